@@ -1,4 +1,8 @@
-﻿from typing import List
+﻿import re
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterable, Iterator, List
 
 try:
     from medspacy.context import ConText
@@ -6,10 +10,74 @@ try:
 except ImportError:
     ConText = None
 
-def medical_chunk(text: str) -> List[str]:
-    if ConText is None:
-        return [chunk.strip() for chunk in text.split('.') if chunk.strip()]
+# Clinical abbreviations: their period ends a sentence only when a
+# capitalised word follows ("... 120 mmHg. Next check"), not before
+# lowercase text or a number ("5 mg. daily", "approx. 3 days").
+ABBREVIATIONS = (
+    'mg', 'mcg', 'g', 'kg', 'ml', 'mmol', 'mmHg', 'min', 'hr', 'hrs', 'wk', 'wks', 'yr', 'yrs',
+    'approx', 'incl', 'max', 'no', 'etc', 'pt', 'pts', 'b.i.d', 't.i.d', 'q.i.d', 'q.d', 'p.o',
+    'p.r.n', 'a.m', 'p.m',
+)
+# Titles and connectives that are always followed by more of the sentence.
+NEVER_FINAL = ('dr', 'mr', 'mrs', 'ms', 'prof', 'e.g', 'i.e', 'vs')
+
+
+def _not_after(words) -> str:
+    # One lookbehind per word, since Python lookbehinds must be fixed width;
+    # the words match in any case.
+    return ''.join(rf'(?<!\b(?i:{re.escape(word)})\.)' for word in words)
+
+
+_SENTENCE_BREAK_RE = re.compile(
+    r'(?:(?<=[.!?])|(?<=[.!?]["\')\]]))' + _not_after(NEVER_FINAL)
+    + r'(?:' + _not_after(ABBREVIATIONS) + r'\s+|\s+(?!\s|["(\[]?[a-z0-9]))'
+)
+
+
+def split_sentences(text: str) -> List[str]:
+    """Regex sentence split: breaks after . ! ? and whitespace (see ABBREVIATIONS)."""
+    return [chunk.strip() for chunk in _SENTENCE_BREAK_RE.split(text) if chunk.strip()]
+
+
+@lru_cache(maxsize=None)
+def _context():
+    """The ConText pipeline, built once per process."""
     context = ConText()
     context.add_rule(ConTextRule('because', '', 'FAMILY', direction='forward'))
-    doc = context.nlp(text)
-    return [sent.text.strip() for sent in doc.sents]
+    return context
+
+
+def chunk_texts(texts: List[str], batch_size: int = 64) -> List[List[str]]:
+    """Sentence chunks for each text, streamed through the NLP pipeline in batches."""
+    if ConText is None:
+        return [split_sentences(text) for text in texts]
+    docs = _context().nlp.pipe(texts, batch_size=batch_size)
+    return [[sent.text.strip() for sent in doc.sents if sent.text.strip()] for doc in docs]
+
+
+def iter_chunk_batches(texts: Iterable[str], batch_size: int = 64,
+                       workers: int = 1) -> Iterator[List[List[str]]]:
+    """Chunk a stream of texts, yielding one list of chunk lists per batch, in order.
+
+    With ``workers > 1`` batches are chunked in a process pool, each worker
+    building its own pipeline once; at most ``2 * workers`` batches are in
+    flight, so a large corpus is never held in memory whole.
+    """
+    texts = iter(texts)
+    batches = iter(lambda: list(itertools.islice(texts, batch_size)), [])
+    if workers <= 1:
+        for batch in batches:
+            yield chunk_texts(batch, batch_size)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for batch in batches:
+            pending.append(pool.submit(chunk_texts, batch, batch_size))
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def medical_chunk(text: str) -> List[str]:
+    return chunk_texts([text])[0]
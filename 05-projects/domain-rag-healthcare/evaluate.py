@@ -1,7 +1,33 @@
-﻿import argparse
+﻿"""Score the healthcare index against a labelled query set, offline.
+
+The default mode needs only the ingested artifacts and the local embedding
+model. Queries in the dataset that carry ``relevant`` passage ids are
+embedded and searched in batches. Their rankings are scored with recall@k,
+MRR and nDCG@k. Each query is also timed as a single search, and the
+report records those latency percentiles and the bytes the index
+occupies. ``--baseline`` compares the report with an earlier one and exits
+non-zero when quality drops or latency or memory grows past the
+thresholds.
+
+``relevant`` is either a list of passage ids, each with gain 1, or a
+mapping of id to graded gain. ``--mode promptfoo`` runs the original
+answer-scoring flow, which needs promptfoo and network access.
+"""
+import argparse
 import json
+import math
 import os
+import sys
+import time
 from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 try:
     import promptfoo
@@ -9,6 +35,12 @@ except ImportError:
     promptfoo = None
 
 REPORT_DIR = 'reports'
+CUTOFFS = (1, 3, 5, 10)
+PERCENTILES = (50, 90, 95, 99)
+# Report sections compared against a baseline, and whether higher values are better.
+GATED_SECTIONS = {'metrics': True, 'latency_ms': False, 'memory_bytes': False}
+# Sub-millisecond searches jitter by more than any ratio; ignore latency changes smaller than this.
+LATENCY_SLACK_MS = 1.0
 
 
 def run(dataset: str):
@@ -32,11 +64,217 @@ def run(dataset: str):
         f.write(f"# Healthcare RAG Evaluation\n\n- Dataset: {dataset}\n- Average score: {avg_score}\n- Report: {report_path}\n")
 
 
+def load_labelled(dataset: str) -> List[Dict]:
+    """Dataset entries with relevance labels, as ``{'input', 'gains': {id: gain}}``."""
+    if not os.path.exists(dataset):
+        raise SystemExit(f'Dataset not found: {dataset}')
+    with open(dataset, encoding='utf-8-sig') as f:
+        entries = json.load(f)
+    labelled = []
+    for entry in entries:
+        relevant = entry.get('relevant')
+        if not relevant:
+            continue
+        if isinstance(relevant, dict):
+            gains = {str(k): float(v) for k, v in relevant.items() if float(v) > 0}
+        else:
+            gains = {str(k): 1.0 for k in relevant}
+        labelled.append({'input': entry['input'], 'gains': gains})
+    return labelled
+
+
+def recall_at(ranked: Sequence[str], gains: Dict[str, float], k: int) -> float:
+    return sum(1 for doc_id in ranked[:k] if doc_id in gains) / len(gains)
+
+
+def reciprocal_rank(ranked: Sequence[str], gains: Dict[str, float]) -> float:
+    for rank, doc_id in enumerate(ranked, 1):
+        if doc_id in gains:
+            return 1.0 / rank
+    return 0.0
+
+
+def ndcg_at(ranked: Sequence[str], gains: Dict[str, float], k: int) -> float:
+    dcg = sum(gains.get(doc_id, 0.0) / math.log2(rank + 1) for rank, doc_id in enumerate(ranked[:k], 1))
+    ideal = sorted(gains.values(), reverse=True)[:k]
+    idcg = sum(gain / math.log2(rank + 1) for rank, gain in enumerate(ideal, 1))
+    return dcg / idcg if idcg else 0.0
+
+
+def _unique_ids(index, rows) -> List[str]:
+    # Several chunks of one guideline share its id; a guideline counts once, at its best rank.
+    seen = {}
+    for row in rows:
+        seen.setdefault(index.passage(row)['id'], None)
+    return list(seen)
+
+
+def percentiles(values: Sequence[float], prefix: str) -> Dict[str, float]:
+    if not values:
+        return {}
+    points = np.percentile(np.asarray(values, dtype=np.float64), PERCENTILES)
+    stats = {f'{prefix}_p{p}': round(float(v), 4) for p, v in zip(PERCENTILES, points)}
+    stats[f'{prefix}_mean'] = round(float(np.mean(values)), 4)
+    return stats
+
+
+def index_memory(index) -> Dict[str, int]:
+    """Bytes held by the index's vectors and passage buffers, plus this process's peak RSS."""
+    sizes = {'vectors': int(index.vectors.nbytes)}
+    for name in ('blob', 'data', 'offsets', 'block_offsets'):
+        buffer = getattr(index.passages, name, None)
+        if buffer is not None:
+            sizes[f'passages_{name}'] = int(getattr(buffer, 'nbytes', None) or len(buffer))
+    sizes['index_total'] = sum(sizes.values())
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        scale = 1 if sys.platform == 'darwin' else 1024
+        sizes['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return sizes
+
+
+def evaluate_retrieval(dataset: str, top_k: int = 10, batch_size: int = 32, index=None) -> Dict:
+    """Run every labelled query through the index and return the report dict."""
+    from pipeline import EMBEDDING_MODEL, HealthcareIndex, embed_texts
+
+    queries = load_labelled(dataset)
+    if not queries:
+        raise SystemExit(f'No entries with "relevant" passage ids in {dataset}')
+    index = index or HealthcareIndex.load()
+    embed_texts(['warm-up'])  # keep model loading out of the timings
+
+    cutoffs = [k for k in CUTOFFS if k < top_k] + [top_k]
+    per_query, embed_ms, search_ms, batch_ms = [], [], [], []
+    started = time.perf_counter()
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        t0 = time.perf_counter()
+        q_vecs = embed_texts([q['input'] for q in batch])
+        t1 = time.perf_counter()
+        rows, _ = index.search_many(q_vecs, top_k)
+        t2 = time.perf_counter()
+        embed_ms.extend([(t1 - t0) * 1000 / len(batch)] * len(batch))
+        batch_ms.append((t2 - t1) * 1000)
+        for q, q_vec, q_rows in zip(batch, q_vecs, rows):
+            t = time.perf_counter()
+            index.search(q_vec, top_k)
+            search_ms.append((time.perf_counter() - t) * 1000)
+            ranked = _unique_ids(index, q_rows.tolist())
+            scores = {f'recall@{k}': recall_at(ranked, q['gains'], k) for k in cutoffs}
+            scores['mrr'] = reciprocal_rank(ranked, q['gains'])
+            scores.update({f'ndcg@{k}': ndcg_at(ranked, q['gains'], k) for k in cutoffs})
+            per_query.append({'input': q['input'], 'relevant': q['gains'], 'retrieved': ranked,
+                              'scores': scores, 'search_ms': round(search_ms[-1], 4)})
+    elapsed = time.perf_counter() - started
+
+    metrics = {name: round(float(np.mean([q['scores'][name] for q in per_query])), 4)
+               for name in per_query[0]['scores']}
+    latency = percentiles(search_ms, 'search')
+    latency.update(percentiles(embed_ms, 'embed'))
+    latency.update(percentiles(batch_ms, 'batch_search'))
+    return {
+        'dataset': dataset,
+        'created': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'model': EMBEDDING_MODEL,
+        'passages': len(index),
+        'queries': len(per_query),
+        'top_k': top_k,
+        'batch_size': batch_size,
+        'metrics': metrics,
+        'latency_ms': latency,
+        'throughput_qps': round(len(per_query) / elapsed, 2) if elapsed else None,
+        'memory_bytes': index_memory(index),
+        'per_query': per_query,
+    }
+
+
+def compare(report: Dict, baseline: Dict, max_metric_drop: float = 0.01,
+            max_latency_increase: float = 0.5, max_memory_increase: float = 0.1) -> List[Dict]:
+    """One row per value present in both reports, flagged when it regressed past its threshold.
+
+    ``max_metric_drop`` is absolute; the latency and memory limits are
+    ratios of the baseline value.
+    """
+    rows = []
+    for section, higher_is_better in GATED_SECTIONS.items():
+        old_values, new_values = baseline.get(section, {}), report.get(section, {})
+        for name in sorted(set(old_values) & set(new_values)):
+            old, new = old_values[name], new_values[name]
+            delta = new - old
+            if higher_is_better:
+                regressed = -delta > max_metric_drop
+            elif section == 'latency_ms':
+                regressed = delta > max(old * max_latency_increase, LATENCY_SLACK_MS)
+            else:
+                regressed = name != 'peak_rss' and delta > old * max_memory_increase
+            rows.append({'section': section, 'name': name, 'baseline': old, 'current': new,
+                         'delta': round(delta, 4), 'regressed': regressed})
+    return rows
+
+
+def print_report(report: Dict, diff: Optional[List[Dict]] = None):
+    print(f"Evaluated {report['queries']} queries against {report['passages']} passages "
+          f"(top_k={report['top_k']}, {report['throughput_qps']} queries/s).")
+    for name, value in report['metrics'].items():
+        print(f'  {name:<14} {value:.4f}')
+    for name in ('search_p50', 'search_p95', 'search_p99', 'embed_mean'):
+        if name in report['latency_ms']:
+            print(f"  {name:<14} {report['latency_ms'][name]:.3f} ms")
+    print(f"  {'index bytes':<14} {report['memory_bytes']['index_total']}")
+    if diff:
+        print('\nAgainst baseline:')
+        for row in diff:
+            flag = '  REGRESSION' if row['regressed'] else ''
+            name = f"{row['section']}.{row['name']}"
+            print(f"  {name:<36} {row['baseline']} -> {row['current']} ({row['delta']:+}){flag}")
+
+
+def run_retrieval(dataset: str, top_k: int = 10, batch_size: int = 32, output: Optional[str] = None,
+                  baseline: Optional[str] = None, **thresholds) -> bool:
+    """Evaluate, write the JSON report, and return False if it regressed against ``baseline``."""
+    report = evaluate_retrieval(dataset, top_k, batch_size)
+    diff = None
+    if baseline:
+        with open(baseline, encoding='utf-8') as f:
+            diff = compare(report, json.load(f), **thresholds)
+        report['baseline'] = {'path': baseline, 'diff': diff}
+    if output is None:
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        timestamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(REPORT_DIR, f'retrieval-{timestamp}.json')
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print_report(report, diff)
+    print(f'\nStored JSON at {output}')
+    return not any(row['regressed'] for row in diff or ())
+
+
 def main():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description='Evaluate the healthcare RAG index')
     parser.add_argument('--dataset', default='eval/healthcare.json')
+    parser.add_argument('--mode', choices=['retrieval', 'promptfoo'], default='retrieval',
+                        help='offline retrieval metrics (default) or promptfoo answer scoring')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=32, help='queries embedded and searched together')
+    parser.add_argument('--output', help='report path (default reports/retrieval-<timestamp>.json)')
+    parser.add_argument('--baseline', help='earlier retrieval report to diff against; exit 1 on regression')
+    parser.add_argument('--max-metric-drop', type=float, default=0.01,
+                        help='allowed absolute drop in any quality metric')
+    parser.add_argument('--max-latency-increase', type=float, default=0.5,
+                        help='allowed latency growth as a fraction of the baseline')
+    parser.add_argument('--max-memory-increase', type=float, default=0.1,
+                        help='allowed index size growth as a fraction of the baseline')
     args = parser.parse_args()
-    run(args.dataset)
+
+    if args.mode == 'promptfoo':
+        run(args.dataset)
+        return
+    ok = run_retrieval(args.dataset, args.top_k, args.batch_size, args.output, args.baseline,
+                       max_metric_drop=args.max_metric_drop,
+                       max_latency_increase=args.max_latency_increase,
+                       max_memory_increase=args.max_memory_increase)
+    if not ok:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,244 @@
+﻿"""Binary, offset-indexed passage store for the healthcare RAG artifacts.
+
+Each passage is one record of length-prefixed UTF-8 fields (id, title,
+content), so tabs and newlines in the text are safe. Records are
+concatenated in passages.bin; passages.offsets.npy holds the int64 start
+of every record plus the end of the last one. Row ``r`` is the slice
+``offsets[r]:offsets[r + 1]`` of a memory map, so reading the top-k
+passages touches only their bytes.
+
+With compression ('zlib', or 'zstd' when the zstandard package is
+installed) records are packed into blocks of ``block_size`` rows, each
+compressed on its own; offsets then count uncompressed bytes and
+passages.blocks.npy locates each compressed block. A lookup decompresses
+one block, and recently used blocks are kept.
+"""
+import os
+import json
+import mmap
+import struct
+import zlib
+from functools import lru_cache, partial
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FIELDS = ('id', 'title', 'content')
+BLOB_FILE = 'passages.bin'
+OFFSETS_FILE = 'passages.offsets.npy'
+BLOCKS_FILE = 'passages.blocks.npy'
+META_FILE = 'passages.json'
+PARTIAL = '.partial'
+FORMAT_VERSION = 1
+
+_LENGTH = struct.Struct('<I')
+
+
+def encode_record(passage: Dict[str, str]) -> bytes:
+    parts = []
+    for field in FIELDS:
+        data = passage[field].encode('utf-8')
+        parts.append(_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def decode_record(data) -> Dict[str, str]:
+    passage, pos = {}, 0
+    for field in FIELDS:
+        (length,) = _LENGTH.unpack_from(data, pos)
+        pos += _LENGTH.size
+        passage[field] = bytes(data[pos:pos + length]).decode('utf-8')
+        pos += length
+    return passage
+
+
+def _codec(compression: str):
+    """(compress, decompress) for a compression name."""
+    if compression == 'zlib':
+        return zlib.compress, zlib.decompress
+    if compression == 'zstd':
+        if zstandard is None:
+            raise SystemExit('Install zstandard for zstd passage compression: pip install zstandard')
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError(f'Unknown passage compression: {compression}')
+
+
+def open_append(path: str, size: int):
+    """Open ``path`` for appending after its first ``size`` bytes."""
+    f = open(path, 'r+b' if size and os.path.exists(path) else 'wb')
+    f.truncate(size)
+    f.seek(size)
+    return f
+
+
+class PassageWriter:
+    """Append passages to .partial store files; finish() moves them into place.
+
+    ``rows`` and ``blob_bytes`` reopen an interrupted write at a state
+    returned by checkpoint(). A compressed store can only checkpoint
+    between blocks, so append in multiples of ``block_size`` rows.
+    """
+
+    def __init__(self, directory: str, compression: str = 'none', block_size: int = 64,
+                 rows: int = 0, blob_bytes: int = 0):
+        self.directory = directory
+        self.compression = compression
+        self.block_size = block_size
+        self.rows = rows
+        self._compress = None if compression == 'none' else _codec(compression)[0]
+        self._blob = open_append(self._path(BLOB_FILE), blob_bytes)
+        self._ends = open_append(self._path(OFFSETS_FILE), rows * 8)
+        self._raw_bytes = 0
+        if rows:
+            self._ends.seek(-8, os.SEEK_END)
+            self._raw_bytes = int.from_bytes(self._ends.read(8), 'little')
+        blocks = -(-rows // block_size) if self._compress else 0
+        self._block_ends = open_append(self._path(BLOCKS_FILE), blocks * 8)
+        self._pending: List[bytes] = []
+
+    @staticmethod
+    def can_resume(directory: str, compression: str, block_size: int, rows: int,
+                   blob_bytes: int) -> bool:
+        """Whether the .partial files still hold a state returned by checkpoint()."""
+        blocks = -(-rows // block_size) if compression != 'none' else 0
+        sizes = {BLOB_FILE: blob_bytes, OFFSETS_FILE: rows * 8, BLOCKS_FILE: blocks * 8}
+        for name, size in sizes.items():
+            path = os.path.join(directory, name + PARTIAL)
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                return False
+        return True
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name + PARTIAL)
+
+    def append(self, passages: Iterable[Dict[str, str]]):
+        ends = []
+        for passage in passages:
+            record = encode_record(passage)
+            self._raw_bytes += len(record)
+            ends.append(self._raw_bytes)
+            if self._compress is None:
+                self._blob.write(record)
+            else:
+                self._pending.append(record)
+                if len(self._pending) == self.block_size:
+                    self._write_block()
+        self._ends.write(np.asarray(ends, dtype=np.int64).tobytes())
+        self.rows += len(ends)
+
+    def _write_block(self):
+        self._blob.write(self._compress(b''.join(self._pending)))
+        self._block_ends.write(self._blob.tell().to_bytes(8, 'little'))
+        self._pending = []
+
+    def checkpoint(self) -> Optional[Dict[str, int]]:
+        """Flush to disk and return the state to resume from.
+
+        None while a compressed block is still open; only finish() closes it.
+        """
+        for f in (self._blob, self._ends, self._block_ends):
+            f.flush()
+        if self._pending:
+            return None
+        return {'rows': self.rows, 'blob_bytes': self._blob.tell()}
+
+    def finish(self):
+        """Write the last block, the offset arrays, and the metadata.
+
+        Every file is completed under its .partial name and then renamed
+        over the old one, so a reader that already has the previous store
+        mapped keeps a consistent set of files.
+        """
+        if self._pending:
+            self._write_block()
+        for f in (self._blob, self._ends, self._block_ends):
+            f.close()
+        zero = np.zeros(1, dtype=np.int64)
+        for name in (OFFSETS_FILE, BLOCKS_FILE):
+            with open(self._path(name), 'rb') as f:
+                ends = np.frombuffer(f.read(), dtype=np.int64)
+            # A file object, since np.save would add .npy to the .partial name.
+            with open(self._path(name), 'wb') as f:
+                np.save(f, np.concatenate([zero, ends]))
+        with open(self._path(META_FILE), 'w', encoding='utf-8') as f:
+            json.dump({'format_version': FORMAT_VERSION, 'rows': self.rows,
+                       'compression': self.compression, 'block_size': self.block_size}, f, indent=2)
+        for name in (BLOB_FILE, BLOCKS_FILE, OFFSETS_FILE, META_FILE):
+            os.replace(self._path(name), os.path.join(self.directory, name))
+
+
+class PassageStore:
+    """Read-only random access to a store written by PassageWriter."""
+
+    def __init__(self, blob, offsets: np.ndarray, compression: str = 'none', block_size: int = 64,
+                 block_offsets: Optional[np.ndarray] = None, cached_blocks: int = 64):
+        self.blob = blob
+        self.offsets = offsets
+        self.compression = compression
+        self.block_size = block_size
+        self.block_offsets = block_offsets
+        if compression != 'none':
+            decompress = _codec(compression)[1]
+            self._block = lru_cache(maxsize=cached_blocks)(
+                lambda b: decompress(self.blob[int(block_offsets[b]):int(block_offsets[b + 1])]))
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, META_FILE))
+
+    @classmethod
+    def open(cls, directory: str) -> 'PassageStore':
+        path = partial(os.path.join, directory)
+        with open(path(META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported passage store format: {meta.get('format_version')!r}")
+        with open(path(BLOB_FILE), 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                blob = b''
+        return cls(blob, np.load(path(OFFSETS_FILE), mmap_mode='r'), meta['compression'],
+                   meta['block_size'], np.load(path(BLOCKS_FILE), mmap_mode='r'))
+
+    def __len__(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, row: int) -> Dict[str, str]:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        if self.compression == 'none':
+            return decode_record(memoryview(self.blob)[start:end])
+        block = row // self.block_size
+        base = int(self.offsets[block * self.block_size])
+        return decode_record(memoryview(self._block(block))[start - base:end - base])
+
+
+class TabSeparatedPassages:
+    """passages.txt from ingests that predate the binary store (id, title, content per line)."""
+
+    def __init__(self, path: str, offsets: Optional[np.ndarray] = None):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b''
+        if offsets is None:
+            ends = [0]
+            for line in iter(self.data.readline, b'') if self.data else ():
+                ends.append(ends[-1] + len(line))
+            offsets = np.asarray(ends, dtype=np.int64)
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, row: int) -> Dict[str, str]:
+        line = self.data[int(self.offsets[row]):int(self.offsets[row + 1])]
+        doc_id, title, content = line.decode('utf-8').rstrip('\r\n').split('\t', 2)
+        return {'id': doc_id, 'title': title, 'content': content}
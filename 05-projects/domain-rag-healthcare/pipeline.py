@@ -1,11 +1,19 @@
 ﻿import os
+import sys
 import csv
+import json
+import socket
+import hashlib
 import argparse
-from typing import List, Dict
+import itertools
+import threading
+import socketserver
+from typing import List, Dict, Iterator, Optional, Tuple, Union
 
-from sentence_transformers import SentenceTransformer
 import numpy as np
 
+from passage_store import PassageStore, PassageWriter, TabSeparatedPassages, open_append
+
 try:
     from langchain.vectorstores import SupabaseVectorStore
     from langchain.embeddings.openai import OpenAIEmbeddings
@@ -15,6 +23,23 @@ except ImportError:
 
 EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
 DATA_FILE = os.getenv('DATA_FILE', 'data/clinical_guidelines.csv')
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '1024'))
+PASSAGE_COMPRESSION = os.getenv('PASSAGE_COMPRESSION', 'none')
+PASSAGE_BLOCK_SIZE = int(os.getenv('PASSAGE_BLOCK_SIZE', '64'))
+ARTIFACTS_DIR = 'artifacts'
+MATRIX_FILE = 'embeddings.f32'
+HASHES_FILE = 'content_hashes.npy'
+META_FILE = 'index.json'
+CHECKPOINT_FILE = 'ingest_checkpoint.json'
+PARTIAL = '.partial'
+# Written by earlier ingests; still readable.
+EMBEDDINGS_FILE = 'embeddings.npy'
+PASSAGES_FILE = 'passages.txt'
+OFFSETS_FILE = 'passages_offsets.npy'
+SOCKET_PATH = os.getenv('HEALTHCARE_RAG_SOCKET', '/tmp/healthcare-rag.sock')
+
+_MODELS: Dict[str, object] = {}
+_MODELS_LOCK = threading.Lock()
 
 
 def load_corpus() -> List[Dict[str, str]]:
@@ -23,61 +48,420 @@ def load_corpus() -> List[Dict[str, str]]:
         return list(reader)
 
 
+def get_model(name: Optional[str] = None):
+    """The embedding backend for ``name`` (default EMBEDDING_MODEL), loaded once per process."""
+    name = name or EMBEDDING_MODEL
+    with _MODELS_LOCK:
+        if name not in _MODELS:
+            if name.startswith('openai:') and OpenAIEmbeddings:
+                _MODELS[name] = OpenAIEmbeddings(model=name.split(':', 1)[1])
+            else:
+                # Imported on first use so socket clients never pay for torch.
+                from sentence_transformers import SentenceTransformer
+                _MODELS[name] = SentenceTransformer(name)
+        return _MODELS[name]
+
+
 def embed_texts(texts: List[str]):
+    model = get_model()
     if EMBEDDING_MODEL.startswith('openai:') and OpenAIEmbeddings:
-        model_name = EMBEDDING_MODEL.split(':', 1)[1]
-        embeddings = OpenAIEmbeddings(model=model_name)
-        return embeddings.embed_documents(texts)
-    model = SentenceTransformer(EMBEDDING_MODEL)
+        return model.embed_documents(texts)
     return model.encode(texts, convert_to_numpy=True)
 
 
-def ingest():
-    corpus = load_corpus()
-    passages = [row['content'] for row in corpus]
-    vectors = embed_texts(passages)
-    os.makedirs('artifacts', exist_ok=True)
-    np.save('artifacts/embeddings.npy', vectors)
-    with open('artifacts/passages.txt', 'w', encoding='utf-8') as f:
-        for row in corpus:
-            f.write(f"{row['id']}	{row['title']}	{row['content']}\n")
-    print(f"Ingested {len(corpus)} passages using model {EMBEDDING_MODEL}.")
+def normalize_rows(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-8)
+
+
+def iter_corpus_batches(batch_size: int, skip: int = 0) -> Iterator[List[Dict[str, str]]]:
+    with open(DATA_FILE, newline='', encoding='utf-8') as f:
+        rows = itertools.islice(csv.DictReader(f), skip, None)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def content_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class GrowableMatrix:
+    """float32 rows in a raw file, memory-mapped; capacity doubles as rows are appended."""
+
+    def __init__(self, path: str, dim: int, rows: int = 0):
+        self.path = path
+        self.dim = dim
+        self.rows = rows
+        self.capacity = 0
+        self._map = None
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        # Opening at ``rows`` also drops anything past it, e.g. a batch cut off mid-write.
+        self._resize(max(rows, 1024))
+
+    def _resize(self, capacity: int):
+        if self._map is not None:
+            self._map.flush()
+            self._map = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * self.dim * 4)
+        if capacity:
+            self._map = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def append(self, vectors: np.ndarray):
+        if self.rows + len(vectors) > self.capacity:
+            self._resize(max(self.rows + len(vectors), 2 * self.capacity))
+        self._map[self.rows:self.rows + len(vectors)] = vectors
+        self.rows += len(vectors)
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        """Trim the file to the rows written."""
+        self._resize(self.rows)
+
+
+class PreviousIngest:
+    """Vectors of the last completed ingest, looked up by content hash."""
+
+    def __init__(self, hashes: np.ndarray, vectors: np.ndarray):
+        self.order = np.argsort(hashes, kind='stable')
+        self.hashes = hashes[self.order]
+        self.vectors = vectors
+
+    @classmethod
+    def load(cls, artifacts_dir: str = ARTIFACTS_DIR) -> Optional['PreviousIngest']:
+        meta_file = os.path.join(artifacts_dir, META_FILE)
+        hashes_file = os.path.join(artifacts_dir, HASHES_FILE)
+        if not os.path.exists(meta_file) or not os.path.exists(hashes_file):
+            return None
+        with open(meta_file, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['model'] != EMBEDDING_MODEL or not meta['rows']:
+            return None
+        return cls(np.load(hashes_file), _open_matrix(artifacts_dir, meta))
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(found mask, vectors of the found keys) for a batch of content hashes."""
+        pos = np.minimum(np.searchsorted(self.hashes, keys), self.hashes.shape[0] - 1)
+        found = self.hashes[pos] == keys
+        return found, np.asarray(self.vectors[self.order[pos[found]]])
+
+
+def _open_matrix(artifacts_dir: str, meta: Dict) -> np.ndarray:
+    if not meta['rows']:
+        return np.empty((0, meta['dim']), dtype=np.float32)
+    return np.memmap(os.path.join(artifacts_dir, MATRIX_FILE), dtype=np.float32, mode='r',
+                     shape=(meta['rows'], meta['dim']))
+
+
+def _partials_cover(artifacts_dir: str, state: Dict) -> bool:
+    """Whether the .partial files still hold every row a checkpoint recorded."""
+    def covers(name: str, size: int) -> bool:
+        path = os.path.join(artifacts_dir, name + PARTIAL)
+        return os.path.exists(path) and os.path.getsize(path) >= size
+
+    rows = state['rows']
+    return (PassageWriter.can_resume(artifacts_dir, state['compression'], state['block_size'], rows,
+                                     state['passage_bytes'])
+            and covers(HASHES_FILE, rows * 8)
+            and (not state['dim'] or covers(MATRIX_FILE, rows * state['dim'] * 4)))
+
+
+def _write_json(path: str, payload: Dict):
+    with open(path + PARTIAL, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=2)
+    os.replace(path + PARTIAL, path)
+
+
+def ingest(batch_size: int = INGEST_BATCH_SIZE, artifacts_dir: str = ARTIFACTS_DIR,
+           compression: str = PASSAGE_COMPRESSION):
+    """Stream DATA_FILE into the artifacts, ``batch_size`` CSV rows at a time.
+
+    Passages whose content hash matches the previous ingest reuse its vector;
+    only new or edited ones are embedded. Everything is written to .partial
+    files with a checkpoint after each batch, so an interrupted run resumes
+    at the last checkpoint while those files still hold it; the checkpoint
+    is removed before the files replace the previous artifacts. Passages go to a binary PassageStore, compressed in
+    blocks when ``compression`` is 'zlib' or 'zstd'.
+    """
+    os.makedirs(artifacts_dir, exist_ok=True)
+    if compression != 'none':
+        # Checkpoints must fall on compressed block boundaries.
+        batch_size = -(-batch_size // PASSAGE_BLOCK_SIZE) * PASSAGE_BLOCK_SIZE
+
+    def path(name: str) -> str:
+        return os.path.join(artifacts_dir, name)
+
+    state = {'data_file': os.path.abspath(DATA_FILE), 'model': EMBEDDING_MODEL,
+             'compression': compression, 'block_size': PASSAGE_BLOCK_SIZE, 'rows': 0,
+             'passage_bytes': 0, 'dim': 0, 'embedded': 0, 'reused': 0}
+    resume_keys = ('data_file', 'model', 'compression', 'block_size')
+    if os.path.exists(path(CHECKPOINT_FILE)):
+        with open(path(CHECKPOINT_FILE), encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if all(checkpoint.get(key) == state[key] for key in resume_keys):
+            if _partials_cover(artifacts_dir, checkpoint):
+                state = checkpoint
+                print(f"Resuming ingest after {state['rows']} rows.")
+            else:
+                print('Partial ingest files are missing or short; starting over.')
+
+    previous = PreviousIngest.load(artifacts_dir)
+    passages = PassageWriter(artifacts_dir, compression, PASSAGE_BLOCK_SIZE, state['rows'],
+                             state['passage_bytes'])
+    hashes = open_append(path(HASHES_FILE + PARTIAL), state['rows'] * 8)
+    matrix = GrowableMatrix(path(MATRIX_FILE + PARTIAL), state['dim'], state['rows']) \
+        if state['dim'] else None
+    try:
+        for batch in iter_corpus_batches(batch_size, skip=state['rows']):
+            texts = [row['content'] for row in batch]
+            keys = np.fromiter((content_hash(t) for t in texts), dtype=np.uint64, count=len(texts))
+            if previous is not None:
+                found, reused = previous.lookup(keys)
+            else:
+                found, reused = np.zeros(len(texts), dtype=bool), None
+            missing = np.flatnonzero(~found)
+            fresh = normalize_rows(embed_texts([texts[i] for i in missing])) if missing.size else None
+            dim = previous.dim if previous is not None else fresh.shape[1]
+            vectors = np.empty((len(texts), dim), dtype=np.float32)
+            if reused is not None:
+                vectors[found] = reused
+            if fresh is not None:
+                vectors[missing] = fresh
+            if matrix is None:
+                matrix = GrowableMatrix(path(MATRIX_FILE + PARTIAL), dim)
+            matrix.append(vectors)
+
+            passages.append(batch)
+            hashes.write(keys.tobytes())
+            hashes.flush()
+            matrix.flush()
+
+            state.update(rows=state['rows'] + len(batch), dim=dim,
+                         embedded=state['embedded'] + int(missing.size),
+                         reused=state['reused'] + int(found.sum()))
+            saved = passages.checkpoint()
+            # None only after the short last batch of a compressed store.
+            if saved is not None:
+                state['passage_bytes'] = saved['blob_bytes']
+                _write_json(path(CHECKPOINT_FILE), state)
+    finally:
+        hashes.close()
+        if matrix is not None:
+            matrix.close()
+
+    # Release the previous matrix before its file is replaced.
+    previous = None
+    # From here on the .partial files are being promoted; a rerun must start over.
+    if os.path.exists(path(CHECKPOINT_FILE)):
+        os.remove(path(CHECKPOINT_FILE))
+    passages.finish()
+    with open(path(HASHES_FILE + PARTIAL), 'rb') as f:
+        keys = np.frombuffer(f.read(), dtype=np.uint64)
+    with open(path(HASHES_FILE + PARTIAL), 'wb') as f:
+        np.save(f, keys)
+    os.replace(path(HASHES_FILE + PARTIAL), path(HASHES_FILE))
+    if matrix is None:
+        open(path(MATRIX_FILE + PARTIAL), 'wb').close()
+    os.replace(path(MATRIX_FILE + PARTIAL), path(MATRIX_FILE))
+    _write_json(path(META_FILE), {'model': EMBEDDING_MODEL, 'rows': state['rows'], 'dim': state['dim']})
+    for name in (EMBEDDINGS_FILE, PASSAGES_FILE, OFFSETS_FILE):
+        if os.path.exists(path(name)):
+            os.remove(path(name))
+    print(f"Ingested {state['rows']} passages ({state['embedded']} embedded, "
+          f"{state['reused']} unchanged) using model {EMBEDDING_MODEL}.")
+
+
+class HealthcareIndex:
+    """Ingested passages and their embeddings, loaded once and reused across queries.
+
+    Vectors are L2-normalized at ingest and memory-mapped here, so a query is
+    one matrix product plus an argpartition top-k. Passage text stays in a
+    memory-mapped PassageStore and is decoded only for returned rows.
+    """
+
+    def __init__(self, vectors: np.ndarray, passages):
+        self.vectors = vectors
+        self.passages = passages
+
+    @classmethod
+    def load(cls, artifacts_dir: str = ARTIFACTS_DIR) -> 'HealthcareIndex':
+        passages_file = os.path.join(artifacts_dir, PASSAGES_FILE)
+        meta_file = os.path.join(artifacts_dir, META_FILE)
+        emb_file = os.path.join(artifacts_dir, EMBEDDINGS_FILE)
+        has_passages = PassageStore.exists(artifacts_dir) or os.path.exists(passages_file)
+        if not has_passages or not (os.path.exists(meta_file) or os.path.exists(emb_file)):
+            raise SystemExit('Run python pipeline.py ingest first.')
+
+        if os.path.exists(meta_file):
+            with open(meta_file, encoding='utf-8') as f:
+                vectors = _open_matrix(artifacts_dir, json.load(f))
+        else:
+            vectors = np.load(emb_file, mmap_mode='r')
+            if not np.allclose(np.linalg.norm(vectors[:256], axis=1), 1.0, atol=1e-3):
+                # Artifacts from an older ingest are unnormalized; fix them up once in memory.
+                vectors = normalize_rows(vectors)
+        if PassageStore.exists(artifacts_dir):
+            passages = PassageStore.open(artifacts_dir)
+        else:
+            offsets_file = os.path.join(artifacts_dir, OFFSETS_FILE)
+            offsets = np.load(offsets_file) if os.path.exists(offsets_file) else None
+            passages = TabSeparatedPassages(passages_file, offsets)
+        return cls(vectors, passages)
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    def passage(self, row: int) -> Dict[str, str]:
+        return self.passages[row]
+
+    def search_many(self, q_vecs, top_k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+        """(rows, cosine scores) of the top_k passages per query vector, best first."""
+        sims = normalize_rows(np.atleast_2d(q_vecs)) @ self.vectors.T
+        k = min(top_k, sims.shape[1])
+        if k <= 0:
+            empty = np.empty((sims.shape[0], 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        if k < sims.shape[1]:
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(k), (sims.shape[0], 1))
+        scores = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+    def search(self, q_vec, top_k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+        rows, scores = self.search_many([q_vec], top_k)
+        return rows[0], scores[0]
+
+    def query(self, prompt: str, top_k: int = 3) -> List[Dict]:
+        return self.query_many([prompt], top_k)[0]
+
+    def query_many(self, prompts: List[str], top_k: int = 3) -> List[List[Dict]]:
+        """Embed all prompts in one call and rank them in one matrix product."""
+        rows, scores = self.search_many(embed_texts(prompts), top_k)
+        return [
+            [dict(self.passage(row), score=score) for row, score in zip(r.tolist(), s.tolist())]
+            for r, s in zip(rows, scores)
+        ]
+
+
+def print_matches(prompt: str, matches: List[Dict], heading: bool = False):
+    print(f'\nTop matches for: {prompt}' if heading else '\nTop matches:')
+    for match in matches:
+        print(f"- {match['title']} (score={match['score']:.3f})")
+        print(f"  {match['content'][:240]}...\n")
+
+
+def query(prompts: Union[str, List[str]], index: Optional[HealthcareIndex] = None):
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    index = index or HealthcareIndex.load()
+    for prompt, matches in zip(prompts, index.query_many(prompts)):
+        print_matches(prompt, matches, heading=len(prompts) > 1)
+
+
+def _answer(index: HealthcareIndex, line: str, top_k: int) -> str:
+    prompt = line.strip()
+    return json.dumps({'prompt': prompt, 'matches': index.query(prompt, top_k)})
+
+
+def serve(socket_path: Optional[str] = None, top_k: int = 3):
+    """Keep the model and index resident and answer one prompt per line.
 
+    Without ``socket_path`` prompts are read from stdin and answered on
+    stdout; otherwise each connection to the Unix socket gets the same
+    line protocol. Every answer is a JSON object with the prompt and its
+    matches.
+    """
+    index = HealthcareIndex.load()
+    embed_texts(['warm-up'])  # load the model before the first real query
+    if socket_path is None:
+        for line in sys.stdin:
+            if line.strip():
+                print(_answer(index, line, top_k), flush=True)
+        return
+    if not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit('Unix sockets are not available on this platform; run serve without --socket.')
 
-def query(prompt: str):
-    passages_file = 'artifacts/passages.txt'
-    emb_file = 'artifacts/embeddings.npy'
-    if not os.path.exists(passages_file) or not os.path.exists(emb_file):
-        raise SystemExit('Run python pipeline.py ingest first.')
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.decode('utf-8')
+                if line.strip():
+                    self.wfile.write((_answer(index, line, top_k) + '\n').encode('utf-8'))
+                    self.wfile.flush()
 
-    with open(passages_file, encoding='utf-8') as f:
-        rows = [line.strip().split('\t', 2) for line in f]
-    passages = [row[2] for row in rows]
-    titles = [row[1] for row in rows]
-    vectors = np.load(emb_file)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        print(f'Serving {len(index)} passages on {socket_path}', file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
 
-    q_vec = embed_texts([prompt])[0]
-    sims = np.dot(vectors, q_vec) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(q_vec) + 1e-8)
-    top_indices = np.argsort(sims)[::-1][:3]
 
-    print('\nTop matches:')
-    for idx in top_indices:
-        print(f"- {titles[idx]} (score={sims[idx]:.3f})")
-        print(f"  {passages[idx][:240]}...\n")
+def ask(prompts: List[str], socket_path: str = SOCKET_PATH) -> List[List[Dict]]:
+    """Send prompts to a running ``serve --socket`` process; one match list per prompt."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        stream = sock.makefile('rwb')
+        results = []
+        for prompt in prompts:
+            stream.write((' '.join(prompt.split()) + '\n').encode('utf-8'))
+            stream.flush()
+            results.append(json.loads(stream.readline())['matches'])
+        return results
 
 
 def main():
     parser = argparse.ArgumentParser(description='Healthcare RAG pipeline utility')
     sub = parser.add_subparsers(dest='cmd', required=True)
-    sub.add_parser('ingest')
+    ingest_parser = sub.add_parser('ingest')
+    ingest_parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE,
+                               help='CSV rows embedded and checkpointed together')
+    ingest_parser.add_argument('--compression', choices=['none', 'zlib', 'zstd'],
+                               default=PASSAGE_COMPRESSION, help='block compression for passage text')
     q_parser = sub.add_parser('query')
-    q_parser.add_argument('prompt')
+    q_parser.add_argument('prompt', nargs='*', help='the question; quoting is optional')
+    q_parser.add_argument('-q', '--question', action='append', default=[],
+                          help='another question, embedded and ranked with the first; repeatable')
+    q_parser.add_argument('--socket', metavar='PATH',
+                          help=f'ask a running serve process (e.g. {SOCKET_PATH}) instead of loading the model')
+    s_parser = sub.add_parser('serve', help='keep the model and index loaded; one prompt per line')
+    s_parser.add_argument('--socket', nargs='?', const=SOCKET_PATH,
+                          help=f'listen on a Unix socket (default path {SOCKET_PATH}) instead of stdin')
+    s_parser.add_argument('--top-k', type=int, default=3)
     args = parser.parse_args()
+    if args.cmd == 'query':
+        prompts = ([' '.join(args.prompt)] if args.prompt else []) + args.question
+        if not prompts:
+            q_parser.error('give a question')
 
     if args.cmd == 'ingest':
-        ingest()
+        ingest(args.batch_size, compression=args.compression)
+    elif args.cmd == 'query' and args.socket:
+        for prompt, matches in zip(prompts, ask(prompts, args.socket)):
+            print_matches(prompt, matches, heading=len(prompts) > 1)
     elif args.cmd == 'query':
-        query(args.prompt)
+        query(prompts)
+    elif args.cmd == 'serve':
+        serve(args.socket, args.top_k)
 
 
 if __name__ == '__main__':
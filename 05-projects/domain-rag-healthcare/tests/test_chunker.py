@@ -0,0 +1,29 @@
+﻿"""Tests for the clinical sentence chunker."""
+import pytest
+
+from chunker import chunk_texts, iter_chunk_batches, split_sentences
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a. b. c', ['a.', 'b.', 'c']),
+    ('BP 120 mmHg. Next check in 2 wks. Patient stable!',
+     ['BP 120 mmHg.', 'Next check in 2 wks.', 'Patient stable!']),
+    ('Give 5 mg. daily for approx. 3 days. Review in 1 wk.',
+     ['Give 5 mg. daily for approx. 3 days.', 'Review in 1 wk.']),
+    ('Seen by Dr. Lee today. Start e.g. Lisinopril.', ['Seen by Dr. Lee today.', 'Start e.g. Lisinopril.']),
+    ('Low vitamin D. Recheck in spring?  Yes.', ['Low vitamin D.', 'Recheck in spring?', 'Yes.']),
+    ('He said "stop." Then left.', ['He said "stop."', 'Then left.']),
+    ('Take 5 mg.  twice daily.', ['Take 5 mg.  twice daily.']),
+    ('', []),
+])
+def test_split_sentences(text, expected):
+    assert split_sentences(text) == expected
+
+
+def test_process_pool_keeps_batch_order():
+    # Uneven batches finish out of order; the output must still follow the input.
+    texts = [f'Note {i}. ' + 'Stable. ' * (200 if i % 7 == 0 else 1) for i in range(60)]
+    serial = list(iter_chunk_batches(texts, batch_size=4))
+    pooled = list(iter_chunk_batches(iter(texts), batch_size=4, workers=3))
+    assert pooled == serial
+    assert [chunks for batch in pooled for chunks in batch] == chunk_texts(texts)
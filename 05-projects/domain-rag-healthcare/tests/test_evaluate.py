@@ -0,0 +1,108 @@
+﻿"""Tests for the offline retrieval metrics and the baseline gate."""
+import csv
+import json
+import math
+import sys
+
+import numpy as np
+import pytest
+
+import evaluate
+import pipeline
+from evaluate import compare, load_labelled, ndcg_at, recall_at, reciprocal_rank
+
+
+def test_binary_relevance_metrics():
+    ranked = ['a', 'b', 'c', 'd']
+    gains = {'b': 1.0, 'd': 1.0}
+    assert recall_at(ranked, gains, 1) == 0.0
+    assert recall_at(ranked, gains, 2) == 0.5
+    assert recall_at(ranked, gains, 4) == 1.0
+    assert reciprocal_rank(ranked, gains) == 0.5
+    # DCG = 1/log2(3) + 1/log2(5); ideal = 1 + 1/log2(3).
+    assert ndcg_at(ranked, gains, 4) == pytest.approx((0.63093 + 0.43068) / 1.63093, abs=1e-4)
+    assert ndcg_at(ranked, gains, 1) == 0.0
+
+
+def test_graded_ndcg():
+    # DCG = 1 + 3/log2(4) = 2.5; ideal puts the gain-3 passage first: 3 + 1/log2(3).
+    assert ndcg_at(['a', 'b', 'c'], {'a': 1.0, 'c': 3.0}, 3) == pytest.approx(2.5 / (3 + 1 / math.log2(3)))
+    assert ndcg_at(['c', 'a'], {'a': 1.0, 'c': 3.0}, 2) == pytest.approx(1.0)
+
+
+def test_no_relevant_passage_retrieved():
+    assert recall_at(['x', 'y'], {'a': 1.0}, 2) == 0.0
+    assert reciprocal_rank(['x', 'y'], {'a': 1.0}) == 0.0
+    assert ndcg_at(['x', 'y'], {'a': 1.0}, 2) == 0.0
+
+
+def test_load_labelled_skips_unlabelled_and_zero_gains(tmp_path):
+    dataset = tmp_path / 'queries.json'
+    dataset.write_text(json.dumps([
+        {'input': 'q1', 'relevant': ['A', 'B']},
+        {'input': 'q2', 'relevant': {'A': 2, 'B': 0}},
+        {'input': 'q3'},
+    ]), encoding='utf-8')
+    assert load_labelled(str(dataset)) == [
+        {'input': 'q1', 'gains': {'A': 1.0, 'B': 1.0}},
+        {'input': 'q2', 'gains': {'A': 2.0}},
+    ]
+
+
+def test_compare_flags_only_drops_past_the_tolerance():
+    baseline = {'metrics': {'mrr': 0.8, 'recall@1': 0.7}, 'memory_bytes': {'index_total': 1000}}
+    report = {'metrics': {'mrr': 0.79, 'recall@1': 0.65}, 'memory_bytes': {'index_total': 1200}}
+    regressed = {row['name'] for row in compare(report, baseline, max_metric_drop=0.02) if row['regressed']}
+    assert regressed == {'recall@1', 'index_total'}
+
+
+def embed(texts):
+    return np.stack([np.random.default_rng(pipeline.content_hash(t)).normal(size=8) for t in texts])
+
+
+@pytest.fixture
+def artifacts(tmp_path, monkeypatch):
+    """A three-passage index in tmp_path/artifacts, with queries that find each passage first."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, 'DATA_FILE', 'corpus.csv')
+    monkeypatch.setattr(pipeline, 'embed_texts', embed)
+    rows = [{'id': f'G-{i}', 'title': f'Guideline {i}', 'content': f'Guideline text {i}.'} for i in range(3)]
+    with open('corpus.csv', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['id', 'title', 'content'])
+        writer.writeheader()
+        writer.writerows(rows)
+    pipeline.ingest(batch_size=2)
+    with open('queries.json', 'w', encoding='utf-8') as f:
+        json.dump([{'input': row['content'], 'relevant': [row['id']]} for row in rows], f)
+    return tmp_path
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['evaluate.py', '--dataset', 'queries.json', '--top-k', '3', *args])
+    evaluate.main()
+
+
+def test_baseline_gate_exit_code(artifacts, monkeypatch):
+    run_main(monkeypatch, '--output', 'baseline.json')
+    with open('baseline.json', encoding='utf-8') as f:
+        baseline = json.load(f)
+    assert baseline['metrics']['mrr'] == 1.0
+    assert baseline['metrics']['recall@1'] == 1.0
+    # Gate on quality alone; latency on a three-row index is noise.
+    del baseline['latency_ms']
+
+    baseline['metrics']['mrr'] = 1.005
+    with open('within.json', 'w', encoding='utf-8') as f:
+        json.dump(baseline, f)
+    run_main(monkeypatch, '--output', 'current.json', '--baseline', 'within.json')
+
+    baseline['metrics']['mrr'] = 1.05
+    with open('dropped.json', 'w', encoding='utf-8') as f:
+        json.dump(baseline, f)
+    with pytest.raises(SystemExit) as exc:
+        run_main(monkeypatch, '--output', 'current.json', '--baseline', 'dropped.json',
+                 '--max-metric-drop', '0.01')
+    assert exc.value.code == 1
+    with open('current.json', encoding='utf-8') as f:
+        diff = json.load(f)['baseline']['diff']
+    assert [row['name'] for row in diff if row['regressed']] == ['mrr']
@@ -0,0 +1,90 @@
+﻿"""Tests for the binary passage store."""
+import os
+
+import pytest
+
+from passage_store import BLOB_FILE, PARTIAL, PassageStore, PassageWriter, TabSeparatedPassages
+
+
+def make_passages(n):
+    return [{'id': f'doc-{i}', 'title': f'Title\t{i}',
+             'content': f'Line one\nline two\twith tab, caf\u00e9 \u00b5g \u2264 {i} \U0001F489'}
+            for i in range(n)]
+
+
+def write_store(directory, passages, compression, block_size=4):
+    writer = PassageWriter(str(directory), compression, block_size)
+    writer.append(passages)
+    writer.finish()
+    return PassageStore.open(str(directory))
+
+
+def read_all(store):
+    return [store[row] for row in range(len(store))]
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+@pytest.mark.parametrize('n', [0, 1, 4, 11])
+def test_round_trip(tmp_path, compression, n):
+    passages = make_passages(n)
+    store = write_store(tmp_path, passages, compression)
+    assert len(store) == n
+    assert read_all(store) == passages
+    assert not any(name.endswith(PARTIAL) for name in os.listdir(tmp_path))
+
+
+def test_compressed_reads_in_any_order(tmp_path):
+    passages = make_passages(11)
+    store = write_store(tmp_path, passages, 'zlib')
+    for row in (10, 0, 5, 3, 8, 10):
+        assert store[row] == passages[row]
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_resume_from_checkpoint(tmp_path, compression):
+    passages = make_passages(11)
+    clean = tmp_path / 'clean'
+    resumed = tmp_path / 'resumed'
+    clean.mkdir()
+    resumed.mkdir()
+    write_store(clean, passages, compression)
+
+    writer = PassageWriter(str(resumed), compression, block_size=4)
+    writer.append(passages[:4])
+    state = writer.checkpoint()
+    assert state['rows'] == 4
+    # Rows written after the checkpoint are lost in the interruption.
+    writer.append(passages[4:6])
+    writer.checkpoint()
+    for f in (writer._blob, writer._ends, writer._block_ends):
+        f.close()
+
+    writer = PassageWriter(str(resumed), compression, block_size=4, **state)
+    writer.append(passages[4:])
+    writer.finish()
+
+    assert read_all(PassageStore.open(str(resumed))) == passages
+    with open(clean / BLOB_FILE, 'rb') as a, open(resumed / BLOB_FILE, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_checkpoint_waits_for_a_closed_block(tmp_path):
+    writer = PassageWriter(str(tmp_path), 'zlib', block_size=4)
+    writer.append(make_passages(3))
+    assert writer.checkpoint() is None
+    writer.finish()
+
+
+def test_legacy_tab_separated_passages(tmp_path):
+    path = tmp_path / 'passages.txt'
+    path.write_bytes('a\tFirst\tplain text\nb\tSecond\tcaf\u00e9\tand tab\r\n'.encode('utf-8'))
+    passages = TabSeparatedPassages(str(path))
+    assert len(passages) == 2
+    assert passages[0] == {'id': 'a', 'title': 'First', 'content': 'plain text'}
+    assert passages[1] == {'id': 'b', 'title': 'Second', 'content': 'caf\u00e9\tand tab'}
+
+
+def test_legacy_empty_file(tmp_path):
+    path = tmp_path / 'passages.txt'
+    path.write_bytes(b'')
+    assert len(TabSeparatedPassages(str(path))) == 0
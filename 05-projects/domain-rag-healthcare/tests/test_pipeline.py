@@ -0,0 +1,306 @@
+﻿"""Tests for the streaming, resumable ingest."""
+import csv
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+
+import pipeline
+from passage_store import PassageWriter
+from pipeline import GrowableMatrix, HealthcareIndex, ask, content_hash, get_model, ingest, query, serve
+
+
+def write_corpus(path, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['id', 'title', 'content'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def make_rows(n, edited=()):
+    return [{'id': f'G-{i:03d}', 'title': f'Guideline {i}',
+             'content': f'Check BP\tweekly; dose {i} mg.\nReview in {i} wks.' + (' Revised.' if i in edited else '')}
+            for i in range(n)]
+
+
+class FakeEmbedder:
+    """Deterministic vectors per text; optionally fails on a given call."""
+
+    def __init__(self, fail_on_call=None):
+        self.calls = []
+        self.fail_on_call = fail_on_call
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        if len(self.calls) == self.fail_on_call:
+            raise KeyboardInterrupt
+        return np.stack([np.random.default_rng(content_hash(t)).normal(size=8) for t in texts])
+
+    @property
+    def texts(self):
+        return [t for call in self.calls for t in call]
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    data_file = tmp_path / 'corpus.csv'
+    monkeypatch.setattr(pipeline, 'DATA_FILE', str(data_file))
+    monkeypatch.setattr(pipeline, 'PASSAGE_BLOCK_SIZE', 4)
+    return data_file
+
+
+def artifacts(directory):
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), 'rb') as f:
+            files[name] = f.read()
+    return files
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_resumed_ingest_matches_a_clean_run(tmp_path, corpus, monkeypatch, compression):
+    rows = make_rows(23)
+    write_corpus(corpus, rows)
+    clean, resumed = str(tmp_path / 'clean'), str(tmp_path / 'resumed')
+
+    monkeypatch.setattr(pipeline, 'embed_texts', FakeEmbedder())
+    ingest(batch_size=4, artifacts_dir=clean, compression=compression)
+
+    monkeypatch.setattr(pipeline, 'embed_texts', FakeEmbedder(fail_on_call=4))
+    with pytest.raises(KeyboardInterrupt):
+        ingest(batch_size=4, artifacts_dir=resumed, compression=compression)
+    assert os.path.exists(os.path.join(resumed, pipeline.CHECKPOINT_FILE))
+
+    embedder = FakeEmbedder()
+    monkeypatch.setattr(pipeline, 'embed_texts', embedder)
+    ingest(batch_size=4, artifacts_dir=resumed, compression=compression)
+    # Only the batches after the last checkpoint are embedded again.
+    assert embedder.texts == [row['content'] for row in rows[12:]]
+
+    assert artifacts(resumed) == artifacts(clean)
+    index = HealthcareIndex.load(resumed)
+    assert [index.passages[i] for i in range(len(rows))] == rows
+
+
+def test_interrupt_while_promoting_files_starts_over(tmp_path, corpus, monkeypatch):
+    rows = make_rows(10)
+    write_corpus(corpus, rows)
+    clean, out = str(tmp_path / 'clean'), str(tmp_path / 'artifacts')
+    monkeypatch.setattr(pipeline, 'embed_texts', FakeEmbedder())
+    ingest(batch_size=4, artifacts_dir=clean)
+
+    finish = PassageWriter.finish
+
+    def interrupted_finish(self):
+        finish(self)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(PassageWriter, 'finish', interrupted_finish)
+    with pytest.raises(KeyboardInterrupt):
+        ingest(batch_size=4, artifacts_dir=out)
+    monkeypatch.setattr(PassageWriter, 'finish', finish)
+
+    embedder = FakeEmbedder()
+    monkeypatch.setattr(pipeline, 'embed_texts', embedder)
+    ingest(batch_size=4, artifacts_dir=out)
+    assert embedder.texts == [row['content'] for row in rows]
+    assert artifacts(out) == artifacts(clean)
+
+
+@pytest.mark.parametrize('damage', ['remove', 'truncate'])
+def test_checkpoint_without_its_partial_files_is_ignored(tmp_path, corpus, monkeypatch, damage):
+    rows = make_rows(10)
+    write_corpus(corpus, rows)
+    out = str(tmp_path / 'artifacts')
+    monkeypatch.setattr(pipeline, 'embed_texts', FakeEmbedder(fail_on_call=3))
+    with pytest.raises(KeyboardInterrupt):
+        ingest(batch_size=4, artifacts_dir=out)
+    blob = os.path.join(out, 'passages.bin' + pipeline.PARTIAL)
+    if damage == 'remove':
+        os.remove(blob)
+    else:
+        with open(blob, 'r+b') as f:
+            f.truncate(10)
+
+    monkeypatch.setattr(pipeline, 'embed_texts', FakeEmbedder())
+    ingest(batch_size=4, artifacts_dir=out)
+    index = HealthcareIndex.load(out)
+    assert [index.passage(i) for i in range(len(index))] == rows
+    assert np.all(np.linalg.norm(index.vectors, axis=1) > 0.99)
+
+
+def test_unchanged_passages_are_not_re_embedded(tmp_path, corpus, monkeypatch):
+    out = str(tmp_path / 'artifacts')
+    write_corpus(corpus, make_rows(10))
+    monkeypatch.setattr(pipeline, 'embed_texts', FakeEmbedder())
+    ingest(batch_size=4, artifacts_dir=out)
+    before = np.array(HealthcareIndex.load(out).vectors)
+
+    rows = make_rows(12, edited={3})
+    write_corpus(corpus, rows)
+    embedder = FakeEmbedder()
+    monkeypatch.setattr(pipeline, 'embed_texts', embedder)
+    ingest(batch_size=4, artifacts_dir=out)
+
+    assert embedder.texts == [rows[i]['content'] for i in (3, 10, 11)]
+    after = np.array(HealthcareIndex.load(out).vectors)
+    unchanged = [i for i in range(10) if i != 3]
+    np.testing.assert_array_equal(after[unchanged], before[unchanged])
+    np.testing.assert_allclose(np.linalg.norm(after, axis=1), 1.0, rtol=1e-5)
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_open_index_survives_a_re_ingest(tmp_path, corpus, monkeypatch, compression):
+    out = str(tmp_path / 'artifacts')
+    rows = make_rows(50)
+    write_corpus(corpus, rows)
+    monkeypatch.setattr(pipeline, 'embed_texts', FakeEmbedder())
+    ingest(batch_size=8, artifacts_dir=out, compression=compression)
+    index = HealthcareIndex.load(out)
+    vectors = np.array(index.vectors)
+
+    write_corpus(corpus, make_rows(10, edited=range(10)))
+    ingest(batch_size=8, artifacts_dir=out, compression=compression)
+
+    # The open index still reads the files it mapped, not a mix of old and new.
+    assert [index.passage(i) for i in range(len(index))] == rows
+    np.testing.assert_array_equal(index.vectors, vectors)
+    assert len(HealthcareIndex.load(out)) == 10
+
+
+def test_growable_matrix_grows_and_trims(tmp_path):
+    path = str(tmp_path / 'matrix.f32')
+    matrix = GrowableMatrix(path, dim=3)
+    assert matrix.capacity == 1024
+    data = np.arange(3000 * 3, dtype=np.float32).reshape(3000, 3)
+    for start in range(0, 3000, 700):
+        matrix.append(data[start:start + 700])
+    assert matrix.rows == 3000
+    assert matrix.capacity == 4096
+    matrix.close()
+    assert os.path.getsize(path) == data.nbytes
+    np.testing.assert_array_equal(np.fromfile(path, dtype=np.float32).reshape(-1, 3), data)
+
+    # Reopening at a checkpoint drops the rows written after it.
+    matrix = GrowableMatrix(path, dim=3, rows=2000)
+    matrix.append(data[:5])
+    matrix.close()
+    stored = np.fromfile(path, dtype=np.float32).reshape(-1, 3)
+    np.testing.assert_array_equal(stored, np.concatenate([data[:2000], data[:5]]))
+
+
+@pytest.fixture
+def served_rows(tmp_path, corpus, monkeypatch):
+    """Single-line rows ingested into ./artifacts, where serve() loads its index."""
+    rows = [{'id': f'G-{i:03d}', 'title': f'Guideline {i}', 'content': f'Guideline text {i}.'}
+            for i in range(6)]
+    write_corpus(corpus, rows)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, 'embed_texts', FakeEmbedder())
+    ingest(batch_size=4)
+    return rows
+
+
+def test_query_many_ranks_each_prompt(served_rows):
+    index = HealthcareIndex.load()
+    assert isinstance(index.vectors, np.memmap)
+    results = index.query_many([served_rows[3]['content'], served_rows[0]['content']], top_k=2)
+    assert [[match['id'] for match in matches][0] for matches in results] == ['G-003', 'G-000']
+    assert all(len(matches) == 2 for matches in results)
+    assert results[0][0] == dict(served_rows[3], score=pytest.approx(1.0))
+    assert results[0][0]['score'] >= results[0][1]['score']
+
+
+def test_query_takes_a_string_or_a_list(served_rows, capsys):
+    index = HealthcareIndex.load()
+    query(served_rows[2]['content'], index)
+    single = capsys.readouterr().out
+    assert single.count('Top matches') == 1
+    assert [line for line in single.splitlines() if line.startswith('- ')][0].startswith('- Guideline 2 ')
+
+    query([served_rows[1]['content'], served_rows[4]['content']])
+    several = capsys.readouterr().out
+    assert several.count('Top matches for: ') == 2
+
+
+@pytest.mark.parametrize('argv, expected', [
+    (['how', 'do', 'I', 'titrate?'], ['how do I titrate?']),
+    (['how do I titrate?'], ['how do I titrate?']),
+    (['first', 'question', '-q', 'second one', '-q', 'third'], ['first question', 'second one', 'third']),
+    (['-q', 'only flagged'], ['only flagged']),
+])
+def test_query_command_line(monkeypatch, argv, expected):
+    seen = []
+    monkeypatch.setattr(pipeline, 'query', seen.append)
+    monkeypatch.setattr(sys, 'argv', ['pipeline.py', 'query', *argv])
+    pipeline.main()
+    assert seen == [expected]
+
+
+def test_get_model_loads_each_name_once(monkeypatch):
+    loads = []
+
+    class SentenceTransformer:
+        def __init__(self, name):
+            time.sleep(0.01)
+            loads.append(name)
+
+    module = types.ModuleType('sentence_transformers')
+    module.SentenceTransformer = SentenceTransformer
+    monkeypatch.setitem(sys.modules, 'sentence_transformers', module)
+    monkeypatch.setattr(pipeline, '_MODELS', {})
+
+    threads = [threading.Thread(target=get_model) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert get_model() is get_model(pipeline.EMBEDDING_MODEL)
+    assert get_model('other-model') is not get_model()
+    assert loads == [pipeline.EMBEDDING_MODEL, 'other-model']
+
+
+def test_serve_answers_one_json_line_per_prompt(served_rows, monkeypatch, capsys):
+    prompts = [served_rows[2]['content'], served_rows[4]['content']]
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(f'{prompts[0]}\n\n  \n{prompts[1]}\n'))
+    serve(top_k=2)
+    answers = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [answer['prompt'] for answer in answers] == prompts
+    assert [answer['matches'][0]['id'] for answer in answers] == ['G-002', 'G-004']
+    assert all(len(answer['matches']) == 2 for answer in answers)
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='needs Unix sockets')
+def test_ask_round_trips_over_a_unix_socket(served_rows, tmp_path, monkeypatch):
+    servers = []
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            servers.append(self)
+
+    monkeypatch.setattr(socketserver, 'ThreadingUnixStreamServer', Server)
+    socket_path = str(tmp_path / 'rag.sock')
+    thread = threading.Thread(target=serve, args=(socket_path,))
+    thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not servers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        results = ask([served_rows[1]['content'], served_rows[5]['content']], socket_path)
+    finally:
+        if servers:
+            servers[0].shutdown()
+        thread.join()
+    assert [matches[0]['id'] for matches in results] == ['G-001', 'G-005']
+    assert results[0][0] == dict(served_rows[1], score=pytest.approx(1.0))
+    assert len(results[0]) == 3
+    assert not os.path.exists(socket_path)
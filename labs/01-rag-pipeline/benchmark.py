@@ -0,0 +1,212 @@
+"""
+Throughput and quality benchmark for the lab Retriever.
+
+Builds a synthetic corpus, indexes it with every backend, saves the index,
+and serves it memory-mapped the way ``load_index`` does. It reports build
+time, resident index memory, single-query latency (p50/p95/p99) and QPS,
+batched QPS, and recall@k against exact search, as JSON so runs can be
+diffed between releases:
+
+    python benchmark.py --n 20000 --dim 64 --duplicate-rate 0.1 --output bench.json
+"""
+import json
+import platform
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import numpy as np
+
+from ann import HNSW, IVFFlat, exact_search
+from quantization import ProductQuantized, ScalarQuantized
+from rag_pipeline import Document, Retriever
+
+
+def synthetic_corpus(n: int, dim: int, duplicate_rate: float = 0.0, n_clusters: int = 64,
+                     vocabulary: int = 5000, words: int = 40, seed: int = 0) -> list[Document]:
+    """Clustered embeddings with topic-correlated text.
+
+    A ``duplicate_rate`` fraction of the documents repeat an earlier
+    document's text, with its embedding perturbed by a tiny amount, the
+    way re-published support articles do.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    labels = rng.integers(n_clusters, size=n)
+    data = centers[labels] + 0.35 * rng.normal(size=(n, dim))
+    # Each cluster draws its words from its own slice of the vocabulary.
+    word_ids = (labels[:, None] * 97 + rng.integers(0, 200, size=(n, words))) % vocabulary
+    source = np.arange(n)
+    n_duplicates = int(round(n * duplicate_rate)) if n > 1 else 0
+    if n_duplicates:
+        duplicates = np.sort(rng.choice(np.arange(1, n), size=n_duplicates, replace=False))
+        # Rows are visited in order, so a copy of a copy resolves to the original.
+        for row, original in zip(duplicates.tolist(), rng.integers(0, duplicates).tolist()):
+            source[row] = source[original]
+        data[duplicates] = data[source[duplicates]] + 1e-3 * rng.normal(size=(n_duplicates, dim))
+        labels[duplicates] = labels[source[duplicates]]
+    texts = [" ".join(f"w{w}" for w in row) for row in word_ids.tolist()]
+    return [
+        Document(content=texts[source[i]], metadata={"id": str(i), "cluster": int(labels[i])},
+                 embedding=data[i].astype(np.float32).tolist())
+        for i in range(n)
+    ]
+
+
+def synthetic_queries(matrix: np.ndarray, n_queries: int, noise: float = 0.05,
+                      seed: int = 0) -> np.ndarray:
+    """Unit-length queries near random corpus rows."""
+    rng = np.random.default_rng(seed + 1)
+    rows = rng.choice(matrix.shape[0], size=min(n_queries, matrix.shape[0]), replace=False)
+    queries = matrix[rows] + noise * rng.normal(size=(rows.shape[0], matrix.shape[1]))
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+
+def default_backends() -> dict[str, Optional[object]]:
+    """Every Retriever backend, forced on regardless of segment size."""
+    return {
+        "exact": None,
+        "hnsw": HNSW(min_rows=0),
+        "ivf_flat": IVFFlat(min_rows=0),
+        "scalar_int8": ScalarQuantized(min_rows=0),
+        "product_quantized": ProductQuantized(min_rows=0),
+    }
+
+
+def index_memory(retriever: Retriever) -> dict[str, int]:
+    """Bytes held by the index arrays, per component.
+
+    ``total`` is what a warmed index keeps resident. A memory-mapped float
+    matrix behind compressed codes is only read to re-rank, so it is
+    reported as ``matrix_on_disk`` and left out of the total.
+    """
+    memory = {"matrix": 0, "ann": 0, "keyword": 0, "columns": 0}
+    on_disk = 0
+    for segment in retriever._snapshot.segments:
+        if isinstance(segment.matrix, np.memmap) and getattr(segment.ann_index, "matrix_on_disk", False):
+            on_disk += segment.matrix.nbytes
+        else:
+            memory["matrix"] += segment.matrix.nbytes
+        if segment.ann_index is not None:
+            memory["ann"] += segment.ann_index.nbytes
+        keywords = segment.keyword_index
+        memory["keyword"] += sum(a.nbytes for a in (keywords.offsets, keywords.doc_ids,
+                                                    keywords.term_freqs, keywords.doc_lengths))
+        store = segment.documents
+        memory["columns"] += store.part_of.nbytes + store.part_row.nbytes + store.row_of.nbytes
+        for part in store.parts:
+            memory["columns"] += part.spans.nbytes + part.metadata_ids.nbytes
+    memory["total"] = sum(memory.values())
+    memory["matrix_on_disk"] = on_disk
+    return memory
+
+
+def latency_summary(latencies_ms: list[float]) -> dict[str, float]:
+    latencies = np.asarray(latencies_ms, dtype=np.float64)
+    if latencies.size == 0:
+        return {"qps": 0.0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "qps": 1000 * latencies.size / latencies.sum() if latencies.sum() > 0 else float("inf"),
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+    }
+
+
+@dataclass
+class BackendReport:
+    backend: str
+    build_seconds: float
+    memory_bytes: dict
+    single_query: dict
+    batched_qps: float
+    recall_at_k: float
+
+
+def benchmark_backend(name: str, ann, documents: list[Document], queries: np.ndarray,
+                      truth: list[set], k: int, batch_size: int) -> BackendReport:
+    start = time.perf_counter()
+    built = Retriever(documents, ann=ann)
+    build_seconds = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as tmp:
+        built.save(tmp)
+        del built
+        retriever = Retriever.load(tmp, use_mmap=True, ann=ann)
+        retriever.warm()
+        return _measure(name, retriever, build_seconds, queries, truth, k, batch_size)
+
+
+def _measure(name: str, retriever: Retriever, build_seconds: float, queries: np.ndarray,
+             truth: list[set], k: int, batch_size: int) -> BackendReport:
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        results = retriever.search(query, top_k=k)
+        latencies.append(1000 * (time.perf_counter() - start))
+        hits += len(expected & {int(r.document.metadata["id"]) for r in results})
+
+    start = time.perf_counter()
+    for offset in range(0, queries.shape[0], batch_size):
+        retriever.search_batch(queries[offset:offset + batch_size], top_k=k)
+    batched_seconds = time.perf_counter() - start
+
+    return BackendReport(
+        backend=name,
+        build_seconds=build_seconds,
+        memory_bytes=index_memory(retriever),
+        single_query=latency_summary(latencies),
+        batched_qps=queries.shape[0] / batched_seconds if batched_seconds > 0 else float("inf"),
+        recall_at_k=hits / max(sum(len(t) for t in truth), 1),
+    )
+
+
+def run(n: int = 10000, dim: int = 64, duplicate_rate: float = 0.1, n_queries: int = 200,
+        k: int = 10, batch_size: int = 64, backends: Optional[dict] = None, seed: int = 0) -> dict:
+    """Benchmark every backend on one corpus; returns a JSON-serializable report."""
+    backends = default_backends() if backends is None else backends
+    documents = synthetic_corpus(n, dim, duplicate_rate, seed=seed)
+    matrix = np.asarray([doc.embedding for doc in documents], dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    queries = synthetic_queries(matrix, n_queries, seed=seed)
+    truth = [set(exact_search(matrix, query, k)[0].tolist()) for query in queries]
+
+    return {
+        "config": {"n": n, "dim": dim, "duplicate_rate": duplicate_rate, "queries": len(queries),
+                   "k": k, "batch_size": batch_size, "seed": seed},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "machine": platform.machine()},
+        "backends": [asdict(benchmark_backend(name, ann, documents, queries, truth, k, batch_size))
+                     for name, ann in backends.items()],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Retriever build/latency/recall benchmark (JSON)")
+    parser.add_argument("--n", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--backends", nargs="+", choices=sorted(default_backends()),
+                        help="subset of backends to run (default: all)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    selected = default_backends()
+    if args.backends:
+        selected = {name: selected[name] for name in args.backends}
+    report = run(args.n, args.dim, args.duplicate_rate, args.queries, args.k, args.batch_size,
+                 selected, args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,191 @@
+"""
+Query cache for RAGPipeline.
+
+Support traffic is full of near-duplicates ("reset password", "Reset
+password?"), so answers are cached in two tiers:
+
+- exact: an LRU keyed on normalized query text, holding the query
+  embedding and the top-k results, so a repeat skips both embedding and
+  retrieval;
+- semantic (optional): a new query embedding within ``semantic_threshold``
+  cosine similarity of a cached one reuses that entry's results.
+
+Entries expire after ``ttl_seconds`` and are dropped as soon as the index
+version they were computed against is no longer current.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, Optional
+
+import numpy as np
+
+_WORD_RE = re.compile(r"\w+(?:[-.]\w+)*")
+
+
+def normalize_query(text: str) -> str:
+    """Case-fold and keep only the words, so spacing and punctuation don't split keys."""
+    return " ".join(_WORD_RE.findall(text.casefold()))
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    semantic_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.semantic_hits + self.misses
+        return (self.hits + self.semantic_hits) / lookups if lookups else 0.0
+
+
+@dataclass(slots=True)
+class CacheEntry:
+    key: tuple
+    embedding: Optional[np.ndarray]
+    results: list
+    version: Hashable
+    expires: float
+    slot: int = -1
+
+
+class QueryCache:
+    """LRU query cache with TTL, index-version invalidation, and a semantic tier.
+
+    ``params`` passed to get/put (e.g. top_k and filters) are part of the
+    key: a cached result is only reused for the same retrieval parameters.
+    Set ``semantic_threshold`` (e.g. 0.95) to enable the semantic tier.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 1024,
+        ttl_seconds: Optional[float] = 300.0,
+        semantic_threshold: Optional[float] = None,
+        normalize: Callable[[str], str] = normalize_query,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.semantic_threshold = semantic_threshold
+        self.normalize = normalize
+        self.clock = clock
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, CacheEntry]" = OrderedDict()
+        # Semantic tier: one normalized embedding per slot, scanned with a
+        # single matrix-vector product per lookup.
+        self._matrix: Optional[np.ndarray] = None
+        self._slot_keys: list[Optional[tuple]] = [None] * capacity
+        self._free_slots = list(range(capacity - 1, -1, -1))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, query: str, version: Hashable, params: Hashable = (),
+            embedding=None) -> Optional[CacheEntry]:
+        """Return a live entry for the query, or None (counted as a miss)."""
+        key = (self.normalize(query), params)
+        with self._lock:
+            entry = self._live(self._entries.get(key), version)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return entry
+            if embedding is not None and self.semantic_threshold is not None:
+                entry = self._nearest(_unit(embedding), params, version)
+                if entry is not None:
+                    self._entries.move_to_end(entry.key)
+                    self.stats.semantic_hits += 1
+                    return entry
+            self.stats.misses += 1
+            return None
+
+    def embedding(self, query: str, version: Hashable, params: Hashable = ()) -> Optional[np.ndarray]:
+        """The cached embedding of this exact query, if any, without counting a lookup."""
+        with self._lock:
+            entry = self._live(self._entries.get((self.normalize(query), params)), version)
+            return None if entry is None else entry.embedding
+
+    def put(self, query: str, version: Hashable, results: list, params: Hashable = (),
+            embedding=None) -> None:
+        key = (self.normalize(query), params)
+        vector = None if embedding is None else _unit(embedding)
+        expires = float("inf") if self.ttl_seconds is None else self.clock() + self.ttl_seconds
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            while len(self._entries) >= self.capacity:
+                self._drop(next(iter(self._entries)))
+                self.stats.evictions += 1
+            entry = CacheEntry(key, vector, list(results), version, expires)
+            if vector is not None and self.semantic_threshold is not None:
+                if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                    self._reset_semantic(vector.shape[0])
+                entry.slot = self._free_slots.pop()
+                self._matrix[entry.slot] = vector
+                self._slot_keys[entry.slot] = key
+            self._entries[key] = entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self._slot_keys = [None] * self.capacity
+            self._free_slots = list(range(self.capacity - 1, -1, -1))
+
+    def _live(self, entry: Optional[CacheEntry], version: Hashable) -> Optional[CacheEntry]:
+        if entry is None:
+            return None
+        if entry.version != version:
+            self._drop(entry.key)
+            self.stats.invalidations += 1
+            return None
+        if entry.expires <= self.clock():
+            self._drop(entry.key)
+            self.stats.expirations += 1
+            return None
+        return entry
+
+    def _nearest(self, vector: np.ndarray, params: Hashable,
+                 version: Hashable) -> Optional[CacheEntry]:
+        if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+            return None
+        scores = self._matrix @ vector
+        candidates = np.flatnonzero(scores >= self.semantic_threshold)
+        for slot in candidates[np.argsort(-scores[candidates], kind="stable")].tolist():
+            key = self._slot_keys[slot]
+            if key is not None and key[1] == params:
+                entry = self._live(self._entries[key], version)
+                if entry is not None:
+                    return entry
+        return None
+
+    def _drop(self, key: tuple) -> None:
+        entry = self._entries.pop(key)
+        if entry.slot >= 0:
+            self._matrix[entry.slot] = 0.0
+            self._slot_keys[entry.slot] = None
+            self._free_slots.append(entry.slot)
+
+    def _reset_semantic(self, dim: int) -> None:
+        # A new embedding dimension means a new model: older vectors can't be compared.
+        for entry in self._entries.values():
+            entry.slot = -1
+        self._matrix = np.zeros((self.capacity, dim), dtype=np.float32)
+        self._slot_keys = [None] * self.capacity
+        self._free_slots = list(range(self.capacity - 1, -1, -1))
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
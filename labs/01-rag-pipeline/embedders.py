@@ -0,0 +1,227 @@
+"""
+Embedding backends for RAGPipeline.
+
+Anything with ``embed(texts) -> (len(texts), dim) float32 matrix`` is an
+Embedder. The wrappers here compose around any of them:
+
+- ``HashingEmbedder``: deterministic feature hashing of words and word
+  bigrams; no model download, stable across processes, for offline tests.
+- ``MicroBatcher``: coalesces concurrent ``embed`` calls from many threads
+  into one backend call of up to ``max_batch_size`` texts, waiting at most
+  ``max_wait_ms`` for a batch to fill.
+- ``CachedEmbedder``: remembers vectors by a hash of the text, so a
+  rebuild only embeds chunks that changed; the cache can be saved and
+  reloaded between processes.
+"""
+import hashlib
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Protocol, Sequence
+
+import numpy as np
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+
+
+class Embedder(Protocol):
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Return one embedding row per text."""
+
+
+@lru_cache(maxsize=1 << 16)
+def _feature_hash(feature: str) -> int:
+    # blake2b rather than hash(): str hashes are salted per process.
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class HashingEmbedder:
+    """Signed feature hashing of words and adjacent word pairs, L2-normalized."""
+
+    def __init__(self, dim: int = 256, bigrams: bool = True):
+        self.dim = dim
+        self.bigrams = bigrams
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = _WORD_RE.findall(text.lower())
+            features = words
+            if self.bigrams:
+                features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            if not features:
+                continue
+            hashes = np.fromiter((_feature_hash(f) for f in features), dtype=np.uint64,
+                                 count=len(features))
+            signs = np.where(hashes >> np.uint64(63), -1.0, 1.0)
+            out[i] = np.bincount((hashes % np.uint64(self.dim)).astype(np.int64), weights=signs,
+                                 minlength=self.dim)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        np.divide(out, norms, out=out, where=norms > 0)
+        return out
+
+
+@dataclass
+class BatchStats:
+    requests: int = 0
+    texts: int = 0
+    batches: int = 0
+
+
+class _Request:
+    __slots__ = ("texts", "future")
+
+    def __init__(self, texts: list[str]):
+        self.texts = texts
+        self.future: Future = Future()
+
+
+class MicroBatcher:
+    """Gather concurrent embed requests into batched backend calls.
+
+    A background thread takes the first waiting request, then keeps
+    collecting until ``max_batch_size`` texts are queued or ``max_wait_ms``
+    has passed, and embeds them in one call (split into
+    ``max_batch_size`` slices if a single request is larger). Each caller
+    blocks only until its own rows are ready.
+    """
+
+    def __init__(self, embedder: Embedder, max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.stats = BatchStats()
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        request = _Request(list(texts))
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        self._queue.put(request)
+        return request.future.result()
+
+    def close(self) -> None:
+        """Finish queued requests and stop the batching thread."""
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is not None:
+            self._queue.put(None)
+            worker.join()
+
+    def __enter__(self) -> "MicroBatcher":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, size, stop = [first], len(first.texts), False
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            self._flush(batch)
+            if stop:
+                return
+
+    def _flush(self, batch: list[_Request]) -> None:
+        texts = [text for request in batch for text in request.texts]
+        try:
+            vectors = np.concatenate([
+                np.asarray(self.embedder.embed(texts[i:i + self.max_batch_size]), dtype=np.float32)
+                for i in range(0, len(texts), self.max_batch_size)
+            ]) if texts else np.empty((0, 0), dtype=np.float32)
+        except Exception as exc:
+            for request in batch:
+                request.future.set_exception(exc)
+            return
+        self.stats.requests += len(batch)
+        self.stats.texts += len(texts)
+        self.stats.batches += -(-len(texts) // self.max_batch_size)
+        offset = 0
+        for request in batch:
+            request.future.set_result(vectors[offset:offset + len(request.texts)])
+            offset += len(request.texts)
+
+
+def content_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class CachedEmbedder:
+    """Skip embedding texts whose content hash has been embedded before.
+
+    Duplicate texts within one call are embedded once. ``save``/``load``
+    keep the cache across processes, so a rebuild of a mostly unchanged
+    corpus embeds only the new or edited chunks. Copies sent to worker
+    processes start from the cache as it was when they were pickled.
+    """
+
+    def __init__(self, embedder: Embedder):
+        self.embedder = embedder
+        self.hits = 0
+        self.misses = 0
+        self._vectors: dict[bytes, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        keys = [content_hash(text) for text in texts]
+        with self._lock:
+            missing = {key: text for key, text in zip(keys, texts) if key not in self._vectors}
+        if missing:
+            vectors = np.asarray(self.embedder.embed(list(missing.values())), dtype=np.float32)
+            with self._lock:
+                self._vectors.update(zip(missing, vectors))
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(keys) - len(missing)
+            if not keys:
+                return np.empty((0, 0), dtype=np.float32)
+            return np.stack([self._vectors[key] for key in keys])
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            keys = np.frombuffer(b"".join(self._vectors), dtype=np.uint8).reshape(-1, 16)
+            vectors = np.stack(list(self._vectors.values())) if self._vectors else np.empty((0, 0))
+        np.savez(path, keys=keys, vectors=vectors.astype(np.float32))
+
+    @classmethod
+    def load(cls, path: str, embedder: Embedder) -> "CachedEmbedder":
+        cached = cls(embedder)
+        with np.load(path) as data:
+            cached._vectors = dict(zip((key.tobytes() for key in data["keys"]), data["vectors"]))
+        return cached
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
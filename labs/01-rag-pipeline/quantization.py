@@ -0,0 +1,232 @@
+"""
+Compressed embedding storage for the lab Retriever.
+
+Both backends plug into ``Retriever(ann=...)`` and ``RAGPipeline(ann=...)``
+like the ANN indexes in ``ann.py``. Candidates are scored against compact
+codes with asymmetric distance computation (the query stays float32, only
+the corpus is quantized), then the best ``rerank · top_k`` are re-scored
+exactly against the float32 matrix. The codes are saved with the index.
+A loaded index keeps its float32 matrix memory-mapped and Retriever.warm()
+leaves it out, so only the re-ranked rows are ever paged in and resident
+memory is the codes:
+
+- ``ScalarQuantized``: one uint8 per dimension (4x smaller than float32).
+- ``ProductQuantized``: one uint8 per subspace, e.g. 48 bytes for a
+  384-dim vector (32x smaller than float32).
+"""
+from dataclasses import dataclass
+from typing import ClassVar, Optional
+
+import numpy as np
+
+from ann import _EMPTY_ROWS, _EMPTY_SCORES, exact_search
+
+
+def _rerank(matrix: np.ndarray, query: np.ndarray, scores: np.ndarray, top_k: int,
+            rerank: int) -> tuple[np.ndarray, np.ndarray]:
+    """Take the best approximate candidates and re-score them exactly."""
+    depth = top_k * rerank if rerank else top_k
+    rows, approx = exact_search_scores(scores, depth)
+    if not rerank:
+        return rows[:top_k], approx[:top_k].astype(np.float32)
+    found, exact = exact_search(np.asarray(matrix[rows], dtype=np.float32), query, top_k)
+    return rows[found], exact
+
+
+def exact_search_scores(scores: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Top-k of an already computed score vector, skipping -inf entries."""
+    k = min(top_k, scores.shape[0])
+    if k <= 0:
+        return _EMPTY_ROWS, _EMPTY_SCORES
+    rows = np.argpartition(-scores, k - 1)[:k]
+    rows = rows[np.argsort(-scores[rows], kind="stable")]
+    rows = rows[np.isfinite(scores[rows])]
+    return rows, scores[rows]
+
+
+# -- Scalar quantization ----------------------------------------------------
+
+@dataclass
+class ScalarQuantized:
+    """Config for per-dimension int8 scalar quantization.
+
+    Each dimension is mapped linearly from its [min, max] range onto
+    0..255. ``rerank`` is the candidate multiplier for the exact float32
+    re-rank (0 returns approximate scores). Segments smaller than
+    ``min_rows`` are scanned exactly.
+    """
+    rerank: int = 4
+    block: int = 4096
+    min_rows: int = 1024
+    search_knobs: ClassVar[tuple[str, ...]] = ("rerank", "block", "min_rows")
+
+    def build(self, matrix: np.ndarray) -> "ScalarQuantizedIndex":
+        return ScalarQuantizedIndex(self, matrix)
+
+    def restore(self, matrix: np.ndarray, arrays: dict[str, np.ndarray]) -> "ScalarQuantizedIndex":
+        index = ScalarQuantizedIndex.__new__(ScalarQuantizedIndex)
+        index.config, index.matrix = self, matrix
+        index.codes, index.offset, index.scale = arrays["codes"], arrays["offset"], arrays["scale"]
+        return index
+
+
+class ScalarQuantizedIndex:
+    # The float rows are read only to re-rank candidates; see Retriever.warm().
+    matrix_on_disk = True
+
+    def __init__(self, config: ScalarQuantized, matrix: np.ndarray):
+        self.config = config
+        self.matrix = matrix
+        self.offset = np.asarray(matrix.min(axis=0), dtype=np.float32)
+        spread = np.asarray(matrix.max(axis=0), dtype=np.float32) - self.offset
+        self.scale = np.where(spread > 0, spread / 255, 1).astype(np.float32)
+        self.codes = np.empty(matrix.shape, dtype=np.uint8)
+        for start in range(0, matrix.shape[0], config.block):
+            block = (matrix[start:start + config.block] - self.offset) / self.scale
+            self.codes[start:start + config.block] = np.clip(np.rint(block), 0, 255)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.offset.nbytes + self.scale.nbytes
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        return {"codes": self.codes, "offset": self.offset, "scale": self.scale}
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        return self.codes[rows] * self.scale + self.offset
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        # q·x ≈ q·offset + (q * scale)·code, computed block-wise so the
+        # float copy of the codes never exceeds one block.
+        weights = query * self.scale
+        bias = float(query @ self.offset)
+        scores = np.empty(self.codes.shape[0], dtype=np.float32)
+        for start in range(0, self.codes.shape[0], self.config.block):
+            block = self.codes[start:start + self.config.block].astype(np.float32)
+            scores[start:start + block.shape[0]] = block @ weights + bias
+        return scores
+
+    def search(self, query: np.ndarray, top_k: int, dead_rows: np.ndarray = _EMPTY_ROWS,
+               allowed: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        if top_k <= 0 or self.codes.shape[0] == 0:
+            return _EMPTY_ROWS, _EMPTY_SCORES
+        scores = self.approximate_scores(query)
+        scores[dead_rows] = -np.inf
+        if allowed is not None:
+            scores[~allowed] = -np.inf
+        return _rerank(self.matrix, query, scores, top_k, self.config.rerank)
+
+
+# -- Product quantization ---------------------------------------------------
+
+def _kmeans_l2(data: np.ndarray, k: int, n_iter: int, rng: np.random.Generator) -> np.ndarray:
+    """Euclidean k-means; sub-vectors are not unit length, unlike IVF."""
+    centroids = data[rng.choice(data.shape[0], size=k, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest_l2(data, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.stack([np.bincount(assign, weights=data[:, d], minlength=k)
+                         for d in range(data.shape[1])], axis=1)
+        empty = counts == 0
+        sums[empty] = data[rng.choice(data.shape[0], size=int(empty.sum()))]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+    return centroids.astype(np.float32)
+
+
+def _nearest_l2(data: np.ndarray, centroids: np.ndarray, block: int = 16384) -> np.ndarray:
+    # argmin ||x - c||² == argmax (x·c - ||c||²/2)
+    half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    return np.concatenate([
+        np.argmax(data[start:start + block] @ centroids.T - half_norms, axis=1)
+        for start in range(0, data.shape[0], block)
+    ] or [_EMPTY_ROWS])
+
+
+@dataclass
+class ProductQuantized:
+    """Config for product quantization with 256 centroids per subspace.
+
+    The vector is split into ``m`` equal sub-vectors (default: subspaces of
+    about 8 dimensions), each encoded as one byte. ``rerank`` is the
+    candidate multiplier for the exact float32 re-rank (0 returns
+    approximate scores). Codebooks are trained on at most ``sample_size``
+    rows. Segments smaller than ``min_rows`` are scanned exactly.
+    """
+    m: Optional[int] = None
+    rerank: int = 8
+    n_iter: int = 10
+    sample_size: int = 16384
+    min_rows: int = 1024
+    seed: int = 0
+    search_knobs: ClassVar[tuple[str, ...]] = ("rerank", "min_rows")
+
+    def build(self, matrix: np.ndarray) -> "ProductQuantizedIndex":
+        return ProductQuantizedIndex(self, matrix)
+
+    def restore(self, matrix: np.ndarray, arrays: dict[str, np.ndarray]) -> "ProductQuantizedIndex":
+        index = ProductQuantizedIndex.__new__(ProductQuantizedIndex)
+        index.config, index.matrix = self, matrix
+        index.codes, index.codebooks = arrays["codes"], arrays["codebooks"]
+        index.m, _, index.sub_dim = index.codebooks.shape
+        return index
+
+
+class ProductQuantizedIndex:
+    # The float rows are read only to re-rank candidates; see Retriever.warm().
+    matrix_on_disk = True
+
+    def __init__(self, config: ProductQuantized, matrix: np.ndarray):
+        self.config = config
+        self.matrix = matrix
+        n, dim = matrix.shape
+        m = config.m or max(d for d in range(1, max(1, dim // 8) + 1) if dim % d == 0)
+        if dim % m:
+            raise ValueError(f"dimension {dim} is not divisible into m={m} subspaces")
+        self.m = m
+        self.sub_dim = dim // m
+        rng = np.random.default_rng(config.seed)
+        sample = matrix
+        if n > config.sample_size:
+            sample = matrix[np.sort(rng.choice(n, size=config.sample_size, replace=False))]
+        sample = np.asarray(sample, dtype=np.float32)
+        n_centroids = min(256, sample.shape[0])
+        self.codebooks = np.stack([
+            _kmeans_l2(sample[:, j * self.sub_dim:(j + 1) * self.sub_dim],
+                       n_centroids, config.n_iter, rng)
+            for j in range(m)
+        ])
+        # Subspace-major (m, n) so each ADC gather reads one contiguous row.
+        self.codes = np.empty((m, n), dtype=np.uint8)
+        for j in range(m):
+            sub = np.asarray(matrix[:, j * self.sub_dim:(j + 1) * self.sub_dim], dtype=np.float32)
+            self.codes[j] = _nearest_l2(sub, self.codebooks[j])
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        return {"codes": self.codes, "codebooks": self.codebooks}
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        return np.concatenate([self.codebooks[j][self.codes[j, rows]] for j in range(self.m)], axis=1)
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        # Asymmetric distance computation: one (m, 256) table of sub-query ·
+        # centroid products, then m gathers per row instead of d multiplies.
+        table = np.einsum("jkd,jd->jk", self.codebooks, query.reshape(self.m, self.sub_dim))
+        scores = np.zeros(self.codes.shape[1], dtype=np.float32)
+        for j in range(self.m):
+            scores += np.take(table[j], self.codes[j])
+        return scores
+
+    def search(self, query: np.ndarray, top_k: int, dead_rows: np.ndarray = _EMPTY_ROWS,
+               allowed: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        if top_k <= 0 or self.codes.shape[1] == 0:
+            return _EMPTY_ROWS, _EMPTY_SCORES
+        scores = self.approximate_scores(query)
+        scores[dead_rows] = -np.inf
+        if allowed is not None:
+            scores[~allowed] = -np.inf
+        return _rerank(self.matrix, query, scores, top_k, self.config.rerank)
@@ -8,105 +8,2243 @@ after deploying this pipeline. Support tickets say answers are "irrelevant",
 Your job: Diagnose why retrieval quality tanked and fix it.
 Run the tests in tests/ — they represent the quality bar we need to hit.
 """
+import codecs
+import hashlib
 import json
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from collections.abc import Sequence
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Optional
+from functools import cached_property, partial
+from typing import Callable, Iterable, Iterator, Optional
 
+import numpy as np
 
-@dataclass
+from ann import ANNBackend, FittedIndex, build_params
+from cache import QueryCache
+from embedders import Embedder
+from rerank import Reranker
+
+
+@dataclass(slots=True)
 class Document:
     content: str
     metadata: dict
     embedding: Optional[list[float]] = None
 
 
-@dataclass
+@dataclass(slots=True)
+class Chunk:
+    """A [start, end) character span of a source document.
+
+    The text is sliced from the source on access, so a chunk costs three
+    references instead of a copy of its content. Until chunks are embedded
+    on their own they share the source document's embedding.
+    """
+    source: Document
+    start: int
+    end: int
+    embedding: Optional[list[float]] = None
+
+    def __post_init__(self):
+        if self.embedding is None:
+            self.embedding = self.source.embedding
+
+    @property
+    def content(self) -> str:
+        return self.source.content[self.start:self.end]
+
+    @property
+    def metadata(self) -> dict:
+        return self.source.metadata
+
+    @property
+    def span(self) -> tuple[Optional[str], int, int]:
+        """(doc_id, start, end) of this chunk within its source document."""
+        return self.source.metadata.get("id"), self.start, self.end
+
+    @property
+    def source_key(self) -> int:
+        return id(self.source)
+
+
+@dataclass(slots=True)
+class ParentSpan:
+    """A window of a parent document around its best-matching sub-chunk.
+
+    ``start``/``end`` bound the window and ``hit`` the sub-chunk that
+    scored, both as character offsets into the parent document.
+    """
+    content: str
+    metadata: dict
+    start: int
+    end: int
+    hit: tuple[int, int]
+    source_key: object = None
+    embedding: Optional[np.ndarray] = None
+
+    @property
+    def span(self) -> tuple[Optional[str], int, int]:
+        return self.metadata.get("id"), self.start, self.end
+
+
 class SearchResult:
-    document: Document
-    score: float
+    """A scored document.
+
+    Results returned by a Retriever hold only their store, row, and score;
+    the DocumentView is created the first time ``document`` is read.
+    """
+    __slots__ = ("_document", "_store", "_row", "score")
+
+    def __init__(self, document=None, score: float = 0.0):
+        self._document = document
+        self._store = None
+        self._row = -1
+        self.score = score
+
+    @classmethod
+    def from_row(cls, store: "DocumentStore", row: int, score: float) -> "SearchResult":
+        result = cls.__new__(cls)
+        result._document = None
+        result._store = store
+        result._row = row
+        result.score = score
+        return result
+
+    @property
+    def document(self):
+        if self._document is None and self._store is not None:
+            self._document = self._store[self._row]
+        return self._document
+
+    def rescored(self, score: float) -> "SearchResult":
+        """The same (still lazy) result under a new score, e.g. from a re-ranker."""
+        result = SearchResult.__new__(SearchResult)
+        result._document = self._document
+        result._store = self._store
+        result._row = self._row
+        result.score = score
+        return result
+
+    def __eq__(self, other):
+        if not isinstance(other, SearchResult):
+            return NotImplemented
+        return (self.document, self.score) == (other.document, other.score)
+
+    def __repr__(self) -> str:
+        return f"SearchResult(document={self.document!r}, score={self.score!r})"
+
+
+# Identifiers such as "E-4012" or "v2.1" stay one token instead of splitting
+# on the punctuation, so exact error codes remain searchable.
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+
+
+# Rough English average; keeps chunk sizing token-aware without a tokenizer.
+CHARS_PER_TOKEN = 4
+
+_PARAGRAPH_BREAK = "\n\n"
+_SENTENCE_END_RE = re.compile(r"[.!?][\"')\]]*(?=\s)")
+_WHITESPACE_RE = re.compile(r"\s")
+
+
+def _snap_end(text: str, start: int, limit: int) -> int:
+    """Pick a split point in the back half of text[start:limit].
+
+    Prefers a paragraph break, then a sentence end, then whitespace, and
+    only cuts mid-word when the window has no boundary at all.
+    """
+    floor = start + (limit - start) // 2
+    paragraph = text.rfind(_PARAGRAPH_BREAK, floor, limit)
+    if paragraph != -1:
+        return paragraph
+    sentence_end = -1
+    for match in _SENTENCE_END_RE.finditer(text, floor, limit):
+        sentence_end = match.end()
+    if sentence_end != -1:
+        return sentence_end
+    for pos in range(limit, floor, -1):
+        if text[pos].isspace():
+            return pos
+    return limit
+
+
+def split_spans(
+    text: str,
+    chunk_size: int = 256,
+    overlap: int = 32,
+    chars_per_token: int = CHARS_PER_TOKEN,
+) -> Iterator[tuple[int, int]]:
+    """Yield (start, end) spans covering text, in approximate tokens.
+
+    Consecutive spans share roughly ``overlap`` tokens; splits snap to
+    paragraph, sentence, or word boundaries where one is available.
+    """
+    if chunk_size <= 0 or not 0 <= overlap < chunk_size:
+        raise ValueError("require chunk_size > 0 and 0 <= overlap < chunk_size")
+    max_chars = chunk_size * chars_per_token
+    overlap_chars = overlap * chars_per_token
+    length = len(text)
+    start = 0
+    while True:
+        limit = start + max_chars
+        if limit >= length:
+            yield start, length
+            return
+        end = _snap_end(text, start, limit)
+        yield start, end
+
+        next_start = max(end - overlap_chars, start + 1)
+        if overlap_chars and next_start > start + 1 and not text[next_start - 1].isspace():
+            # Begin the overlap on a word boundary rather than mid-word.
+            match = _WHITESPACE_RE.search(text, next_start, end)
+            if match:
+                next_start = match.end()
+        while next_start < length and text[next_start].isspace():
+            next_start += 1
+        start = next_start
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase word tokenizer used by the keyword index."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k scores, best first, without a full sort."""
+    if top_k >= scores.shape[0]:
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+@dataclass
+class BM25Stats:
+    """Collection statistics shared by the keyword indexes of every segment."""
+    n_docs: int
+    avg_length: float
+    doc_freqs: dict[str, int]
+
+
+class KeywordIndex:
+    """BM25 inverted index with postings stored as flat CSR arrays.
+
+    Postings for term ``t`` live in ``doc_ids[offsets[t]:offsets[t + 1]]``
+    with matching term frequencies in ``term_freqs``. Document lengths are
+    precomputed, so a query only touches the postings of its own terms.
+    """
+
+    def __init__(self, texts: Iterable[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        postings: dict[str, list[tuple[int, int]]] = {}
+        lengths = []
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, freq in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, freq))
+
+        counts = np.fromiter((len(p) for p in postings.values()), dtype=np.int64,
+                             count=len(postings))
+        offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        flat = [pair for plist in postings.values() for pair in plist]
+        pairs = np.array(flat, dtype=np.int32).reshape(-1, 2)
+        self._set_arrays(list(postings), offsets, np.ascontiguousarray(pairs[:, 0]),
+                         pairs[:, 1].astype(np.float32), np.asarray(lengths, dtype=np.int32))
+
+    @classmethod
+    def from_arrays(cls, terms: list[str], offsets: np.ndarray, doc_ids: np.ndarray,
+                    term_freqs: np.ndarray, doc_lengths: np.ndarray,
+                    k1: float = 1.5, b: float = 0.75) -> "KeywordIndex":
+        """Rebuild an index from its CSR arrays (e.g. memory-mapped from disk)."""
+        index = cls.__new__(cls)
+        index.k1 = k1
+        index.b = b
+        index._set_arrays(terms, offsets, doc_ids, term_freqs, doc_lengths)
+        return index
+
+    @classmethod
+    def merge(cls, indexes: list["KeywordIndex"], doc_maps: list[np.ndarray]) -> "KeywordIndex":
+        """Merge indexes into one without re-tokenizing any text.
+
+        ``doc_maps[i]`` gives the merged doc id of each doc in
+        ``indexes[i]``, or -1 to drop it (e.g. a tombstoned doc).
+        """
+        vocabulary: dict[str, int] = {}
+        term_parts, doc_parts, tf_parts = [], [], []
+        n_docs = 1 + max((int(m.max()) for m in doc_maps if m.size), default=-1)
+        lengths = np.zeros(n_docs, dtype=np.int32)
+        for index, doc_map in zip(indexes, doc_maps):
+            live = doc_map >= 0
+            lengths[doc_map[live]] = index.doc_lengths[live]
+            local_to_merged = np.fromiter(
+                (vocabulary.setdefault(term, len(vocabulary)) for term in index.vocabulary),
+                dtype=np.int64, count=len(index.vocabulary))
+            docs = doc_map[index.doc_ids]
+            keep = docs >= 0
+            term_parts.append(np.repeat(local_to_merged, np.diff(index.offsets))[keep])
+            doc_parts.append(docs[keep])
+            tf_parts.append(np.asarray(index.term_freqs)[keep])
+
+        terms = np.concatenate(term_parts) if term_parts else np.empty(0, dtype=np.int64)
+        docs = np.concatenate(doc_parts) if doc_parts else np.empty(0, dtype=np.int64)
+        tfs = np.concatenate(tf_parts) if tf_parts else np.empty(0, dtype=np.float32)
+        order = np.lexsort((docs, terms))
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocabulary)), out=offsets[1:])
+        k1, b = (indexes[0].k1, indexes[0].b) if indexes else (1.5, 0.75)
+        # Terms whose postings were all dropped keep an empty slot; they
+        # simply never match.
+        return cls.from_arrays(list(vocabulary), offsets, docs[order].astype(np.int32),
+                               tfs[order].astype(np.float32), lengths, k1=k1, b=b)
+
+    def _set_arrays(self, terms, offsets, doc_ids, term_freqs, doc_lengths) -> None:
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.total_length = int(doc_lengths.sum())
+
+    def __len__(self) -> int:
+        return self.doc_lengths.shape[0]
+
+    def doc_freq(self, term: str) -> int:
+        term_id = self.vocabulary.get(term)
+        return 0 if term_id is None else int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def search(
+        self,
+        query: str,
+        top_k: int = 3,
+        exclude: Optional[np.ndarray] = None,
+        stats: Optional[BM25Stats] = None,
+        allowed: Optional[np.ndarray] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return (doc_ids, scores) of the best BM25 matches, best first.
+
+        ``exclude`` holds doc ids that must not be returned; ``allowed``
+        is a boolean mask over doc ids, applied before the top-k. ``stats``
+        replaces this index's own collection statistics when it is one
+        segment of a larger corpus, so scores stay comparable across
+        segments.
+        """
+        terms = {t for t in tokenize(query) if t in self.vocabulary}
+        if top_k <= 0 or not terms:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if stats is None:
+            n_docs = len(self)
+            avg_length = self.total_length / n_docs if n_docs else 0.0
+            stats = BM25Stats(n_docs, avg_length, {t: self.doc_freq(t) for t in terms})
+
+        touched, partial = [], []
+        for term in terms:
+            term_id = self.vocabulary[term]
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.term_freqs[start:end]
+            df = stats.doc_freqs[term]
+            idf = np.log1p((stats.n_docs - df + 0.5) / (df + 0.5))
+            if stats.avg_length > 0:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / stats.avg_length)
+            else:
+                norm = self.k1
+            touched.append(docs)
+            partial.append(idf * tf * (self.k1 + 1) / (tf + norm))
+
+        docs, inverse = np.unique(np.concatenate(touched), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(partial))
+        if exclude is not None and exclude.size:
+            keep = ~np.isin(docs, exclude)
+            docs, scores = docs[keep], scores[keep]
+        if allowed is not None:
+            keep = allowed[docs]
+            docs, scores = docs[keep], scores[keep]
+        order = _top_k(scores, top_k)
+        return docs[order].astype(np.int64), scores[order]
+
+
+@dataclass
+class LoadStats:
+    """Progress counters for a streaming document load."""
+    documents: int = 0
+    bytes_read: int = 0
+
+
+def _iter_jsonl(f, stats: LoadStats, max_record_bytes: int) -> Iterator[dict]:
+    while True:
+        line = f.readline(max_record_bytes + 1)
+        if not line:
+            return
+        stats.bytes_read += len(line)
+        if len(line) > max_record_bytes and not line.endswith(b"\n"):
+            raise ValueError(f"record exceeds max_record_bytes={max_record_bytes}")
+        if line.strip():
+            yield json.loads(line)
+
+
+def _skip_preamble(f, stats: LoadStats, read_size: int = 1 << 16) -> bytes:
+    """Move ``f`` past a UTF-8 BOM and leading whitespace.
+
+    Returns the first byte after them (``b""`` at EOF), which tells a JSON
+    array from JSONL however much whitespace precedes it.
+    """
+    if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+        f.seek(0)
+    while True:
+        chunk = f.read(read_size)
+        rest = chunk.lstrip(b" \t\r\n")
+        if rest or not chunk:
+            break
+    f.seek(-len(rest), os.SEEK_CUR)
+    stats.bytes_read += f.tell()
+    return rest[:1]
+
+
+# Characters that may continue a JSON number (fraction, exponent, sign).
+_NUMBER_TAIL_RE = re.compile(r"[0-9.eE+-]*")
+
+
+def _exceeds(text: str, limit: int) -> bool:
+    """Whether ``text`` is longer than ``limit`` bytes once encoded as UTF-8."""
+    if 4 * len(text) <= limit:
+        return False
+    return len(text) > limit or len(text.encode("utf-8")) > limit
+
+
+def _iter_json_array(f, stats: LoadStats, max_record_bytes: int,
+                     read_size: int = 1 << 16) -> Iterator[dict]:
+    """Decode the items of a top-level JSON array one at a time.
+
+    Only the unparsed tail of the file is buffered, so memory is bounded
+    by the largest single item rather than by the file size. Items must
+    be separated by exactly one comma, and only whitespace may follow the
+    closing bracket. A number is only taken once a character that cannot
+    continue it (or EOF) has been read, so a number split across reads is
+    not cut in two.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer, pos, eof = "", 0, False
+    # "open": before "[", "first": after it, "item": after a comma, "next":
+    # after an item, "done": after "]".
+    state = "open"
+
+    def fill() -> bool:
+        nonlocal buffer, pos
+        raw = f.read(read_size)
+        stats.bytes_read += len(raw)
+        buffer = buffer[pos:] + utf8.decode(raw, final=not raw)
+        pos = 0
+        return bool(raw)
+
+    def too_large() -> ValueError:
+        return ValueError(f"record exceeds max_record_bytes={max_record_bytes}")
+
+    while True:
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                if state == "done":
+                    return
+                raise ValueError("unexpected end of JSON array")
+            eof = not fill()
+            continue
+        char = buffer[pos]
+        if state == "done":
+            raise ValueError(f"unexpected data after the JSON array, found {char!r}")
+        if state == "open":
+            if char != "[":
+                raise ValueError("expected a JSON array of documents")
+            state, pos = "first", pos + 1
+            continue
+        if state == "next":
+            if char == "]":
+                state, pos = "done", pos + 1
+                continue
+            if char != ",":
+                raise ValueError(f"expected ',' or ']' between array items, found {char!r}")
+            state, pos = "item", pos + 1
+            continue
+        if char == "]" and state == "first":
+            state, pos = "done", pos + 1
+            continue
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            if _exceeds(buffer[pos:], max_record_bytes):
+                raise too_large() from None
+            eof = not fill()
+            continue
+        if (not eof and type(item) in (int, float)
+                and _NUMBER_TAIL_RE.match(buffer, end).end() == len(buffer)):
+            eof = not fill()
+            continue
+        if _exceeds(buffer[pos:end], max_record_bytes):
+            raise too_large()
+        state, pos = "next", end
+        yield item
 
 
 class KnowledgeBase:
     def __init__(self):
         self.documents: list[Document] = []
+        self.load_stats = LoadStats()
+
+    def iter_documents(
+        self,
+        filepath: str,
+        max_record_bytes: int = 16 << 20,
+        progress: Optional[Callable[[LoadStats], None]] = None,
+        progress_every: int = 10_000,
+    ) -> Iterator[Document]:
+        """Stream documents from a JSONL file or a JSON array file.
 
-    def load_documents(self, filepath: str) -> None:
-        """Load documents from a JSON file."""
-        with open(filepath, "r") as f:
-            data = json.load(f)
-        for item in data:
-            doc = Document(content=item["content"], metadata=item.get("metadata", {}))
-            self.documents.append(doc)
+        Records are parsed one at a time, and no single record may exceed
+        ``max_record_bytes``, so peak memory stays bounded however large the
+        export is. ``self.load_stats`` is updated as records are read and
+        ``progress`` is called with it every ``progress_every`` documents.
+        """
+        self.load_stats = stats = LoadStats()
+        with open(filepath, "rb") as f:
+            if _skip_preamble(f, stats) == b"[":
+                items = _iter_json_array(f, stats, max_record_bytes)
+            else:
+                items = _iter_jsonl(f, stats, max_record_bytes)
+            for item in items:
+                stats.documents += 1
+                yield Document(content=item["content"], metadata=item.get("metadata", {}))
+                if progress is not None and stats.documents % progress_every == 0:
+                    progress(stats)
+        if progress is not None:
+            progress(stats)
+
+    def load_documents(self, filepath: str, **kwargs) -> None:
+        """Load documents from a JSON or JSONL file."""
+        self.documents.extend(self.iter_documents(filepath, **kwargs))
+
+    def iter_chunks(
+        self,
+        documents: Optional[Iterable[Document]] = None,
+        chunk_size: int = 256,
+        overlap: int = 32,
+    ) -> Iterator[Chunk]:
+        """Lazily split documents into overlapping chunks.
 
-    def chunk_documents(self, chunk_size: int = 10000, overlap: int = 0) -> list[Document]:
+        ``chunk_size`` and ``overlap`` are measured in approximate tokens.
+        Defaults to this knowledge base's documents; any iterable works, so
+        a streamed export is chunked one document at a time.
+        """
+        for doc in self.documents if documents is None else documents:
+            for start, end in split_spans(doc.content, chunk_size, overlap):
+                yield Chunk(source=doc, start=start, end=end)
+
+    def chunk_documents(self, chunk_size: int = 256, overlap: int = 32) -> list[Chunk]:
         """Split documents into chunks for better retrieval."""
-        chunks = []
-        for doc in self.documents:
-            if len(doc.content) <= chunk_size:
-                chunks.append(doc)
+        return list(self.iter_chunks(chunk_size=chunk_size, overlap=overlap))
+
+
+INDEX_FORMAT_VERSION = 1
+_MANIFEST = "manifest.json"
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fsync_dir(path: str) -> None:
+    """Persist a directory's entries (new, renamed, or removed files)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # directories cannot be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _replace_dir(src: str, dst: str) -> None:
+    """Move directory ``src`` to ``dst``, replacing any directory there.
+
+    The old directory is renamed aside before ``src`` takes its name and
+    only then removed. Its files are unlinked, never truncated, so readers
+    that have them memory mapped keep a valid view until they let go.
+    """
+    parent = os.path.dirname(dst)
+    old = None
+    if os.path.lexists(dst):
+        old = tempfile.mkdtemp(prefix=f".{os.path.basename(dst)}.old-", dir=parent)
+        os.rmdir(old)
+        os.rename(dst, old)
+    os.rename(src, dst)
+    _fsync_dir(parent)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+class _RecordBlob:
+    """Variable-length byte records in one blob, addressed by an offsets array."""
+
+    def __init__(self, data, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def write(records: Iterable[bytes], blob_path: str, offsets_path: str) -> None:
+        offsets = [0]
+        with open(blob_path, "wb") as f:
+            for record in records:
+                f.write(record)
+                offsets.append(offsets[-1] + len(record))
+        np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+
+    @classmethod
+    def open(cls, blob_path: str, offsets_path: str, use_mmap: bool) -> "_RecordBlob":
+        offsets = np.load(offsets_path, mmap_mode="r" if use_mmap else None)
+        with open(blob_path, "rb") as f:
+            if use_mmap and os.fstat(f.fileno()).st_size:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
             else:
-                chunks.append(Document(
-                    content=doc.content[:chunk_size],
-                    metadata=doc.metadata
-                ))
-        return chunks
+                data = f.read()
+        return cls(data, offsets)
 
+    def __len__(self) -> int:
+        return self.offsets.shape[0] - 1
 
-class Retriever:
-    def __init__(self, documents: list[Document]):
+    def __getitem__(self, i: int) -> bytes:
+        return self.data[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def buffers(self) -> list:
+        return [self.data, self.offsets]
+
+
+def _touch_pages(buffer) -> int:
+    """Read one byte per page of ``buffer`` so a memory map is faulted in now.
+
+    Returns the bytes covered; in-memory buffers are read the same way.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8) if isinstance(buffer, (bytes, mmap.mmap)) \
+        else np.asarray(buffer).reshape(-1).view(np.uint8)
+    if data.size:
+        int(data[::mmap.PAGESIZE].sum())
+    return int(data.size)
+
+
+def _normalize(vector: list[float]) -> np.ndarray:
+    query = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(query)
+    return query / norm if norm > 0 else query
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize each row in place, leaving zero rows untouched."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return np.ascontiguousarray(matrix)
+
+
+class DocumentView:
+    """One row of a DocumentStore; every field is read from the columns on access."""
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store: "DocumentStore", row: int):
+        self._store = store
+        self._row = row
+
+    @property
+    def content(self) -> str:
+        return self._store.content(self._row)
+
+    @property
+    def metadata(self) -> dict:
+        return self._store.metadata(self._row)
+
+    @property
+    def embedding(self) -> Optional[np.ndarray]:
+        return self._store.embedding(self._row)
+
+    @property
+    def span(self) -> tuple[Optional[str], int, int]:
+        """(doc_id, start, end) of this row within its source document."""
+        return self._store.span(self._row)
+
+    @property
+    def source_key(self) -> tuple[int, int]:
+        return self._store.source_key(self._row)
+
+    def __eq__(self, other):
+        if not isinstance(other, DocumentView):
+            return NotImplemented
+        return self._store is other._store and self._row == other._row
+
+    def __hash__(self) -> int:
+        return hash((id(self._store), self._row))
+
+    def __repr__(self) -> str:
+        return f"DocumentView(row={self._row}, span={self.span!r})"
+
+
+class _MemoryColumns:
+    """Text and metadata columns of documents indexed from memory.
+
+    Each distinct source string and metadata dict is kept once; row ``r``
+    is ``sources[source_ids[r]][bounds[r, 0]:bounds[r, 1]]``. ``spans``
+    are the offsets reported to callers, which equal ``bounds`` for chunks.
+    """
+
+    def __init__(self, sources: list[str], source_ids: np.ndarray, bounds: np.ndarray,
+                 spans: np.ndarray, metadata: list[dict], metadata_ids: np.ndarray):
+        self.sources = sources
+        self.source_ids = source_ids
+        self.bounds = bounds
+        self.spans = spans
+        self.metadata_table = metadata
+        self.metadata_ids = metadata_ids
+
+    @cached_property
+    def parent_ids(self) -> np.ndarray:
+        """Dense id of each row's source document: same text and same metadata."""
+        pairs = self.source_ids.astype(np.int64) << 32 | self.metadata_ids.astype(np.int64)
+        return np.unique(pairs, return_inverse=True)[1].ravel().astype(np.int64)
+
+    def text(self, row: int) -> str:
+        start, end = self.bounds[row].tolist()
+        return self.sources[self.source_ids[row]][start:end]
+
+    def text_bytes(self, row: int) -> bytes:
+        return self.text(row).encode("utf-8")
+
+    def metadata(self, metadata_id: int) -> dict:
+        return self.metadata_table[metadata_id]
+
+    def source_key(self, row: int) -> int:
+        return int(self.source_ids[row])
+
+
+class _BlobColumns:
+    """Text and metadata columns of a saved index, decoded on access.
+
+    Indexes saved before ``parent_ids`` was written treat every row as
+    its own parent document.
+    """
+
+    def __init__(self, texts: _RecordBlob, metadata: _RecordBlob, metadata_ids: np.ndarray,
+                 spans: np.ndarray, parent_ids: Optional[np.ndarray] = None):
+        self.texts = texts
+        self.spans = spans
+        self.metadata_ids = metadata_ids
+        self.parent_ids = np.arange(len(texts)) if parent_ids is None else parent_ids
+        self._metadata = metadata
+        self._decoded: dict[int, dict] = {}
+
+    def text(self, row: int) -> str:
+        return self.texts[row].decode("utf-8")
+
+    def text_bytes(self, row: int) -> bytes:
+        return bytes(self.texts[row])
+
+    def metadata(self, metadata_id: int) -> dict:
+        if metadata_id not in self._decoded:
+            self._decoded[metadata_id] = json.loads(self._metadata[metadata_id])
+        return self._decoded[metadata_id]
+
+    def source_key(self, row: int) -> int:
+        return int(self.parent_ids[row])
+
+
+class DocumentStore(Sequence):
+    """Columnar storage for indexed documents.
+
+    The text, span, and metadata of row ``r`` live in the column group
+    ``parts[part_of[r]]`` at row ``part_row[r]``. A store built in one pass
+    has a single part; a merged store gathers the parts of its inputs
+    without copying any text. Embeddings are one L2-normalized float32
+    matrix: ``rows[m]`` is the document row of matrix row ``m`` and
+    ``row_of`` the inverse, -1 for documents without an embedding.
+    Indexing returns lightweight DocumentView objects.
+    """
+
+    def __init__(self, parts: list, part_of: np.ndarray, part_row: np.ndarray,
+                 matrix: np.ndarray, rows: np.ndarray):
+        self.parts = parts
+        self.part_of = part_of
+        self.part_row = part_row
+        self.matrix = matrix
+        self.rows = rows
+        self.row_of = np.full(part_of.shape[0], -1, dtype=np.int64)
+        self.row_of[rows] = np.arange(rows.shape[0])
+
+    @classmethod
+    def from_documents(cls, documents: Iterable) -> "DocumentStore":
+        """Pack documents or chunks into columns in one pass.
+
+        Chunks of the same source share its text and metadata entries.
+        Zero embedding vectors stay zero so they score 0.0.
+        """
+        sources: list[str] = []
+        source_index: dict[int, int] = {}
+        metadata: list[dict] = []
+        metadata_index: dict[int, int] = {}
+        source_ids, metadata_ids, bounds, spans = [], [], [], []
+        rows, embeddings = [], []
+        for row, doc in enumerate(documents):
+            if isinstance(doc, Chunk):
+                text, start, end = doc.source.content, doc.start, doc.end
+                span = (start, end)
+            else:
+                text, start, end = doc.content, 0, len(doc.content)
+                span = getattr(doc, "span", (None, start, end))[1:]
+            # Both tables hold their keys' objects, so the ids stay unique.
+            if id(text) not in source_index:
+                source_index[id(text)] = len(sources)
+                sources.append(text)
+            if id(doc.metadata) not in metadata_index:
+                metadata_index[id(doc.metadata)] = len(metadata)
+                metadata.append(doc.metadata)
+            source_ids.append(source_index[id(text)])
+            metadata_ids.append(metadata_index[id(doc.metadata)])
+            bounds.append((start, end))
+            spans.append(span)
+            if doc.embedding is not None:
+                rows.append(row)
+                embeddings.append(doc.embedding)
+
+        n = len(source_ids)
+        bounds = np.asarray(bounds, dtype=np.int64).reshape(n, 2)
+        spans = np.asarray(spans, dtype=np.int64).reshape(n, 2)
+        if np.array_equal(bounds, spans):
+            spans = bounds
+        part = _MemoryColumns(sources, np.asarray(source_ids, dtype=np.int32), bounds, spans,
+                              metadata, np.asarray(metadata_ids, dtype=np.int32))
+        if embeddings:
+            matrix = _normalize_rows(np.array(embeddings, dtype=np.float32))
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        return cls([part], np.zeros(n, dtype=np.int32), np.arange(n, dtype=np.int64),
+                   matrix, np.asarray(rows, dtype=np.int64))
+
+    @classmethod
+    def merge(cls, stores: Sequence["DocumentStore"],
+              dead: Sequence[np.ndarray]) -> tuple["DocumentStore", list[np.ndarray]]:
+        """Concatenate stores, dropping the rows listed in ``dead``.
+
+        Returns the merged store and, per input store, the merged row of
+        each of its rows (-1 where dropped). Text stays in the input parts;
+        only the row columns and embedding rows are gathered.
+        """
+        parts: list = []
+        part_index: dict[int, int] = {}
+        doc_maps, part_of, part_row, row_parts, next_id = [], [], [], [], 0
+        for store, tombstones in zip(stores, dead):
+            alive = np.ones(len(store), dtype=bool)
+            alive[tombstones] = False
+            doc_map = np.full(alive.shape[0], -1, dtype=np.int64)
+            doc_map[alive] = np.arange(next_id, next_id + int(alive.sum()))
+            next_id += int(alive.sum())
+            doc_maps.append(doc_map)
+            remap = np.empty(len(store.parts), dtype=np.int32)
+            for p, part in enumerate(store.parts):
+                remap[p] = part_index.setdefault(id(part), len(parts))
+                if remap[p] == len(parts):
+                    parts.append(part)
+            part_of.append(remap[store.part_of[alive]])
+            part_row.append(store.part_row[alive])
+            row_parts.append(alive[store.rows])
+
+        dims = {s.matrix.shape[1] for s, keep in zip(stores, row_parts) if keep.any()}
+        if len(dims) > 1:
+            raise ValueError(f"cannot merge embeddings of different dimensions: {sorted(dims)}")
+        if dims:
+            matrix = np.concatenate([s.matrix[keep] for s, keep in zip(stores, row_parts)
+                                     if keep.any()])
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        rows = np.concatenate([m[s.rows[keep]] for s, m, keep in zip(stores, doc_maps, row_parts)]
+                              or [np.empty(0, dtype=np.int64)])
+        merged = cls(parts, np.concatenate(part_of or [np.empty(0, dtype=np.int32)]),
+                     np.concatenate(part_row or [np.empty(0, dtype=np.int64)]),
+                     np.ascontiguousarray(matrix), rows)
+        return merged, doc_maps
+
+    def __len__(self) -> int:
+        return self.part_of.shape[0]
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [DocumentView(self, i) for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return DocumentView(self, int(row))
+
+    def _locate(self, row: int):
+        return self.parts[self.part_of[row]], int(self.part_row[row])
+
+    def content(self, row: int) -> str:
+        part, local = self._locate(row)
+        return part.text(local)
+
+    def metadata(self, row: int) -> dict:
+        part, local = self._locate(row)
+        return part.metadata(int(part.metadata_ids[local]))
+
+    def span(self, row: int) -> tuple[Optional[str], int, int]:
+        part, local = self._locate(row)
+        start, end = part.spans[local].tolist()
+        return part.metadata(int(part.metadata_ids[local])).get("id"), start, end
+
+    def embedding(self, row: int) -> Optional[np.ndarray]:
+        matrix_row = self.row_of[row]
+        return None if matrix_row < 0 else self.matrix[matrix_row]
+
+    def source_key(self, row: int) -> tuple[int, int]:
+        part, local = self._locate(row)
+        return id(part), part.source_key(local)
+
+    def _part_rows(self) -> Iterator[tuple[object, np.ndarray, np.ndarray]]:
+        """Yield (part, store rows, part rows) for every part in use."""
+        for p, part in enumerate(self.parts):
+            rows = np.flatnonzero(self.part_of == p)
+            if rows.size:
+                yield part, rows, self.part_row[rows]
+
+    def buffers(self, matrix: bool = True) -> list:
+        """The arrays and blobs behind the columns, for Retriever.warm()."""
+        buffers = [self.matrix, self.rows] if matrix else [self.rows]
+        for part in self.parts:
+            buffers += [part.spans, part.metadata_ids, part.parent_ids]
+            if isinstance(part, _BlobColumns):
+                buffers += part.texts.buffers() + part._metadata.buffers()
+        return buffers
+
+    @cached_property
+    def parent_ids(self) -> np.ndarray:
+        """Per row, a store-wide dense id of the document it was chunked from."""
+        parent_ids = np.empty(len(self), dtype=np.int64)
+        offset = 0
+        for part, rows, local in self._part_rows():
+            unique, inverse = np.unique(part.parent_ids[local], return_inverse=True)
+            parent_ids[rows] = offset + inverse.ravel()
+            offset += unique.shape[0]
+        return parent_ids
+
+    def key_rows(self) -> dict[str, list[int]]:
+        """Rows per metadata ``id``, grouped per interned metadata entry."""
+        key_rows: dict[str, list[int]] = {}
+        for part, rows, local in self._part_rows():
+            metadata_ids = part.metadata_ids[local]
+            order = np.argsort(metadata_ids, kind="stable")
+            starts = np.flatnonzero(np.diff(metadata_ids[order], prepend=-1))
+            for group in np.split(order, starts[1:]):
+                key = part.metadata(int(metadata_ids[group[0]])).get("id")
+                if key is not None:
+                    key_rows.setdefault(key, []).extend(rows[group].tolist())
+        return key_rows
+
+    def value_bitmaps(self, field: str) -> dict:
+        """Packed row bitmaps per value of metadata ``field``.
+
+        Values are read once per interned metadata entry, not per row. A
+        list value sets the row's bit under each of its items; rows without
+        the field are in no bitmap.
+        """
+        masks: dict = {}
+        for part, rows, local in self._part_rows():
+            unique, inverse = np.unique(part.metadata_ids[local], return_inverse=True)
+            entries: dict = {}
+            for j, metadata_id in enumerate(unique.tolist()):
+                value = part.metadata(metadata_id).get(field)
+                for item in value if isinstance(value, (list, tuple)) else (value,):
+                    if item is not None:
+                        entries.setdefault(item, []).append(j)
+            for item, hits in entries.items():
+                entry_mask = np.zeros(unique.shape[0], dtype=bool)
+                entry_mask[hits] = True
+                if item not in masks:
+                    masks[item] = np.zeros(len(self), dtype=bool)
+                masks[item][rows] |= entry_mask[inverse.ravel()]
+        return {item: np.packbits(mask) for item, mask in masks.items()}
+
+    def save(self, path: str) -> None:
+        """Write the columns of a saved index into directory ``path``.
+
+        Files are overwritten in place; Retriever.save() only calls this
+        on a fresh staging directory.
+        """
+        join = partial(os.path.join, path)
+        metadata_table: dict[str, int] = {}
+        metadata_ids = np.empty(len(self), dtype=np.int32)
+        spans = np.empty((len(self), 2), dtype=np.int64)
+        for part, rows, local in self._part_rows():
+            unique, inverse = np.unique(part.metadata_ids[local], return_inverse=True)
+            interned = np.asarray([
+                metadata_table.setdefault(json.dumps(part.metadata(int(m)), sort_keys=True),
+                                          len(metadata_table))
+                for m in unique.tolist()
+            ], dtype=np.int32)
+            metadata_ids[rows] = interned[inverse.ravel()]
+            spans[rows] = part.spans[local]
+
+        _RecordBlob.write((self.parts[p].text_bytes(r) for p, r in
+                           zip(self.part_of.tolist(), self.part_row.tolist())),
+                          join("text.bin"), join("text_offsets.npy"))
+        _RecordBlob.write((key.encode("utf-8") for key in metadata_table),
+                          join("metadata.bin"), join("metadata_offsets.npy"))
+        np.save(join("metadata_ids.npy"), metadata_ids)
+        np.save(join("spans.npy"), spans)
+        np.save(join("parent_ids.npy"), self.parent_ids)
+        np.save(join("embeddings.npy"), np.ascontiguousarray(self.matrix, dtype=np.float32))
+        np.save(join("embedding_rows.npy"), self.rows)
+
+    @classmethod
+    def load(cls, path: str, use_mmap: bool = True) -> "DocumentStore":
+        """Open the columns written by save()."""
+        join = partial(os.path.join, path)
+        mmap_mode = "r" if use_mmap else None
+        part = _BlobColumns(
+            texts=_RecordBlob.open(join("text.bin"), join("text_offsets.npy"), use_mmap),
+            metadata=_RecordBlob.open(join("metadata.bin"), join("metadata_offsets.npy"), use_mmap),
+            metadata_ids=np.load(join("metadata_ids.npy"), mmap_mode=mmap_mode),
+            spans=np.load(join("spans.npy"), mmap_mode=mmap_mode),
+            parent_ids=(np.load(join("parent_ids.npy"), mmap_mode=mmap_mode)
+                        if os.path.exists(join("parent_ids.npy")) else None),
+        )
+        n = len(part.texts)
+        return cls([part], np.zeros(n, dtype=np.int32), np.arange(n, dtype=np.int64),
+                   np.load(join("embeddings.npy"), mmap_mode=mmap_mode),
+                   np.load(join("embedding_rows.npy")))
+
+
+class _Segment:
+    """An immutable slice of the index: a document store plus its postings.
+
+    ``rows``, ``matrix``, and ``row_of`` are the store's embedding columns.
+    Segments with at least ``ann.min_rows`` embeddings also get an ANN index,
+    unless a fitted ``ann_index`` (restored or extended) is passed in.
+    ``bitmaps`` holds the packed value bitmaps of each ``filter_fields``
+    entry, built with the segment; other fields are added on first use.
+    """
+
+    def __init__(self, documents: DocumentStore, keyword_index: KeywordIndex,
+                 ann: Optional[ANNBackend] = None, filter_fields: Iterable[str] = (),
+                 ann_index: Optional[FittedIndex] = None):
         self.documents = documents
+        self.rows = documents.rows
+        self.matrix = documents.matrix
+        self.row_of = documents.row_of
+        self.keyword_index = keyword_index
+        self.bitmaps = {field: documents.value_bitmaps(field) for field in filter_fields}
+        self.ann_index = ann_index
+        if ann_index is None and ann is not None and self.matrix.shape[0] >= max(ann.min_rows, 1):
+            self.ann_index = ann.build(self.matrix)
+
+    @classmethod
+    def build(cls, documents: Iterable, ann: Optional[ANNBackend] = None,
+              filter_fields: Iterable[str] = ()) -> "_Segment":
+        store = DocumentStore.from_documents(documents)
+        keyword_index = KeywordIndex(store.content(row) for row in range(len(store)))
+        return cls(store, keyword_index, ann, filter_fields)
+
+    @classmethod
+    def merge(cls, segments: Sequence["_Segment"], dead: Sequence[np.ndarray],
+              ann: Optional[ANNBackend] = None,
+              filter_fields: Iterable[str] = ()) -> tuple["_Segment", list[np.ndarray]]:
+        """Merge segments into one, dropping tombstoned documents.
+
+        Returns the merged segment and, per input segment, the merged index
+        of each of its documents (-1 where dropped). Embedding rows are
+        copied as-is and postings are merged without re-tokenizing. When
+        the first segment lost no embedded rows, its rows open the merged
+        matrix unchanged, so an ANN index that can ``extend`` only adds
+        the rows of the others instead of being rebuilt.
+        """
+        store, doc_maps = DocumentStore.merge([s.documents for s in segments], dead)
+        keyword_index = KeywordIndex.merge([s.keyword_index for s in segments], doc_maps)
+        ann_index = None
+        first = segments[0] if segments else None
+        if (ann is not None and first is not None and hasattr(first.ann_index, "extend")
+                and build_params(first.ann_index.config) == build_params(ann)
+                and not (first.row_of[dead[0]] >= 0).any()):
+            ann_index = first.ann_index.extend(store.matrix)
+        return cls(store, keyword_index, ann, filter_fields, ann_index), doc_maps
+
+    @cached_property
+    def key_rows(self) -> dict[str, list[int]]:
+        """Document indices per metadata ``id``, built on first write."""
+        return self.documents.key_rows()
+
+    @cached_property
+    def parent_groups(self) -> tuple[Optional[np.ndarray], np.ndarray]:
+        """(order, starts) for segment-max over matrix rows by parent document.
+
+        ``order`` sorts the matrix rows by parent (None when they already
+        are, the usual case since chunks of a document are added together);
+        ``starts`` is where each parent's run begins in that order.
+        """
+        parents = self.documents.parent_ids[self.rows]
+        order = None
+        if parents.size and np.any(parents[1:] < parents[:-1]):
+            order = np.argsort(parents, kind="stable")
+            parents = parents[order]
+        return order, np.flatnonzero(np.diff(parents, prepend=-1))
+
+    def allowed(self, where: dict) -> np.ndarray:
+        """Boolean mask of the documents matching every ``where`` condition.
+
+        A condition is ``field: value`` or ``field: [values]`` (any of);
+        the packed bitmaps are OR-ed per field and AND-ed across fields
+        before a single unpack.
+        """
+        packed = None
+        for field, wanted in where.items():
+            if field not in self.bitmaps:
+                self.bitmaps[field] = self.documents.value_bitmaps(field)
+            bitmaps = self.bitmaps[field]
+            field_bits = np.zeros((len(self.documents) + 7) // 8, dtype=np.uint8)
+            for value in wanted if isinstance(wanted, (list, tuple, set, frozenset)) else (wanted,):
+                if value in bitmaps:
+                    field_bits |= bitmaps[value]
+            packed = field_bits if packed is None else packed & field_bits
+        return np.unpackbits(packed, count=len(self.documents)).view(bool)
+
+
+_NO_ROWS = np.empty(0, dtype=np.int64)
+
+# ANN candidates per requested parent in Retriever.search_parents().
+_PARENT_OVERFETCH = 8
+
+
+class _Snapshot:
+    """An immutable view of the segments and their tombstones.
+
+    Every search reads ``Retriever._snapshot`` once and works only on that
+    object, so writes and compaction never expose a half-applied state.
+    Documents are addressed by a global id: ``offsets[s] + index``.
+    """
+
+    def __init__(self, segments: tuple[_Segment, ...], dead: tuple[np.ndarray, ...], version: int):
+        self.segments = segments
+        self.dead = dead
+        self.version = version
+        self.offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+        np.cumsum([len(s.documents) for s in segments], out=self.offsets[1:])
+        self.dead_rows = tuple(
+            np.sort(r[r >= 0]) for r in (s.row_of[d] for s, d in zip(segments, dead))
+        )
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1]) - sum(d.size for d in self.dead)
+
+    def document(self, gid: int) -> DocumentView:
+        s = int(np.searchsorted(self.offsets, gid, side="right")) - 1
+        return self.segments[s].documents[gid - int(self.offsets[s])]
+
+    def results(self, ids, scores) -> list[SearchResult]:
+        """Lazy results for global ids; no document is materialized here."""
+        ids = np.asarray(ids, dtype=np.int64)
+        segment_of = np.searchsorted(self.offsets, ids, side="right") - 1
+        rows = ids - self.offsets[segment_of]
+        return [
+            SearchResult.from_row(self.segments[s].documents, row, score)
+            for s, row, score in zip(segment_of.tolist(), rows.tolist(), np.asarray(scores).tolist())
+        ]
+
+    def documents(self) -> Sequence:
+        if len(self.segments) == 1 and not self.dead[0].size:
+            return self.segments[0].documents
+        return [
+            segment.documents[i]
+            for segment, dead in zip(self.segments, self.dead)
+            for i in np.setdiff1d(np.arange(len(segment.documents)), dead).tolist()
+        ]
+
+    def allowed(self, where: Optional[dict]) -> tuple[Optional[np.ndarray], ...]:
+        """Per segment, the live documents matching ``where`` (None: no filter)."""
+        if not where:
+            return (None,) * len(self.segments)
+        masks = []
+        for segment, dead in zip(self.segments, self.dead):
+            mask = segment.allowed(where)
+            mask[dead] = False
+            masks.append(mask)
+        return tuple(masks)
+
+    def bm25_stats(self, query: str) -> Optional[BM25Stats]:
+        """Corpus-wide BM25 statistics, or None when one segment suffices."""
+        if len(self.segments) == 1:
+            return None
+        keyword_indexes = [s.keyword_index for s in self.segments]
+        n_docs = sum(len(k) for k in keyword_indexes)
+        total_length = sum(k.total_length for k in keyword_indexes)
+        doc_freqs = {t: sum(k.doc_freq(t) for k in keyword_indexes) for t in set(tokenize(query))}
+        return BM25Stats(n_docs, total_length / n_docs if n_docs else 0.0, doc_freqs)
+
+
+class Retriever:
+    def __init__(self, documents: Iterable[Document], max_segments: int = 8,
+                 ann: Optional[ANNBackend] = None, filter_fields: Iterable[str] = (),
+                 prefilter_below: float = 0.1):
+        """Index ``documents``.
+
+        Later ``add``/``delete``/``upsert`` calls append small segments and
+        tombstones; once more than ``max_segments`` segments exist they are
+        merged by a background compaction. ``ann`` (``ann.HNSW()``,
+        ``ann.IVFFlat()``, or a compressed store from ``quantization.py``)
+        replaces the exact scan on large segments; its tuning knobs can be
+        changed on the live retriever.
+
+        ``filter_fields`` names the metadata fields (e.g. product, locale,
+        status) whose value bitmaps are built with every segment for
+        ``where=`` filters. A filter that keeps less than
+        ``prefilter_below`` of a segment's rows is answered by exact
+        scoring of just those rows instead of a filtered ANN traversal.
+        """
+        self.max_segments = max_segments
+        self.ann = ann
+        self.filter_fields = tuple(filter_fields)
+        self.prefilter_below = prefilter_below
+        self._write_lock = threading.Lock()
+        self._compaction: Optional[threading.Thread] = None
+        segment = _Segment.build(documents, ann, self.filter_fields)
+        self._snapshot = _Snapshot((segment,), (_NO_ROWS,), version=0)
+
+    @property
+    def documents(self) -> Sequence:
+        """The live (not deleted) documents of the current snapshot."""
+        return self._snapshot.documents()
+
+    @property
+    def version(self) -> int:
+        """Incremented by every write and compaction."""
+        return self._snapshot.version
+
+    def __len__(self) -> int:
+        return len(self._snapshot)
+
+    def warm(self) -> int:
+        """Fault in every page of the index; returns the bytes touched.
+
+        A memory-mapped index is read lazily, so the first queries after
+        load() pay the page faults. Call this before serving (RAGPipeline
+        does before swapping an index in) to take that cost up front.
+        Segments searched through compressed codes (``quantization.py``)
+        warm the codes and leave the float32 matrix on disk: it is read
+        only for the few rows each query re-ranks.
+        """
+        touched = 0
+        for segment in self._snapshot.segments:
+            keywords = segment.keyword_index
+            index = segment.ann_index
+            on_disk = getattr(index, "matrix_on_disk", False)
+            buffers = segment.documents.buffers(matrix=not on_disk) + [
+                keywords.offsets, keywords.doc_ids, keywords.term_freqs, keywords.doc_lengths]
+            if index is not None and hasattr(index, "arrays"):
+                buffers += index.arrays().values()
+            for buffer in buffers:
+                touched += _touch_pages(buffer)
+        return touched
+
+    def add(self, documents: Iterable[Document]) -> None:
+        """Append documents as a new segment."""
+        self._write(set(), list(documents))
+
+    def delete(self, doc_id: str) -> int:
+        """Tombstone every entry whose metadata ``id`` is doc_id.
+
+        Returns the number of entries removed.
+        """
+        return self._write({doc_id}, [])
+
+    def upsert(self, documents: Iterable[Document]) -> int:
+        """Replace all entries sharing a metadata ``id`` with documents.
+
+        The tombstones and the new segment become visible in one step, so
+        a concurrent search sees either the old or the new version of each
+        document, never both or neither. Returns the number of entries
+        replaced.
+        """
+        documents = list(documents)
+        keys = {doc.metadata["id"] for doc in documents if doc.metadata.get("id") is not None}
+        return self._write(keys, documents)
+
+    def _write(self, delete_keys: set[str], documents: list) -> int:
+        segment = _Segment.build(documents, self.ann, self.filter_fields) if documents else None
+        with self._write_lock:
+            snapshot = self._snapshot
+            dead, removed = list(snapshot.dead), 0
+            for s, existing in enumerate(snapshot.segments):
+                hits = [i for key in delete_keys for i in existing.key_rows.get(key, ())]
+                if hits:
+                    updated = np.union1d(dead[s], np.asarray(hits, dtype=np.int64))
+                    removed += updated.size - dead[s].size
+                    dead[s] = updated
+            if segment is None and not removed:
+                return 0
+            segments = snapshot.segments + ((segment,) if segment else ())
+            dead += [_NO_ROWS] if segment else []
+            self._snapshot = _Snapshot(segments, tuple(dead), snapshot.version + 1)
+            compact = len(segments) > self.max_segments
+        if compact:
+            self.compact(wait=False)
+        return removed
+
+    def compact(self, wait: bool = True) -> None:
+        """Merge all segments into one and drop tombstoned entries.
+
+        The merge runs without the write lock against the snapshot taken
+        when it started; writes that land meanwhile are carried over when
+        the merged segment is swapped in. With ``wait=False`` the merge
+        runs on a background thread.
+        """
+        while True:
+            with self._write_lock:
+                running = self._compaction
+                if running is None:
+                    self._compaction = threading.Thread(target=self._run_compaction, daemon=True)
+                    self._compaction.start()
+                    started = self._compaction
+            if running is None:
+                if wait:
+                    started.join()
+                return
+            if not wait:
+                return
+            # A merge is already under way but may predate the latest
+            # writes; wait for it, then merge again.
+            running.join()
+
+    def _run_compaction(self) -> None:
+        try:
+            base = self._snapshot
+            merged, doc_maps = _Segment.merge(base.segments, base.dead, self.ann,
+                                              self.filter_fields)
+            with self._write_lock:
+                current = self._snapshot
+                n = len(base.segments)
+                # Tombstones written to the merged segments during the merge.
+                late = [m[np.setdiff1d(now, before)] for m, now, before
+                        in zip(doc_maps, current.dead[:n], base.dead)]
+                merged_dead = np.unique(np.concatenate(late + [_NO_ROWS]))
+                self._snapshot = _Snapshot((merged,) + current.segments[n:],
+                                           (merged_dead[merged_dead >= 0],) + current.dead[n:],
+                                           current.version + 1)
+        finally:
+            with self._write_lock:
+                self._compaction = None
+
+    def save(self, path: str) -> None:
+        """Write the index as a versioned directory.
+
+        Layout: the normalized float32 matrix and its row map as .npy,
+        chunk text and interned metadata as offset-indexed blobs, the BM25
+        postings as CSR arrays, the fitted ANN index as ``ann_*.npy`` when
+        its backend can restore one, and a manifest with a SHA-256 per file.
+        The manifest is written last, so a directory without one is an
+        incomplete save. Segments and tombstones are merged on the way out.
+
+        Files go to a temporary sibling directory, are fsynced, and are
+        renamed into place (see _replace_dir), so an index at ``path`` that
+        this or another process has memory mapped is never rewritten in
+        place, and a crash never leaves a half-written index at ``path``.
+        """
+        snapshot = self._snapshot
+        if len(snapshot.segments) == 1 and not snapshot.dead[0].size:
+            segment = snapshot.segments[0]
+        else:
+            segment, _ = _Segment.merge(snapshot.segments, snapshot.dead, self.ann)
+        path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f".{os.path.basename(path)}.", dir=os.path.dirname(path))
+        try:
+            self._save_files(segment, staging)
+            _replace_dir(staging, path)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def _save_files(segment: "_Segment", path: str) -> None:
+        join = partial(os.path.join, path)
+        segment.documents.save(path)
+
+        keywords = segment.keyword_index
+        with open(join("keyword_terms.json"), "w", encoding="utf-8") as f:
+            json.dump(list(keywords.vocabulary), f)
+        np.save(join("keyword_offsets.npy"), keywords.offsets)
+        np.save(join("keyword_doc_ids.npy"), keywords.doc_ids)
+        np.save(join("keyword_term_freqs.npy"), keywords.term_freqs)
+        np.save(join("keyword_doc_lengths.npy"), keywords.doc_lengths)
+
+        ann_index = segment.ann_index
+        saved_ann = None
+        if ann_index is not None and hasattr(ann_index.config, "restore"):
+            arrays = ann_index.arrays()
+            for name, array in arrays.items():
+                np.save(join(f"ann_{name}.npy"), array)
+            saved_ann = {"params": build_params(ann_index.config), "arrays": sorted(arrays)}
+
+        with os.scandir(path) as entries:
+            files = sorted(entry.name for entry in entries
+                           if entry.is_file(follow_symlinks=False) and entry.name != _MANIFEST)
+        for name in files:
+            with open(join(name), "r+b") as f:
+                os.fsync(f.fileno())
+        manifest = {
+            "format_version": INDEX_FORMAT_VERSION,
+            "documents": len(segment.documents),
+            "dimension": int(segment.matrix.shape[1]),
+            "bm25": {"k1": keywords.k1, "b": keywords.b},
+            "ann": saved_ann,
+            "files": {
+                name: {"bytes": os.path.getsize(join(name)), "sha256": _file_digest(join(name))}
+                for name in files
+            },
+        }
+        with open(join(_MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_dir(path)
+
+    @classmethod
+    def load(cls, path: str, use_mmap: bool = True, verify: bool = False,
+             max_segments: int = 8, ann: Optional[ANNBackend] = None,
+             filter_fields: Iterable[str] = (), prefilter_below: float = 0.1) -> "Retriever":
+        """Open an index written by save().
+
+        With ``use_mmap`` the matrix, postings, and text blob are memory
+        mapped, so processes loading the same index share the page cache
+        and chunk text is only decoded when a result is read. File sizes
+        are always checked against the manifest; ``verify`` also re-hashes
+        every file. An ANN index saved with the same build parameters as
+        ``ann`` is restored rather than built again.
+        """
+        join = partial(os.path.join, path)
+        with open(join(_MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"unsupported index format: {manifest.get('format_version')!r}")
+        for name, expected in manifest["files"].items():
+            if os.path.getsize(join(name)) != expected["bytes"]:
+                raise ValueError(f"index file {name} is truncated or modified")
+            if verify and _file_digest(join(name)) != expected["sha256"]:
+                raise ValueError(f"checksum mismatch for index file {name}")
+
+        def load(name: str) -> np.ndarray:
+            return np.load(join(name), mmap_mode="r" if use_mmap else None)
+
+        documents = DocumentStore.load(path, use_mmap)
+        with open(join("keyword_terms.json"), encoding="utf-8") as f:
+            terms = json.load(f)
+        keyword_index = KeywordIndex.from_arrays(
+            terms, load("keyword_offsets.npy"), load("keyword_doc_ids.npy"),
+            load("keyword_term_freqs.npy"), load("keyword_doc_lengths.npy"),
+            **manifest["bm25"],
+        )
+
+        ann_index = None
+        saved_ann = manifest.get("ann")
+        if (ann is not None and saved_ann and hasattr(ann, "restore")
+                and saved_ann["params"] == json.loads(json.dumps(build_params(ann)))):
+            ann_index = ann.restore(documents.matrix,
+                                    {name: load(f"ann_{name}.npy") for name in saved_ann["arrays"]})
+
+        retriever = cls([], max_segments=max_segments, ann=ann, filter_fields=filter_fields,
+                        prefilter_below=prefilter_below)
+        segment = _Segment(documents, keyword_index, ann, retriever.filter_fields, ann_index)
+        retriever._snapshot = _Snapshot((segment,), (_NO_ROWS,), version=0)
+        return retriever
+
+    @classmethod
+    def open_shards(cls, paths: Sequence[str], use_mmap: bool = True, verify: bool = False,
+                    max_segments: int = 8, ann: Optional[ANNBackend] = None,
+                    filter_fields: Iterable[str] = ()) -> "Retriever":
+        """Open several saved indexes as the segments of one retriever.
+
+        Nothing is merged: each shard's matrix stays its own (memory-mapped)
+        segment, and BM25 already uses corpus-wide statistics across
+        segments. ``max_segments`` is raised to the shard count so the
+        first write does not trigger a full merge; compact() or save()
+        still merges on request.
+        """
+        shards = [cls.load(path, use_mmap, verify, ann=ann, filter_fields=filter_fields)
+                  for path in paths]
+        retriever = cls([], max_segments=max(max_segments, len(shards)), ann=ann,
+                        filter_fields=filter_fields)
+        if shards:
+            segments = tuple(shard._snapshot.segments[0] for shard in shards)
+            retriever._snapshot = _Snapshot(segments, (_NO_ROWS,) * len(segments), version=0)
+        return retriever
+
+    def _vector_search(self, snapshot: _Snapshot, query_embedding: list[float], top_k: int,
+                       where: Optional[dict] = None) -> tuple[np.ndarray, np.ndarray]:
+        """Return (global ids, cosine scores) of the nearest live embeddings."""
+        query = _normalize(query_embedding)
+        ids, scores = [], []
+        for s, (segment, allowed) in enumerate(zip(snapshot.segments, snapshot.allowed(where))):
+            if top_k <= 0 or segment.matrix.shape[0] == 0:
+                continue
+            if allowed is not None:
+                rows, segment_scores = self._filtered_search(segment, query, top_k,
+                                                             allowed[segment.rows])
+                ids.append(snapshot.offsets[s] + segment.rows[rows])
+                scores.append(segment_scores)
+                continue
+            if segment.ann_index is not None:
+                rows, segment_scores = segment.ann_index.search(query, top_k, snapshot.dead_rows[s])
+                ids.append(snapshot.offsets[s] + segment.rows[rows])
+                scores.append(segment_scores)
+                continue
+            segment_scores = segment.matrix @ query
+            segment_scores[snapshot.dead_rows[s]] = -np.inf
+            order = _top_k(segment_scores, top_k)
+            order = order[np.isfinite(segment_scores[order])]
+            ids.append(snapshot.offsets[s] + segment.rows[order])
+            scores.append(segment_scores[order])
+        return self._merge_hits(ids, scores, top_k)
+
+    def _filtered_search(self, segment: _Segment, query: np.ndarray, top_k: int,
+                         allowed_rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k matrix rows among ``allowed_rows`` (dead rows already cleared).
+
+        Selective filters gather and score only the matching rows; broad
+        ones let the ANN index skip non-matching rows during traversal.
+        """
+        selected = int(np.count_nonzero(allowed_rows))
+        if selected == 0:
+            return _NO_ROWS, np.empty(0, dtype=np.float32)
+        if segment.ann_index is not None and selected >= self.prefilter_below * allowed_rows.shape[0]:
+            return segment.ann_index.search(query, top_k, allowed=allowed_rows)
+        rows = np.flatnonzero(allowed_rows)
+        row_scores = segment.matrix[rows] @ query
+        order = _top_k(row_scores, top_k)
+        return rows[order], row_scores[order]
+
+    def _keyword_search(self, snapshot: _Snapshot, query: str, top_k: int,
+                        where: Optional[dict] = None) -> tuple[np.ndarray, np.ndarray]:
+        stats = snapshot.bm25_stats(query)
+        ids, scores = [], []
+        for s, (segment, allowed) in enumerate(zip(snapshot.segments, snapshot.allowed(where))):
+            docs, segment_scores = segment.keyword_index.search(
+                query, top_k, exclude=snapshot.dead[s], stats=stats, allowed=allowed)
+            ids.append(snapshot.offsets[s] + docs)
+            scores.append(segment_scores)
+        return self._merge_hits(ids, scores, top_k)
+
+    @staticmethod
+    def _merge_hits(ids: list[np.ndarray], scores: list[np.ndarray],
+                    top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        if not ids:
+            return _NO_ROWS, np.empty(0, dtype=np.float32)
+        if len(ids) == 1:
+            return ids[0], scores[0]
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        order = _top_k(scores, top_k)
+        return ids[order], scores[order]
+
+    def search(self, query_embedding: list[float], top_k: int = 3,
+               where: Optional[dict] = None) -> list[SearchResult]:
+        """Search for relevant documents.
+
+        ``where`` restricts results by metadata, e.g.
+        ``{"product": "billing", "locale": ["en", "en-GB"]}``: every field
+        must match, and a list matches any of its values.
+        """
+        snapshot = self._snapshot
+        return snapshot.results(*self._vector_search(snapshot, query_embedding, top_k, where))
+
+    def keyword_search(self, query: str, top_k: int = 3,
+                       where: Optional[dict] = None) -> list[SearchResult]:
+        """Rank documents by BM25 over the exact query terms."""
+        snapshot = self._snapshot
+        return snapshot.results(*self._keyword_search(snapshot, query, top_k, where))
+
+    def hybrid_search(
+        self,
+        query: str,
+        query_embedding: list[float],
+        top_k: int = 3,
+        candidates: Optional[int] = None,
+        rrf_k: int = 60,
+        where: Optional[dict] = None,
+    ) -> list[SearchResult]:
+        """Fuse BM25 and vector rankings with reciprocal-rank fusion.
+
+        Each ranker contributes ``1 / (rrf_k + rank)`` for the documents in
+        its top ``candidates``; the fused score orders the final results.
+        """
+        snapshot = self._snapshot
+        depth = candidates or max(top_k * 4, 20)
+        fused: dict[int, float] = {}
+        for ids, _ in (self._vector_search(snapshot, query_embedding, depth, where),
+                       self._keyword_search(snapshot, query, depth, where)):
+            for rank, gid in enumerate(ids.tolist(), start=1):
+                fused[gid] = fused.get(gid, 0.0) + 1.0 / (rrf_k + rank)
+        ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return snapshot.results(*zip(*ranked)) if ranked else []
+
+    def search_parents(self, query_embedding: list[float], top_k: int = 3,
+                       window_tokens: int = 256,
+                       where: Optional[dict] = None) -> list[SearchResult]:
+        """Multi-vector search: rank parent documents by their best sub-chunk.
+
+        Index small chunks (``iter_chunks(chunk_size=64)``) and each parent
+        document is scored by the max similarity over its sub-chunk
+        vectors. Each result's document is a ParentSpan: the best sub-chunk
+        widened with its neighbours in the same parent, up to about
+        ``window_tokens``. The max is a segment reduction over the flat
+        score array, so the cost stays that of one single-vector scan.
+        """
+        snapshot = self._snapshot
+        query = _normalize(query_embedding)
+        hits = []
+        for s, (segment, allowed) in enumerate(zip(snapshot.segments, snapshot.allowed(where))):
+            if top_k <= 0 or segment.matrix.shape[0] == 0:
+                continue
+            rows, scores = self._parent_hits(segment, query, top_k, snapshot.dead_rows[s],
+                                             None if allowed is None else allowed[segment.rows])
+            hits.extend((score, s, row) for score, row in zip(scores.tolist(), rows.tolist()))
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        return [
+            SearchResult(_parent_span(snapshot.segments[s].documents,
+                                      int(snapshot.segments[s].rows[row]), window_tokens), score)
+            for score, s, row in hits[:top_k]
+        ]
+
+    def _parent_hits(self, segment: _Segment, query: np.ndarray, top_k: int,
+                     dead_rows: np.ndarray,
+                     allowed_rows: Optional[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        """Matrix row and score of the best sub-chunk of the top-k parents."""
+        if segment.ann_index is not None:
+            # The index returns sub-chunks, not parents: over-fetch, then
+            # keep each parent's best hit.
+            depth = top_k * _PARENT_OVERFETCH
+            if allowed_rows is not None:
+                rows, scores = self._filtered_search(segment, query, depth, allowed_rows)
+            else:
+                rows, scores = segment.ann_index.search(query, depth, dead_rows)
+            parents = segment.documents.parent_ids[segment.rows[rows]]
+            order = np.lexsort((-scores, parents))
+            best = order[np.flatnonzero(np.diff(parents[order], prepend=-1))]
+            best = best[_top_k(scores[best], top_k)]
+            return rows[best], scores[best]
+
+        scores = segment.matrix @ query
+        scores[dead_rows] = -np.inf
+        if allowed_rows is not None:
+            scores[~allowed_rows] = -np.inf
+        order, starts = segment.parent_groups
+        flat = scores if order is None else scores[order]
+        parent_scores = np.maximum.reduceat(flat, starts)
+        top = _top_k(parent_scores, top_k)
+        top = top[np.isfinite(parent_scores[top])]
+        ends = np.append(starts[1:], flat.shape[0])
+        positions = np.asarray([start + int(np.argmax(flat[start:end]))
+                                for start, end in zip(starts[top].tolist(), ends[top].tolist())],
+                               dtype=np.int64)
+        rows = positions if order is None else order[positions]
+        return rows, parent_scores[top]
+
+    def search_batch(
+        self,
+        query_matrix,
+        top_k: int = 3,
+        query_block: int = 64,
+        doc_block: int = 16384,
+        where: Optional[dict] = None,
+    ) -> list[list[SearchResult]]:
+        """Search for many queries at once, one result list per query row.
+
+        Scores are computed tile by tile (query_block x doc_block) and merged
+        into a running top-k, so peak memory is bounded by the tile size
+        rather than by n_queries x n_documents.
+        """
+        snapshot = self._snapshot
+        queries = np.array(query_matrix, dtype=np.float32, ndmin=2)
+        n_rows = sum(s.matrix.shape[0] for s in snapshot.segments)
+        if top_k <= 0 or n_rows == 0:
+            return [[] for _ in range(queries.shape[0])]
+        queries = _normalize_rows(queries)
+        k = min(top_k, n_rows)
+        allowed = [None if mask is None else mask[segment.rows]
+                   for segment, mask in zip(snapshot.segments, snapshot.allowed(where))]
 
-    def _cosine_similarity(self, a: list[float], b: list[float]) -> float:
-        """Calculate cosine similarity between two vectors."""
-        dot = sum(x * y for x, y in zip(a, b))
-        norm_a = sum(x * x for x in a) ** 0.5
-        norm_b = sum(x * x for x in b) ** 0.5
-        if norm_a == 0 or norm_b == 0:
-            return 0.0
-        return dot / (norm_a * norm_b)
-
-    def search(self, query_embedding: list[float], top_k: int = 3) -> list[SearchResult]:
-        """Search for relevant documents."""
         results = []
-        for doc in self.documents:
-            if doc.embedding is None:
+        for q_start in range(0, queries.shape[0], query_block):
+            q_tile = queries[q_start:q_start + query_block]
+            best_scores = np.empty((q_tile.shape[0], 0), dtype=np.float32)
+            best_ids = np.empty((q_tile.shape[0], 0), dtype=np.int64)
+            for tile_scores, tile_ids in self._candidate_tiles(snapshot, q_tile, k, doc_block,
+                                                                allowed):
+                best_scores = np.concatenate([best_scores, tile_scores], axis=1)
+                best_ids = np.concatenate([best_ids, tile_ids], axis=1)
+                if best_scores.shape[1] > k:
+                    keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                    best_ids = np.take_along_axis(best_ids, keep, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind="stable")
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            best_ids = np.take_along_axis(best_ids, order, axis=1)
+            for scores, ids in zip(best_scores, best_ids):
+                live = np.isfinite(scores)
+                results.append(snapshot.results(ids[live], scores[live]))
+        return results
+
+    def _candidate_tiles(self, snapshot: _Snapshot, q_tile: np.ndarray, k: int, doc_block: int,
+                         allowed: list[Optional[np.ndarray]]) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Yield (scores, global ids) of up to k candidates per query, per tile.
+
+        ``allowed`` holds, per segment, the matrix rows passing the filter
+        (dead rows already cleared), or None when unfiltered.
+        """
+        for s, segment in enumerate(snapshot.segments):
+            dead_rows = snapshot.dead_rows[s]
+            mask = allowed[s]
+            if mask is not None and segment.ann_index is not None:
+                # Per query, like the ANN path below, choosing the filtered
+                # traversal or a pre-filtered scan by selectivity.
+                scores = np.full((q_tile.shape[0], k), -np.inf, dtype=np.float32)
+                ids = np.zeros((q_tile.shape[0], k), dtype=np.int64)
+                for q, query in enumerate(q_tile):
+                    rows, row_scores = self._filtered_search(segment, query, k, mask)
+                    scores[q, :rows.size] = row_scores
+                    ids[q, :rows.size] = snapshot.offsets[s] + segment.rows[rows]
+                yield scores, ids
+                continue
+            if segment.ann_index is not None:
+                # Graph/list traversal is per query; pad to k with -inf.
+                scores = np.full((q_tile.shape[0], k), -np.inf, dtype=np.float32)
+                ids = np.zeros((q_tile.shape[0], k), dtype=np.int64)
+                for q, query in enumerate(q_tile):
+                    rows, row_scores = segment.ann_index.search(query, k, dead_rows)
+                    scores[q, :rows.size] = row_scores
+                    ids[q, :rows.size] = snapshot.offsets[s] + segment.rows[rows]
+                yield scores, ids
+                continue
+            for d_start in range(0, segment.matrix.shape[0], doc_block):
+                d_end = d_start + doc_block
+                tile = q_tile @ segment.matrix[d_start:d_end].T
+                if mask is not None:
+                    tile[:, ~mask[d_start:d_end]] = -np.inf
+                lo, hi = np.searchsorted(dead_rows, [d_start, d_end])
+                tile[:, dead_rows[lo:hi] - d_start] = -np.inf
+                tile_k = min(k, tile.shape[1])
+                part = np.argpartition(-tile, tile_k - 1, axis=1)[:, :tile_k]
+                yield (np.take_along_axis(tile, part, axis=1),
+                       snapshot.offsets[s] + segment.rows[part + d_start])
+
+
+def _parent_span(store: DocumentStore, row: int, window_tokens: int) -> ParentSpan:
+    """Widen ``row`` with adjacent rows of the same parent up to ``window_tokens``."""
+    parents = store.parent_ids
+    parent = parents[row]
+    _, hit_start, hit_end = store.span(row)
+    budget = window_tokens * CHARS_PER_TOKEN
+    lo = hi = row
+    start, end = hit_start, hit_end
+    grew = True
+    while grew:
+        grew = False
+        for neighbour in (hi + 1, lo - 1):
+            if not 0 <= neighbour < len(store) or parents[neighbour] != parent:
+                continue
+            _, n_start, n_end = store.span(neighbour)
+            if max(end, n_end) - min(start, n_start) > budget:
                 continue
-            score = self._cosine_similarity(query_embedding, doc.embedding)
-            results.append(SearchResult(document=doc, score=score))
+            start, end = min(start, n_start), max(end, n_end)
+            lo, hi = min(lo, neighbour), max(hi, neighbour)
+            grew = True
+
+    pieces = sorted((store.span(r)[1:], r) for r in range(lo, hi + 1))
+    (first_start, covered), first = pieces[0]
+    text = store.content(first)
+    for (piece_start, piece_end), r in pieces[1:]:
+        if piece_end <= covered:
+            continue
+        gap = piece_start - covered
+        text += (" " if gap > 0 else "") + store.content(r)[max(-gap, 0):]
+        covered = piece_end
+    return ParentSpan(text, store.metadata(row), first_start, covered, (hit_start, hit_end),
+                      store.source_key(row))
+
+
+def approx_token_count(text: str) -> int:
+    """Fast token estimate: about CHARS_PER_TOKEN characters per token."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+@dataclass
+class ContextPassage:
+    """A contiguous span of one source document placed in the prompt."""
+    doc_id: Optional[str]
+    start: int
+    end: int
+    text: str
+    score: float
+    tokens: int = 0
+
+
+class ContextPacker:
+    """Assemble retrieved chunks into prompt context under a token budget.
+
+    Overlapping or adjacent chunks of the same document are merged into
+    one passage (deduplicating the overlap), then passages are packed
+    greedily by score per token. Scores are first rescaled onto [1, 2]
+    (min to max), so cosine similarities and unbounded re-ranker logits,
+    negative ones included, rank the same way. A passage that does not fit is trimmed
+    back to its last complete sentence, or left out. ``count_tokens`` can
+    be any tokenizer's length function; the default is a fast estimate.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 1024,
+        count_tokens: Callable[[str], int] = approx_token_count,
+        separator: str = "\n---\n",
+        merge_gap: int = 2,
+        min_fragment_tokens: int = 16,
+    ):
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.separator = separator
+        self.merge_gap = merge_gap
+        self.min_fragment_tokens = min_fragment_tokens
+
+    def render(self, results: list[SearchResult]) -> str:
+        return self.separator.join(p.text for p in self.pack(results))
+
+    def pack(self, results: list[SearchResult]) -> list[ContextPassage]:
+        """Select passages for the budget, best score first."""
+        passages = self.merge_spans(results)
+        for passage in passages:
+            passage.tokens = self.count_tokens(passage.text)
+        separator_tokens = self.count_tokens(self.separator)
+
+        # Dividing a negative score by tokens would favour long passages.
+        low = min((p.score for p in passages), default=0.0)
+        spread = max((p.score for p in passages), default=0.0) - low
+
+        def value(passage: ContextPassage) -> float:
+            gain = 1.0 + ((passage.score - low) / spread if spread > 0 else 0.0)
+            return gain / max(passage.tokens, 1)
+
+        packed, used = [], 0
+        for passage in sorted(passages, key=value, reverse=True):
+            remaining = self.token_budget - used - (separator_tokens if packed else 0)
+            if passage.tokens > remaining:
+                if remaining < self.min_fragment_tokens:
+                    continue
+                passage = self._trim(passage, remaining)
+                if passage is None:
+                    continue
+            packed.append(passage)
+            used += passage.tokens + (separator_tokens if len(packed) > 1 else 0)
+        packed.sort(key=lambda p: p.score, reverse=True)
+        return packed
+
+    def merge_spans(self, results: list[SearchResult]) -> list[ContextPassage]:
+        """Collapse overlapping and adjacent chunks of each document."""
+        by_source: dict[object, list[ContextPassage]] = {}
+        for result in results:
+            doc = result.document
+            content = doc.content
+            span = getattr(doc, "span", None)
+            doc_id, start, end = span if span else (doc.metadata.get("id"), 0, len(content))
+            # Without an id, only chunks of the very same source merge.
+            key = doc_id if doc_id is not None else getattr(doc, "source_key", id(doc))
+            by_source.setdefault(key, []).append(
+                ContextPassage(doc_id, start, end, content, result.score))
+
+        merged = []
+        for spans in by_source.values():
+            spans.sort(key=lambda p: (p.start, -p.end))
+            current = spans[0]
+            for span in spans[1:]:
+                gap = span.start - current.end
+                if gap > self.merge_gap:
+                    merged.append(current)
+                    current = span
+                    continue
+                if span.end > current.end:
+                    tail = span.text[max(-gap, 0):]
+                    current.text += (" " if gap > 0 else "") + tail
+                    current.end = span.end
+                current.score = max(current.score, span.score)
+            merged.append(current)
+        return merged
 
-        results.sort(key=lambda x: x.score, reverse=True)
-        return results[:top_k]
+    def _trim(self, passage: ContextPassage, budget: int) -> Optional[ContextPassage]:
+        """Cut the passage at its last sentence end that fits the budget."""
+        limit = len(passage.text) * budget // max(passage.tokens, 1)
+        while limit > 0:
+            end = -1
+            for match in _SENTENCE_END_RE.finditer(passage.text, 0, limit):
+                end = match.end()
+            if end == -1:
+                return None
+            text = passage.text[:end]
+            tokens = self.count_tokens(text)
+            if tokens <= budget:
+                return ContextPassage(passage.doc_id, passage.start, passage.start + end,
+                                      text, passage.score, tokens)
+            limit = end - 1
+        return None
+
+
+def embed_chunks(chunks: Iterable[Chunk], embedder: Embedder,
+                 batch_size: int = 256) -> Iterator[Chunk]:
+    """Embed chunk text ``batch_size`` chunks at a time, yielding each chunk once embedded."""
+    batch: list[Chunk] = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == batch_size:
+            yield from _embed_batch(batch, embedder)
+            batch = []
+    if batch:
+        yield from _embed_batch(batch, embedder)
+
+
+def _embed_batch(batch: list[Chunk], embedder: Embedder) -> list[Chunk]:
+    vectors = np.asarray(embedder.embed([chunk.content for chunk in batch]), dtype=np.float32)
+    for chunk, vector in zip(batch, vectors):
+        chunk.embedding = vector
+    return batch
+
+
+def _shards(documents: Iterable[Document], shard_size: int) -> Iterator[list[Document]]:
+    shard: list[Document] = []
+    for doc in documents:
+        shard.append(doc)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def _build_shard(documents: list[Document], path: str, embedder: Optional[Embedder],
+                 chunking: dict, ann: Optional[ANNBackend] = None) -> str:
+    """Worker: chunk, embed, and save one shard (with its ANN index) as a standalone index."""
+    chunks = KnowledgeBase().iter_chunks(documents, **chunking)
+    if embedder is not None:
+        chunks = embed_chunks(chunks, embedder)
+    Retriever(chunks, ann=ann).save(path)
+    return path
+
+
+def _where_key(where: Optional[dict]) -> Optional[tuple]:
+    """A hashable, order-independent form of a ``where`` filter."""
+    if not where:
+        return None
+    return tuple(sorted(
+        (field, tuple(sorted(value, key=repr)) if isinstance(value, (list, tuple, set, frozenset))
+         else value)
+        for field, value in where.items()
+    ))
+
+
+class IndexVersion:
+    """One published index: a retriever and the queries still using it.
+
+    RAGPipeline swaps versions under a lock, so a query runs start to end
+    on one version. A replaced version is released once its last in-flight
+    query returns: the retriever is dropped (unmapping its files) and the
+    ``on_release`` callbacks run, e.g. to delete a superseded build.
+    """
+
+    def __init__(self, retriever: Retriever, generation: int):
+        self.retriever: Optional[Retriever] = retriever
+        self.generation = generation
+        self.on_release: list[Callable[[], None]] = []
+        self.refs = 0
+        self.retired = False
+
+    @property
+    def released(self) -> bool:
+        return self.retriever is None
+
+    def _release(self) -> None:
+        self.retriever = None
+        for callback in self.on_release:
+            callback()
 
 
 class RAGPipeline:
-    def __init__(self, knowledge_base: KnowledgeBase):
+    def __init__(self, knowledge_base: KnowledgeBase, context_packer: Optional[ContextPacker] = None,
+                 top_k: int = 3, cache: Optional[QueryCache] = None,
+                 reranker: Optional[Reranker] = None, embedder: Optional[Embedder] = None,
+                 sub_chunk_tokens: Optional[int] = None, parent_window_tokens: int = 256,
+                 ann: Optional[ANNBackend] = None, filter_fields: Iterable[str] = ()):
+        """``cache`` (a ``cache.QueryCache``) short-circuits repeated and,
+        optionally, semantically similar queries; it is invalidated by any
+        index write and cleared when the index is rebuilt or reloaded.
+        ``reranker`` (a ``rerank.Reranker``) re-scores the first-stage
+        candidates before the best ``top_k`` become context. ``embedder``
+        (see ``embedders.py``) embeds chunks at build time and queries
+        passed without an embedding; without one, chunks keep their source
+        document's embedding.
+
+        ``sub_chunk_tokens`` switches to multi-vector retrieval: documents
+        are indexed as sub-chunks of that size, ranked by their best
+        sub-chunk, and each answer gets the ``parent_window_tokens`` of the
+        parent around that hit (see Retriever.search_parents). Sub-chunks
+        need their own vectors, so use it with an ``embedder``.
+
+        ``ann`` and ``filter_fields`` are passed to every Retriever the
+        pipeline builds or loads (see Retriever); shards built in worker
+        processes save their fitted ANN index, so it is not rebuilt here."""
         self.kb = knowledge_base
-        self.retriever: Optional[Retriever] = None
+        self.embedder = embedder
+        self._index: Optional[IndexVersion] = None
+        self._index_lock = threading.Lock()
+        self.context_packer = context_packer or ContextPacker()
+        self.top_k = top_k
+        self.cache = cache
+        self.reranker = reranker
+        self.sub_chunk_tokens = sub_chunk_tokens
+        self.parent_window_tokens = parent_window_tokens
+        self.ann = ann
+        self.filter_fields = tuple(filter_fields)
 
-    def build_index(self) -> None:
-        """Build the search index from the knowledge base."""
-        chunks = self.kb.chunk_documents()
-        # In production, embeddings would be generated here
-        self.retriever = Retriever(chunks)
+    @property
+    def retriever(self) -> Optional[Retriever]:
+        """The retriever of the current index version."""
+        index = self._index
+        return None if index is None else index.retriever
 
-    def generate_answer(self, query: str, query_embedding: list[float]) -> str:
-        """Retrieve context and generate an answer."""
-        if self.retriever is None:
-            raise RuntimeError("Index not built. Call build_index() first.")
+    @retriever.setter
+    def retriever(self, retriever: Retriever) -> None:
+        self.swap_index(retriever, warm=False)
 
-        results = self.retriever.search(query_embedding, top_k=3)
+    def swap_index(self, retriever: Retriever, warm: bool = True,
+                   on_release: Iterable[Callable[[], None]] = ()) -> IndexVersion:
+        """Publish ``retriever`` as the next index version.
 
-        max_context_length = 500
-        context_parts = []
-        total_length = 0
-        for result in results:
-            remaining = max_context_length - total_length
-            if remaining <= 0:
-                break
-            context_parts.append(result.document.content[:remaining])
-            total_length += len(result.document.content[:remaining])
+        With ``warm`` its pages are faulted in first (Retriever.warm()),
+        so queries never see a cold index. The swap itself is a pointer
+        change: queries already running finish on the version they
+        started with, which is released once the last of them returns.
+        """
+        if warm:
+            retriever.warm()
+        with self._index_lock:
+            previous = self._index
+            self._index = IndexVersion(retriever, previous.generation + 1 if previous else 1)
+            self._index.on_release.extend(on_release)
+            release = previous is not None and previous.refs == 0
+            if previous is not None:
+                previous.retired = True
+        if release:
+            previous._release()
+        if self.cache is not None:
+            self.cache.clear()
+        return self._index
+
+    @contextmanager
+    def acquire(self) -> Iterator[IndexVersion]:
+        """Pin the current index version for the duration of the block."""
+        with self._index_lock:
+            index = self._index
+            if index is None:
+                raise RuntimeError("Index not built. Call build_index() first.")
+            index.refs += 1
+        try:
+            yield index
+        finally:
+            with self._index_lock:
+                index.refs -= 1
+                release = index.retired and index.refs == 0
+            if release:
+                index._release()
+
+    def build_index(self, documents: Optional[Iterable[Document]] = None, workers: int = 1,
+                    shard_size: int = 50_000, shard_dir: Optional[str] = None) -> None:
+        """Build the search index from the knowledge base.
+
+        Pass ``documents`` (e.g. ``kb.iter_documents(path)``) to chunk a
+        stream directly instead of the documents already loaded in memory.
+
+        With ``workers > 1`` the stream is cut into ``shard_size``-document
+        shards that a process pool chunks, embeds, and saves; each shard
+        becomes one segment of the index, so no matrix is concatenated.
+        Shards are written to a new directory under ``shard_dir`` and
+        memory-mapped from there, or read into memory from a temporary
+        directory if it is not given. The embedder must be picklable.
+        ``shard_dir`` also applies with one worker: the index is then
+        built in a worker process and served from disk, which with a
+        quantized ``ann`` backend keeps only its codes resident.
+
+        The new index is warmed and swapped in only once complete (see
+        swap_index()); queries keep using the previous one until then, and
+        the previous build's shard directory is removed when it is released.
+        """
+        on_release = ()
+        if workers > 1 and shard_dir is None:
+            with tempfile.TemporaryDirectory() as tmp:
+                retriever = self._build_sharded(documents, workers, shard_size, tmp,
+                                                use_mmap=False)
+        elif shard_dir is not None:
+            # Never rewrite files a live version may have mapped.
+            os.makedirs(shard_dir, exist_ok=True)
+            build_dir = tempfile.mkdtemp(prefix="index-", dir=shard_dir)
+            retriever = self._build_sharded(documents, workers, shard_size, build_dir,
+                                            use_mmap=True)
+            on_release = (partial(shutil.rmtree, build_dir, ignore_errors=True),)
+        else:
+            chunks = self.kb.iter_chunks(documents, **self._chunking)
+            if self.embedder is not None:
+                chunks = embed_chunks(chunks, self.embedder)
+            retriever = Retriever(chunks, ann=self.ann, filter_fields=self.filter_fields)
+        self.swap_index(retriever, on_release=on_release)
+
+    def _build_sharded(self, documents: Optional[Iterable[Document]], workers: int,
+                       shard_size: int, shard_dir: str, use_mmap: bool) -> Retriever:
+        documents = self.kb.documents if documents is None else documents
+        os.makedirs(shard_dir, exist_ok=True)
+        paths, pending = [], set()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for i, shard in enumerate(_shards(documents, shard_size)):
+                paths.append(os.path.join(shard_dir, f"shard-{i:05d}"))
+                pending.add(pool.submit(_build_shard, shard, paths[-1], self.embedder,
+                                         self._chunking, self.ann))
+                # Bound the shards held in memory while the stream is read.
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            for future in pending:
+                future.result()
+        return Retriever.open_shards(paths, use_mmap=use_mmap, ann=self.ann,
+                                     filter_fields=self.filter_fields)
+
+    def save_index(self, path: str) -> None:
+        """Persist the built index so restarts can skip build_index()."""
+        with self.acquire() as index:
+            index.retriever.save(path)
+
+    def load_index(self, path: str, mmap: bool = True, verify: bool = False,
+                   warm: bool = True) -> None:
+        """Swap in an index written by save_index(), warmed first by default."""
+        retriever = Retriever.load(path, use_mmap=mmap, verify=verify, ann=self.ann,
+                                   filter_fields=self.filter_fields)
+        self.swap_index(retriever, warm=warm)
+
+    def generate_answer(self, query: str, query_embedding: Optional[list[float]] = None,
+                        where: Optional[dict] = None) -> str:
+        """Retrieve context and generate an answer.
+
+        ``where`` restricts retrieval by metadata, see Retriever.search().
+        With a cache, ``query_embedding`` may be omitted for a query whose
+        normalized text is already cached.
+        """
+        with self.acquire() as index:
+            retriever = index.retriever
+            # Read before searching, so a write racing this query leaves the
+            # entry tagged with an already outdated version, never a newer one.
+            version = (index.generation, retriever.version)
+            if query_embedding is None and self.embedder is not None:
+                cached = None
+                if self.cache is not None:
+                    cached = self.cache.embedding(query, version, (self.top_k, _where_key(where)))
+                query_embedding = cached if cached is not None else self.embedder.embed([query])[0]
+
+            results = self._cached(query, version, query_embedding, where)
+            if results is None:
+                if query_embedding is None:
+                    raise ValueError("query_embedding is required for a query that is not cached")
+                results = self._search(retriever, query_embedding, where)
+                results = self._rerank(query, results)
+                self._remember(query, version, query_embedding, where, results)
+            return self._answer_from_results(results)
+
+    def generate_answers(self, queries: list[str], query_matrix=None) -> list[str]:
+        """Answer a burst of queries with one batched retrieval pass.
+
+        Cached queries are answered from the cache; only the rest are
+        searched, together. Without ``query_matrix`` the queries are
+        embedded in one call to the pipeline's embedder.
+        """
+        with self.acquire() as index:
+            retriever = index.retriever
+            if query_matrix is None:
+                if self.embedder is None:
+                    raise ValueError("query_matrix is required without an embedder")
+                query_matrix = self.embedder.embed(queries)
+            if len(queries) != len(query_matrix):
+                raise ValueError("queries and query_matrix must have the same length")
+
+            version = (index.generation, retriever.version)
+            batch_results = [self._cached(q, version, e, None)
+                             for q, e in zip(queries, query_matrix)]
+            misses = [i for i, results in enumerate(batch_results) if results is None]
+            if misses:
+                miss_matrix = np.asarray(query_matrix, dtype=np.float32)[misses]
+                if self.sub_chunk_tokens:
+                    searched = [self._search(retriever, embedding, None) for embedding in miss_matrix]
+                else:
+                    searched = retriever.search_batch(miss_matrix, top_k=self._depth)
+                for i, embedding, results in zip(misses, miss_matrix, searched):
+                    results = self._rerank(queries[i], results)
+                    self._remember(queries[i], version, embedding, None, results)
+                    batch_results[i] = results
+            return [self._answer_from_results(results) for results in batch_results]
+
+    @property
+    def _chunking(self) -> dict:
+        if not self.sub_chunk_tokens:
+            return {}
+        return {"chunk_size": self.sub_chunk_tokens, "overlap": self.sub_chunk_tokens // 8}
+
+    def _search(self, retriever: Retriever, query_embedding,
+                where: Optional[dict]) -> list[SearchResult]:
+        if self.sub_chunk_tokens:
+            return retriever.search_parents(query_embedding, top_k=self._depth,
+                                            window_tokens=self.parent_window_tokens, where=where)
+        return retriever.search(query_embedding, top_k=self._depth, where=where)
+
+    @property
+    def _depth(self) -> int:
+        """First-stage result count: the re-ranker's candidate pool, if any."""
+        return max(self.top_k, self.reranker.candidates) if self.reranker else self.top_k
+
+    def _rerank(self, query: str, results: list[SearchResult]) -> list[SearchResult]:
+        if self.reranker is None:
+            return results
+        return self.reranker.rerank(query, results, self.top_k)
+
+    def _cached(self, query: str, version: tuple[int, int], query_embedding,
+                where: Optional[dict]) -> Optional[list[SearchResult]]:
+        if self.cache is None:
+            return None
+        entry = self.cache.get(query, version, (self.top_k, _where_key(where)), query_embedding)
+        return None if entry is None else entry.results
+
+    def _remember(self, query: str, version: tuple[int, int], query_embedding, where: Optional[dict],
+                  results: list[SearchResult]) -> None:
+        if self.cache is not None:
+            self.cache.put(query, version, results, (self.top_k, _where_key(where)),
+                           query_embedding)
 
-        context = "\n---\n".join(context_parts)
+    def _answer_from_results(self, results: list[SearchResult]) -> str:
+        context = self.context_packer.render(results)
 
         # In production, this would call an LLM
         return f"Based on the following context:\n{context}\n\nAnswer: [LLM would generate here]"
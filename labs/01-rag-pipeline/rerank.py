@@ -0,0 +1,109 @@
+"""
+Second-stage re-ranking for RAGPipeline.
+
+The retriever scores query and passage independently (bi-encoder); a
+cross-encoder reads them together and orders candidates better, at a much
+higher cost per pair. ``Reranker`` takes the first-stage top-N, scores them
+in batches, and keeps the best k, but only spends that cost on candidates
+that could actually change the top k:
+
+- if no candidate below rank k scores within ``margin`` of the k-th
+  first-stage score, the top k is already settled and re-ranking is
+  skipped;
+- otherwise only the top k plus those close contenders are scored.
+
+Any object with ``predict(pairs) -> scores`` works as the scorer, including
+``sentence_transformers.CrossEncoder``. ``LexicalCrossEncoder`` is a
+deterministic local stand-in.
+"""
+import math
+import re
+from dataclasses import dataclass
+from typing import Protocol, Sequence
+
+import numpy as np
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+
+
+class CrossEncoder(Protocol):
+    def predict(self, pairs: Sequence[tuple[str, str]]) -> Sequence[float]:
+        """Relevance of each (query, passage) pair; higher is better."""
+
+
+class LexicalCrossEncoder:
+    """Deterministic pair scorer: query-term coverage plus in-order bigram matches.
+
+    Like a real cross-encoder it sees query and passage together, so a
+    passage that contains the query's phrases outranks one that merely
+    shares its vocabulary. No model, no randomness.
+    """
+
+    def __init__(self, phrase_weight: float = 0.5):
+        self.phrase_weight = phrase_weight
+
+    def predict(self, pairs: Sequence[tuple[str, str]]) -> np.ndarray:
+        return np.asarray([self._score(query, passage) for query, passage in pairs],
+                          dtype=np.float32)
+
+    def _score(self, query: str, passage: str) -> float:
+        q = _WORD_RE.findall(query.lower())
+        p = _WORD_RE.findall(passage.lower())
+        if not q or not p:
+            return 0.0
+        q_terms, p_terms = set(q), set(p)
+        coverage = len(q_terms & p_terms) / len(q_terms)
+        q_bigrams = set(zip(q, q[1:]))
+        phrases = len(q_bigrams & set(zip(p, p[1:]))) / len(q_bigrams) if q_bigrams else 0.0
+        # A mild length penalty so a focused passage beats one that merely contains everything.
+        return coverage + self.phrase_weight * phrases - 0.01 * math.log(len(p))
+
+
+@dataclass
+class RerankStats:
+    queries: int = 0
+    skipped: int = 0
+    pairs_scored: int = 0
+
+
+class Reranker:
+    """Re-rank the first-stage top ``candidates`` with ``scorer`` and keep the best k.
+
+    ``margin`` is in first-stage score units (cosine similarity for
+    ``Retriever.search``). Pairs are sent to the scorer ``batch_size`` at
+    a time.
+    """
+
+    def __init__(self, scorer: CrossEncoder, candidates: int = 20, batch_size: int = 16,
+                 margin: float = 0.05):
+        self.scorer = scorer
+        self.candidates = candidates
+        self.batch_size = batch_size
+        self.margin = margin
+        self.stats = RerankStats()
+
+    def budget(self, scores: Sequence[float], top_k: int) -> int:
+        """How many leading candidates to re-rank; 0 when the top k is settled."""
+        scores = np.asarray(scores, dtype=np.float64)[:self.candidates]
+        if top_k <= 0 or scores.shape[0] <= top_k:
+            return 0
+        contenders = int(np.count_nonzero(scores[top_k:] >= scores[top_k - 1] - self.margin))
+        return top_k + contenders if contenders else 0
+
+    def rerank(self, query: str, results: list, top_k: int) -> list:
+        """Return the best ``top_k`` of ``results`` (ordered best first by the first stage)."""
+        self.stats.queries += 1
+        n = self.budget([r.score for r in results], top_k)
+        if n == 0:
+            self.stats.skipped += 1
+            return results[:top_k]
+        head = results[:n]
+        passages = [r.document.content for r in head]
+        scores = np.concatenate([
+            np.asarray(self.scorer.predict([(query, p) for p in passages[i:i + self.batch_size]]),
+                       dtype=np.float32)
+            for i in range(0, n, self.batch_size)
+        ])
+        self.stats.pairs_scored += n
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [head[i].rescored(float(scores[i])) for i in order.tolist()]
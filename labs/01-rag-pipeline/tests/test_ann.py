@@ -0,0 +1,158 @@
+"""Tests for the approximate nearest-neighbour backends."""
+import numpy as np
+import pytest
+
+import ann
+from ann import HNSW, HNSWIndex, IVFFlat, exact_search, recall_at_k
+from rag_pipeline import Document, KnowledgeBase, RAGPipeline, Retriever
+
+
+def clustered(n=600, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(12, dim))
+    data = centers[rng.integers(12, size=n)] + 0.3 * rng.normal(size=(n, dim))
+    return (data / np.linalg.norm(data, axis=1, keepdims=True)).astype(np.float32)
+
+
+@pytest.mark.parametrize("config", [HNSW(min_rows=1), IVFFlat(nprobe=6, min_rows=1)])
+def test_recall_against_exact_search(config):
+    matrix = clustered()
+    queries = matrix[:40] + 0.01
+    index = config.build(matrix)
+    assert recall_at_k(matrix, index, queries, k=10) >= 0.9
+
+
+def test_search_knobs_trade_recall():
+    matrix = clustered()
+    queries = matrix[::15]
+    config = IVFFlat(n_lists=40, nprobe=1, min_rows=1)
+    index = config.build(matrix)
+    low = recall_at_k(matrix, index, queries, k=10)
+    config.nprobe = 40
+    assert recall_at_k(matrix, index, queries, k=10) == 1.0 >= low
+
+
+@pytest.mark.parametrize("config", [HNSW(min_rows=1), IVFFlat(nprobe=40, min_rows=1)])
+def test_dead_rows_are_never_returned(config):
+    matrix = clustered(n=200)
+    index = config.build(matrix)
+    dead = np.sort(exact_search(matrix, matrix[0], 5)[0])
+    rows, _ = index.search(matrix[0], 10, dead)
+    assert len(rows) == 10
+    assert not set(rows.tolist()) & set(dead.tolist())
+
+
+def test_retriever_uses_ann_backend_with_same_api():
+    matrix = clustered(n=300)
+    docs = [Document(content=f"doc {i}", metadata={"id": str(i)}, embedding=list(v))
+            for i, v in enumerate(matrix)]
+    exact = Retriever(docs)
+    approx = Retriever(docs, ann=HNSW(min_rows=100, ef_search=128))
+    assert approx._snapshot.segments[0].ann_index is not None
+
+    query = list(matrix[7])
+    assert [r.document.content for r in approx.search(query, top_k=5)] == [
+        r.document.content for r in exact.search(query, top_k=5)]
+    batched = approx.search_batch(matrix[:3], top_k=5)
+    assert [r.document.content for r in batched[1]] == [
+        r.document.content for r in exact.search(list(matrix[1]), top_k=5)]
+
+    approx.delete("7")
+    assert "doc 7" not in [r.document.content for r in approx.search(query, top_k=5)]
+
+
+@pytest.mark.parametrize("config", [HNSW(min_rows=1), IVFFlat(nprobe=6, min_rows=1)])
+def test_filtered_traversal_only_returns_allowed_rows(config):
+    matrix = clustered()
+    allowed = np.arange(matrix.shape[0]) % 3 == 0
+    index = config.build(matrix)
+    hits = found = 0
+    for query in matrix[:20] + 0.01:
+        rows, _ = index.search(query, 10, allowed=allowed)
+        assert allowed[rows].all()
+        truth = exact_search(matrix, query, 10, allowed=allowed)[0]
+        hits += len(set(rows.tolist()) & set(truth.tolist()))
+        found += len(truth)
+    assert hits / found >= 0.9
+
+
+def test_retriever_filters_choose_scan_or_traversal():
+    matrix = clustered(n=300)
+    docs = [Document(content=f"doc {i}", embedding=list(v),
+                     metadata={"id": str(i), "tier": "gold" if i < 10 else "std"})
+            for i, v in enumerate(matrix)]
+    exact = Retriever(docs, filter_fields=["tier"])
+    approx = Retriever(docs, ann=HNSW(min_rows=100, ef_search=128), filter_fields=["tier"])
+    for tier in ("gold", "std"):
+        query = list(matrix[3])
+        got = approx.search(query, top_k=5, where={"tier": tier})
+        assert all(r.document.metadata["tier"] == tier for r in got)
+        assert [r.document.content for r in got] == [
+            r.document.content for r in exact.search(query, top_k=5, where={"tier": tier})]
+
+
+@pytest.mark.parametrize("config", [HNSW(min_rows=100), IVFFlat(nprobe=4, min_rows=100)])
+def test_saved_index_is_restored_without_rebuilding(config, tmp_path, monkeypatch):
+    matrix = clustered(n=300)
+    docs = [Document(content=f"doc {i}", metadata={"id": str(i)}, embedding=list(v))
+            for i, v in enumerate(matrix)]
+    built = Retriever(docs, ann=config)
+    built.save(str(tmp_path / "index"))
+
+    def never(*args, **kwargs):
+        raise AssertionError("the saved index was rebuilt")
+    monkeypatch.setattr(HNSWIndex, "_insert", never)
+    monkeypatch.setattr(ann, "kmeans", never)
+    loaded = Retriever.load(str(tmp_path / "index"), ann=config)
+    original, restored = built._snapshot.segments[0].ann_index, loaded._snapshot.segments[0].ann_index
+    assert type(restored) is type(original)
+    for name, array in original.arrays().items():
+        assert np.array_equal(restored.arrays()[name], array)
+    for query in matrix[:10]:
+        assert [r.document.content for r in loaded.search(list(query), top_k=5)] == [
+            r.document.content for r in built.search(list(query), top_k=5)]
+    monkeypatch.undo()
+
+    # Other build parameters fit a new index; query knobs alone do not.
+    rebuilt = type(config)(seed=1, min_rows=100)
+    assert Retriever.load(str(tmp_path / "index"), ann=rebuilt)._snapshot.segments[0].ann_index \
+        .config is rebuilt
+
+
+def test_compaction_extends_the_graph_instead_of_rebuilding(monkeypatch):
+    matrix = clustered(n=320)
+    docs = [Document(content=f"doc {i}", metadata={"id": str(i)}, embedding=list(v))
+            for i, v in enumerate(matrix)]
+    config = HNSW(min_rows=100, ef_search=128)
+    retriever = Retriever(docs[:300], ann=config, max_segments=8)
+    retriever.add(docs[300:])
+    inserted = []
+    insert = HNSWIndex._insert
+    monkeypatch.setattr(HNSWIndex, "_insert", lambda self, node: (inserted.append(node), insert(self, node)))
+    retriever.compact()
+    assert inserted == list(range(300, 320))
+    exact = Retriever(docs)
+    query = list(matrix[310])
+    assert [r.document.content for r in retriever.search(query, top_k=5)] == [
+        r.document.content for r in exact.search(query, top_k=5)]
+
+
+def test_pipeline_builds_and_loads_with_ann_and_filters(tmp_path):
+    matrix = clustered(n=240)
+    kb = KnowledgeBase()
+    kb.documents = [Document(content=f"doc {i}", embedding=list(v),
+                             metadata={"id": str(i), "tier": "gold" if i % 4 == 0 else "std"})
+                    for i, v in enumerate(matrix)]
+    pipeline = RAGPipeline(kb, ann=HNSW(min_rows=50), filter_fields=["tier"])
+    pipeline.build_index(workers=2, shard_size=120, shard_dir=str(tmp_path / "shards"))
+    for segment in pipeline.retriever._snapshot.segments:
+        assert isinstance(segment.ann_index, HNSWIndex) and "tier" in segment.bitmaps
+    pipeline.save_index(str(tmp_path / "index"))
+
+    loaded = RAGPipeline(KnowledgeBase(), ann=HNSW(min_rows=50), filter_fields=["tier"])
+    loaded.load_index(str(tmp_path / "index"))
+    segment = loaded.retriever._snapshot.segments[0]
+    assert isinstance(segment.ann_index, HNSWIndex) and "tier" in segment.bitmaps
+    hits = loaded.retriever.search(list(matrix[8]), top_k=3, where={"tier": "gold"})
+    assert hits[0].document.content == "doc 8"
+    assert all(r.document.metadata["tier"] == "gold" for r in hits)
@@ -0,0 +1,35 @@
+"""Tests for the retrieval benchmark harness."""
+import json
+
+import numpy as np
+
+from ann import HNSW
+from benchmark import latency_summary, run, synthetic_corpus
+
+
+def test_corpus_duplicate_rate():
+    docs = synthetic_corpus(500, 8, duplicate_rate=0.2)
+    assert len(docs) == 500
+    assert len({d.content for d in docs}) == 400
+    first = {}
+    for doc in docs:
+        original = first.setdefault(doc.content, doc)
+        if original is not doc:
+            assert np.allclose(doc.embedding, original.embedding, atol=0.01)
+
+
+def test_latency_percentiles_are_ordered():
+    summary = latency_summary([1.0] * 90 + [5.0] * 9 + [50.0])
+    assert summary["p50_ms"] <= summary["p95_ms"] <= summary["p99_ms"]
+    assert summary["qps"] > 0
+
+
+def test_report_is_json_with_recall_per_backend():
+    report = run(n=300, dim=16, n_queries=20, k=5,
+                 backends={"exact": None, "hnsw": HNSW(min_rows=0)})
+    report = json.loads(json.dumps(report))
+    by_name = {b["backend"]: b for b in report["backends"]}
+    assert by_name["exact"]["recall_at_k"] == 1.0
+    assert by_name["hnsw"]["recall_at_k"] >= 0.9
+    assert by_name["hnsw"]["memory_bytes"]["ann"] > 0
+    assert report["config"]["n"] == 300
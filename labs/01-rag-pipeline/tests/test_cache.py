@@ -0,0 +1,84 @@
+"""Tests for the RAGPipeline query cache."""
+import pytest
+
+from cache import QueryCache, normalize_query
+from rag_pipeline import Document, KnowledgeBase, RAGPipeline
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_normalized_text_hits_and_lru_evicts():
+    cache = QueryCache(capacity=2)
+    assert normalize_query("  Reset   my PASSWORD? ") == "reset my password"
+    cache.put("reset password", 0, ["a"])
+    cache.put("error E-4012", 0, ["b"])
+    assert cache.get("Reset password!", 0).results == ["a"]
+    cache.put("webhooks", 0, ["c"])
+    assert cache.get("error e-4012", 0) is None
+    assert cache.get("reset password", 0) is not None
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.evictions) == (2, 1, 1)
+
+
+def test_ttl_and_version_invalidate():
+    clock = FakeClock()
+    cache = QueryCache(ttl_seconds=10, clock=clock)
+    cache.put("q", 3, ["a"])
+    assert cache.get("q", 4) is None
+    assert cache.stats.invalidations == 1 and len(cache) == 0
+    cache.put("q", 4, ["a"])
+    clock.now = 11
+    assert cache.get("q", 4) is None
+    assert cache.stats.expirations == 1
+
+
+def test_semantic_tier_respects_threshold_and_params():
+    cache = QueryCache(semantic_threshold=0.95)
+    cache.put("reset password", 0, ["a"], params=5, embedding=[1.0, 0.0])
+    assert cache.get("how to reset pwd", 0, params=5, embedding=[0.99, 0.05]).results == ["a"]
+    assert cache.get("how to reset pwd", 0, params=3, embedding=[0.99, 0.05]) is None
+    assert cache.get("billing", 0, params=5, embedding=[0.6, 0.8]) is None
+    assert (cache.stats.semantic_hits, cache.stats.misses) == (1, 2)
+
+
+class TestPipelineCache:
+    def pipeline(self, **cache_args):
+        kb = KnowledgeBase()
+        kb.documents = [
+            Document(content="Reset your password in Settings.", metadata={"id": "a"},
+                     embedding=[1.0, 0.0]),
+            Document(content="Error E-4012 means an expired API key.", metadata={"id": "b"},
+                     embedding=[0.0, 1.0]),
+        ]
+        pipeline = RAGPipeline(kb, top_k=1, cache=QueryCache(**cache_args))
+        pipeline.build_index()
+        return pipeline
+
+    def test_repeat_query_skips_retrieval(self):
+        pipeline = self.pipeline()
+        first = pipeline.generate_answer("Reset password", [1.0, 0.0])
+        assert pipeline.generate_answer("reset password?") == first
+        assert pipeline.cache.stats.hits == 1
+        with pytest.raises(ValueError):
+            pipeline.generate_answer("never asked")
+
+    def test_index_writes_invalidate(self):
+        pipeline = self.pipeline()
+        pipeline.generate_answer("reset password", [1.0, 0.0])
+        pipeline.retriever.upsert([Document(content="Passwords reset via SSO now.",
+                                            metadata={"id": "a"}, embedding=[1.0, 0.0])])
+        assert "SSO" in pipeline.generate_answer("reset password", [1.0, 0.0])
+        assert pipeline.cache.stats.invalidations == 1
+
+    def test_batch_only_searches_misses(self):
+        pipeline = self.pipeline(semantic_threshold=0.9)
+        pipeline.generate_answer("reset password", [1.0, 0.0])
+        answers = pipeline.generate_answers(["forgot password", "E-4012"], [[0.98, 0.1], [0.0, 1.0]])
+        assert "Settings" in answers[0] and "E-4012" in answers[1]
+        assert pipeline.cache.stats.semantic_hits == 1
+        assert len(pipeline.cache) == 2
@@ -0,0 +1,69 @@
+"""Tests for the embedder protocol, micro-batching, and the content-hash cache."""
+import threading
+
+import numpy as np
+
+from embedders import CachedEmbedder, HashingEmbedder, MicroBatcher
+from rag_pipeline import Document, KnowledgeBase, RAGPipeline
+
+
+class CountingEmbedder(HashingEmbedder):
+    def __init__(self):
+        super().__init__(dim=64)
+        self.calls = []
+
+    def embed(self, texts):
+        self.calls.append(len(texts))
+        return super().embed(texts)
+
+
+def test_hashing_embedder_is_deterministic_and_normalized():
+    embedder = HashingEmbedder(dim=128)
+    a = embedder.embed(["reset your password", "reset the password", "invoice totals"])
+    assert np.array_equal(a, HashingEmbedder(dim=128).embed(["reset your password", "reset the password",
+                                                             "invoice totals"]))
+    assert np.allclose(np.linalg.norm(a, axis=1), 1.0)
+    assert a[0] @ a[1] > a[0] @ a[2]
+    assert not embedder.embed([""]).any()
+
+
+def test_micro_batcher_coalesces_concurrent_requests():
+    inner = CountingEmbedder()
+    results = {}
+    with MicroBatcher(inner, max_batch_size=8, max_wait_ms=200) as batcher:
+        threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, batcher.embed([f"q {i}"])))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert batcher.embed([f"q {i}" for i in range(20)]).shape == (20, 64)
+    assert sum(inner.calls) == 28 and max(inner.calls) <= 8
+    assert len(inner.calls) < 8 + 3
+    for i, vector in results.items():
+        assert np.array_equal(vector[0], inner.embed([f"q {i}"])[0])
+
+
+def test_cache_skips_unchanged_text_and_survives_save(tmp_path):
+    inner = CountingEmbedder()
+    cached = CachedEmbedder(inner)
+    first = cached.embed(["a b", "c d", "a b"])
+    assert inner.calls == [2]
+    assert np.array_equal(cached.embed(["c d"])[0], first[1])
+    cached.save(str(tmp_path / "cache.npz"))
+    reloaded = CachedEmbedder.load(str(tmp_path / "cache.npz"), inner)
+    reloaded.embed(["a b", "e f"])
+    assert inner.calls == [2, 1] and (reloaded.hits, reloaded.misses) == (1, 1)
+
+
+def test_pipeline_rebuild_embeds_only_changed_chunks():
+    inner = CountingEmbedder()
+    kb = KnowledgeBase()
+    kb.documents = [Document(content=f"Article {i} explains password resets.", metadata={"id": str(i)})
+                    for i in range(5)]
+    pipeline = RAGPipeline(kb, top_k=1, embedder=CachedEmbedder(inner))
+    pipeline.build_index()
+    kb.documents[2] = Document(content="Article 2 now covers invoices.", metadata={"id": "2"})
+    pipeline.build_index()
+    assert sum(inner.calls) == 6
+    assert "invoices" in pipeline.generate_answer("invoices")
@@ -0,0 +1,95 @@
+"""Tests for the scalar and product quantized embedding stores."""
+import numpy as np
+import pytest
+
+import rag_pipeline
+from ann import recall_at_k
+from benchmark import index_memory
+from quantization import ProductQuantized, ScalarQuantized
+from rag_pipeline import Document, KnowledgeBase, RAGPipeline, Retriever
+
+
+def clustered(n=800, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(16, dim))
+    data = centers[rng.integers(16, size=n)] + 0.5 * rng.normal(size=(n, dim))
+    return (data / np.linalg.norm(data, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_scalar_codes_are_one_byte_per_dimension():
+    matrix = clustered()
+    index = ScalarQuantized(min_rows=1).build(matrix)
+    assert index.codes.dtype == np.uint8 and index.codes.shape == matrix.shape
+    assert matrix.nbytes / index.nbytes > 3.9
+    np.testing.assert_allclose(index.decode(np.arange(10)), matrix[:10], atol=index.scale.max())
+    query = matrix[3]
+    np.testing.assert_allclose(index.approximate_scores(query), matrix @ query, atol=0.02)
+
+
+def test_product_codes_use_asymmetric_distance():
+    matrix = clustered()
+    index = ProductQuantized(m=8, min_rows=1).build(matrix)
+    assert index.codes.shape == (8, matrix.shape[0])
+    assert index.codes.nbytes * 16 == matrix.nbytes
+    query = matrix[5]
+    # ADC equals the inner product with the decoded (reconstructed) vectors.
+    rows = np.arange(matrix.shape[0])
+    np.testing.assert_allclose(index.approximate_scores(query), index.decode(rows) @ query,
+                               atol=1e-5)
+    with pytest.raises(ValueError, match="divisible"):
+        ProductQuantized(m=5, min_rows=1).build(matrix)
+
+
+@pytest.mark.parametrize("config", [ScalarQuantized(min_rows=1),
+                                    ProductQuantized(m=8, rerank=10, min_rows=1)])
+def test_rerank_recovers_exact_scores(config):
+    matrix = clustered()
+    index = config.build(matrix)
+    queries = matrix[:30]
+    assert recall_at_k(matrix, index, queries, k=5) >= 0.9
+    rows, scores = index.search(matrix[0], 5)
+    np.testing.assert_allclose(scores, matrix[rows] @ matrix[0], rtol=1e-6)
+
+
+def test_retriever_with_quantized_store_skips_deleted_rows():
+    matrix = clustered(n=300)
+    docs = [Document(content=f"doc {i}", metadata={"id": str(i)}, embedding=list(v))
+            for i, v in enumerate(matrix)]
+    retriever = Retriever(docs, ann=ProductQuantized(m=8, rerank=20, min_rows=100))
+    exact = Retriever(docs)
+    query = list(matrix[42])
+    assert retriever.search(query, top_k=1)[0].document.content == "doc 42"
+    assert [r.document.content for r in retriever.search(query, top_k=3)] == [
+        r.document.content for r in exact.search(query, top_k=3)]
+    retriever.delete("42")
+    assert "doc 42" not in [r.document.content for r in retriever.search(query, top_k=5)]
+
+
+@pytest.mark.parametrize("config", [ScalarQuantized(min_rows=100),
+                                    ProductQuantized(m=8, rerank=20, min_rows=100)])
+def test_loaded_index_keeps_only_codes_resident(config, tmp_path, monkeypatch):
+    matrix = clustered(n=300)
+    kb = KnowledgeBase()
+    kb.documents = [Document(content=f"doc {i}", metadata={"id": str(i)}, embedding=list(v))
+                    for i, v in enumerate(matrix)]
+    built = RAGPipeline(kb, ann=config)
+    built.build_index(shard_dir=str(tmp_path / "build"))
+    assert isinstance(built.retriever._snapshot.segments[0].matrix, np.memmap)
+    built.save_index(str(tmp_path / "index"))
+
+    monkeypatch.setattr(type(built.retriever._snapshot.segments[0].ann_index), "__init__", None)
+    touched = []
+    monkeypatch.setattr(rag_pipeline, "_touch_pages", lambda buffer: touched.append(buffer) or 0)
+    pipeline = RAGPipeline(KnowledgeBase(), ann=config)
+    pipeline.load_index(str(tmp_path / "index"))
+    segment = pipeline.retriever._snapshot.segments[0]
+    assert isinstance(segment.matrix, np.memmap)
+    assert any(buffer is segment.ann_index.codes for buffer in touched)
+    assert not any(buffer is segment.matrix for buffer in touched)
+
+    memory = index_memory(pipeline.retriever)
+    assert memory["matrix"] == 0 and memory["matrix_on_disk"] == matrix.nbytes
+    assert memory["ann"] == segment.ann_index.nbytes and segment.ann_index.codes.nbytes * 4 <= matrix.nbytes
+    query = list(matrix[42])
+    assert [r.document.content for r in pipeline.retriever.search(query, top_k=3)] == [
+        r.document.content for r in built.retriever.search(query, top_k=3)]
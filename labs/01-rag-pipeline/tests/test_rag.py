@@ -1,6 +1,22 @@
 """Tests for RAG Pipeline — all must pass to complete the lab."""
+import io
+import json
+
+import numpy as np
 import pytest
-from rag_pipeline import KnowledgeBase, Retriever, RAGPipeline, Document
+from rag_pipeline import (
+    ContextPacker,
+    Document,
+    DocumentStore,
+    KeywordIndex,
+    KnowledgeBase,
+    LoadStats,
+    RAGPipeline,
+    Retriever,
+    SearchResult,
+    _iter_json_array,
+    tokenize,
+)
 
 
 class TestChunking:
@@ -43,6 +59,120 @@ class TestChunking:
         assert len(chunks) == 1
         assert chunks[0].content == "Short doc"
 
+    def test_chunks_are_spans_of_the_source(self):
+        """Chunks reference offsets into the source instead of copies."""
+        kb = KnowledgeBase()
+        doc = Document(content="First sentence here. " * 100, metadata={"id": "kb-7"})
+        chunks = list(kb.iter_chunks([doc], chunk_size=64, overlap=8))
+        assert len(chunks) > 1
+        for chunk in chunks:
+            doc_id, start, end = chunk.span
+            assert doc_id == "kb-7"
+            assert chunk.content == doc.content[start:end]
+        assert chunks[-1].end == len(doc.content)
+        # Overlapping spans leave no gaps between consecutive chunks.
+        assert all(b.start < a.end for a, b in zip(chunks, chunks[1:]))
+
+    def test_splits_snap_to_sentence_boundaries(self):
+        kb = KnowledgeBase()
+        text = " ".join(f"Sentence number {i} ends here." for i in range(60))
+        chunks = list(kb.iter_chunks([Document(content=text, metadata={})],
+                                     chunk_size=50, overlap=5))
+        assert all(c.content.endswith(".") for c in chunks)
+
+    def test_iter_chunks_is_lazy(self):
+        def documents():
+            yield Document(content="alpha " * 400, metadata={"id": "1"})
+            raise AssertionError("second document should not be read yet")
+
+        first = next(KnowledgeBase().iter_chunks(documents()))
+        assert first.content.startswith("alpha")
+
+
+class TestLoading:
+    ARTICLES = [
+        {"content": "Reset your password in Settings.", "metadata": {"id": "a-1"}},
+        {"content": "Tabs\tand\nnewlines survive.", "metadata": {"id": "a-2"}},
+        {"content": "No metadata here."},
+    ]
+
+    def test_loads_jsonl_and_json_array_identically(self, tmp_path):
+        jsonl = tmp_path / "articles.jsonl"
+        jsonl.write_text("\n".join(json.dumps(a) for a in self.ARTICLES) + "\n\n")
+        array = tmp_path / "articles.json"
+        array.write_text(json.dumps(self.ARTICLES, indent=2))
+
+        for path in (jsonl, array):
+            kb = KnowledgeBase()
+            kb.load_documents(str(path))
+            assert [d.content for d in kb.documents] == [a["content"] for a in self.ARTICLES]
+            assert kb.documents[2].metadata == {}
+            assert kb.load_stats.documents == 3
+            assert kb.load_stats.bytes_read == path.stat().st_size
+
+    def test_progress_and_record_ceiling(self, tmp_path):
+        path = tmp_path / "articles.json"
+        path.write_text(json.dumps(self.ARTICLES))
+        seen = []
+        kb = KnowledgeBase()
+        list(kb.iter_documents(str(path), progress=lambda s: seen.append(s.documents),
+                               progress_every=2))
+        assert seen == [2, 3]
+        with pytest.raises(ValueError, match="max_record_bytes"):
+            list(kb.iter_documents(str(path), max_record_bytes=10))
+
+    @staticmethod
+    def parse(text, read_size=3, max_record_bytes=1 << 20):
+        stream = io.BytesIO(text.encode("utf-8"))
+        return list(_iter_json_array(stream, LoadStats(), max_record_bytes, read_size=read_size))
+
+    def test_json_array_items_may_span_small_reads(self):
+        assert self.parse("[12345, 678]") == [12345, 678]
+        assert self.parse('[ {"content": "caf\u00e9 \u00e9t\u00e9"} ,\n 3.25e2, true,null ]',
+                          read_size=1) == [{"content": "café été"}, 325.0, True, None]
+        assert self.parse("[]") == [] and self.parse("[\n]") == []
+
+    @pytest.mark.parametrize("text", ["[1 2]", "[1,,2]", "[,1]", "[1,]", "[1", "{}"])
+    def test_json_array_rejects_malformed_separators(self, text):
+        with pytest.raises(ValueError):
+            self.parse(text)
+
+    def test_json_array_rejects_trailing_data(self):
+        assert self.parse("[1, 2] \n\t") == [1, 2]
+        with pytest.raises(ValueError, match="after the JSON array"):
+            self.parse("[1, 2] trailing-garbage")
+        with pytest.raises(ValueError, match="after the JSON array"):
+            self.parse("[][]")
+
+    @pytest.mark.parametrize("preamble", ["\ufeff", " " * 200 + "\n", "\ufeff\n" + "\t" * 100],
+                             ids=["bom", "whitespace", "bom-and-whitespace"])
+    def test_bom_and_leading_whitespace(self, tmp_path, preamble):
+        array = tmp_path / "articles.json"
+        array.write_text(preamble + json.dumps(self.ARTICLES), encoding="utf-8")
+        jsonl = tmp_path / "articles.jsonl"
+        jsonl.write_text(preamble + "\n".join(json.dumps(a) for a in self.ARTICLES), encoding="utf-8")
+        for path in (array, jsonl):
+            kb = KnowledgeBase()
+            kb.load_documents(str(path))
+            assert [d.content for d in kb.documents] == [a["content"] for a in self.ARTICLES]
+            assert kb.load_stats.bytes_read == path.stat().st_size
+
+    def test_record_limit_counts_utf8_bytes(self):
+        item = json.dumps("é" * 10, ensure_ascii=False)  # 12 characters, 22 bytes
+        assert self.parse(f"[{item}]", max_record_bytes=22) == ["é" * 10]
+        with pytest.raises(ValueError, match="max_record_bytes"):
+            self.parse(f"[{item}]", max_record_bytes=21)
+
+    def test_build_index_from_stream(self, tmp_path):
+        path = tmp_path / "articles.jsonl"
+        path.write_text("\n".join(json.dumps(a) for a in self.ARTICLES))
+        kb = KnowledgeBase()
+        pipeline = RAGPipeline(kb)
+        pipeline.build_index(kb.iter_documents(str(path)))
+        assert kb.documents == []
+        results = pipeline.retriever.keyword_search("password", top_k=1)
+        assert results[0].document.metadata["id"] == "a-1"
+
 
 class TestRetriever:
     def test_semantic_search_returns_results(self):
@@ -58,6 +188,40 @@ class TestRetriever:
         assert len(results) > 0
         assert results[0].document.content == "Python programming guide"
 
+    def test_search_matches_exact_cosine_ranking(self):
+        """Vectorized scoring should rank like a brute-force cosine scan."""
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(50, 16))
+        docs = [Document(content=f"doc {i}", metadata={}, embedding=list(v))
+                for i, v in enumerate(vectors)]
+        docs.append(Document(content="no embedding", metadata={}))
+        query = rng.normal(size=16)
+        expected = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+
+        results = Retriever(docs).search(list(query), top_k=5)
+
+        assert [r.document.content for r in results] == [
+            f"doc {i}" for i in np.argsort(-expected)[:5]
+        ]
+        assert results[0].score == pytest.approx(expected.max(), abs=1e-5)
+        assert len(Retriever(docs).search(list(query), top_k=100)) == 50
+
+    def test_search_batch_matches_single_search(self):
+        """Tiled batch search should return the same rankings as search()."""
+        rng = np.random.default_rng(1)
+        docs = [Document(content=f"doc {i}", metadata={}, embedding=list(v))
+                for i, v in enumerate(rng.normal(size=(40, 8)))]
+        queries = rng.normal(size=(7, 8))
+        retriever = Retriever(docs)
+
+        batched = retriever.search_batch(queries, top_k=4, query_block=3, doc_block=9)
+
+        assert len(batched) == 7
+        for query, results in zip(queries, batched):
+            single = retriever.search(list(query), top_k=4)
+            assert [r.document.content for r in results] == [r.document.content for r in single]
+            assert [r.score for r in results] == pytest.approx([r.score for r in single], abs=1e-5)
+
     def test_exact_term_retrieval(self):
         """System should be able to find documents by exact terms like error codes."""
         docs = [
@@ -80,6 +244,285 @@ class TestRetriever:
             pytest.fail("Retriever must support keyword_search or hybrid_search for exact matches")
         assert found, "Exact term 'E-4012' should be retrievable"
 
+    def test_error_codes_tokenize_as_single_terms(self):
+        assert tokenize("Error E-4012: see v2.1 docs.") == ["error", "e-4012", "see", "v2.1", "docs"]
+
+    def test_bm25_prefers_rare_terms_and_skips_unmatched_docs(self):
+        index = KeywordIndex([
+            "error E-4012 expired key",
+            "error E-4013 rate limit",
+            "password reset guide",
+        ])
+        doc_ids, scores = index.search("E-4012 error", top_k=5)
+        assert doc_ids.tolist() == [0, 1]
+        assert scores[0] > scores[1] > 0
+        assert index.search("nonexistent", top_k=5)[0].size == 0
+
+    def test_hybrid_search_fuses_both_rankings(self):
+        docs = [
+            Document(content="Error E-4012 expired API key", metadata={}, embedding=[0.0, 1.0]),
+            Document(content="Troubleshooting overview", metadata={}, embedding=[1.0, 0.0]),
+            Document(content="Billing FAQ", metadata={}, embedding=[0.7, 0.7]),
+        ]
+        results = Retriever(docs).hybrid_search("E-4012", [1.0, 0.0], top_k=3)
+        assert results[0].document.content == "Error E-4012 expired API key"
+        assert results[0].score > results[1].score
+
+
+class TestIncrementalUpdates:
+    @staticmethod
+    def article(doc_id, text, vector):
+        return Document(content=text, metadata={"id": doc_id}, embedding=vector)
+
+    def base(self):
+        return Retriever([
+            self.article("a", "Reset your password in Settings", [1.0, 0.0, 0.0]),
+            self.article("b", "Error E-4012 means an expired API key", [0.0, 1.0, 0.0]),
+        ])
+
+    def test_add_delete_upsert(self):
+        retriever = self.base()
+        retriever.add([self.article("c", "Webhook retries use backoff", [0.0, 0.0, 1.0])])
+        assert retriever.search([0.0, 0.1, 1.0], top_k=1)[0].document.metadata["id"] == "c"
+
+        assert retriever.delete("b") == 1
+        assert retriever.keyword_search("E-4012", top_k=3) == []
+        assert all(r.document.metadata["id"] != "b"
+                   for r in retriever.search([0.0, 1.0, 0.0], top_k=3))
+
+        replaced = retriever.upsert([self.article("a", "Passwords reset via SSO now", [1.0, 0.0, 0.0])])
+        assert replaced == 1
+        assert [r.document.content for r in retriever.keyword_search("password", top_k=5)] == []
+        assert retriever.keyword_search("passwords", top_k=5)[0].document.content == "Passwords reset via SSO now"
+        assert sorted(d.metadata["id"] for d in retriever.documents) == ["a", "c"]
+        assert retriever.delete("missing") == 0
+
+    def test_compaction_matches_fresh_build(self):
+        retriever = self.base()
+        retriever.add([self.article("c", "API key rotation guide", [0.5, 0.5, 0.0])])
+        retriever.upsert([self.article("b", "Error E-4012 means an expired API key, rotate it",
+                                       [0.0, 1.0, 0.1])])
+        retriever.compact()
+
+        fresh = Retriever(retriever.documents)
+        for query in ("API key", "E-4012 expired"):
+            got = retriever.keyword_search(query, top_k=3)
+            want = fresh.keyword_search(query, top_k=3)
+            assert [r.document.content for r in got] == [r.document.content for r in want]
+            assert [r.score for r in got] == pytest.approx([r.score for r in want])
+        batched = retriever.search_batch([[0.0, 1.0, 0.1]], top_k=3)[0]
+        assert [r.document.content for r in batched] == [
+            r.document.content for r in fresh.search([0.0, 1.0, 0.1], top_k=3)]
+
+    def test_searches_see_a_consistent_snapshot_during_compaction(self):
+        retriever = Retriever([], max_segments=2)
+        for i in range(20):
+            retriever.upsert([self.article("doc", f"version {i}", [1.0, float(i), 0.0])])
+            hits = retriever.search([1.0, 0.0, 0.0], top_k=5)
+            # Exactly one live version of "doc" at any point in time.
+            assert [r.document.content for r in hits] == [f"version {i}"]
+        retriever.compact()
+        assert len(retriever) == 1
+        assert len(retriever._snapshot.segments) == 1
+
+
+class TestDocumentStore:
+    def chunks(self):
+        kb = KnowledgeBase()
+        kb.documents = [
+            Document(content="alpha " * 200, metadata={"id": "a"}, embedding=[1.0, 0.0]),
+            Document(content="beta " * 200, metadata={"id": "b"}, embedding=[0.0, 2.0]),
+        ]
+        return kb.chunk_documents(chunk_size=64, overlap=8)
+
+    def test_chunks_share_source_text_and_metadata(self):
+        chunks = self.chunks()
+        store = DocumentStore.from_documents(chunks)
+        (part,) = store.parts
+        assert len(part.sources) == 2 and len(part.metadata_table) == 2
+        assert [d.content for d in store] == [c.content for c in chunks]
+        assert [d.span for d in store] == [c.span for c in chunks]
+        assert store[-1].embedding.tolist() == [0.0, 1.0]
+        assert sorted(store.key_rows()) == ["a", "b"]
+
+    def test_search_results_are_lazy_views(self):
+        retriever = Retriever(self.chunks())
+        result = retriever.search([0.0, 1.0], top_k=1)[0]
+        assert not hasattr(result, "__dict__")
+        assert result.document.metadata["id"] == "b"
+        assert result.document == result.document
+
+    def test_merge_reuses_parts(self):
+        first = Retriever(self.chunks(), max_segments=4)
+        first.add([Document(content="gamma", metadata={"id": "c"}, embedding=[1.0, 1.0])])
+        parts = [s.documents.parts[0] for s in first._snapshot.segments]
+        first.delete("a")
+        first.compact()
+        (segment,) = first._snapshot.segments
+        assert all(any(p is q for q in parts) for p in segment.documents.parts)
+        assert sorted({d.metadata["id"] for d in first.documents}) == ["b", "c"]
+
+
+def ids(results):
+    return [r.document.metadata["id"] for r in results]
+
+
+class TestMetadataFilters:
+    @staticmethod
+    def docs():
+        return [
+            Document(content="Reset your password", embedding=[1.0, 0.0],
+                     metadata={"id": "1", "product": "billing", "locale": "en", "status": "published"}),
+            Document(content="Réinitialiser le password", embedding=[0.9, 0.1],
+                     metadata={"id": "2", "product": "billing", "locale": "fr", "status": "published"}),
+            Document(content="Reset your password (draft)", embedding=[1.0, 0.05],
+                     metadata={"id": "3", "product": "billing", "locale": "en", "status": "draft"}),
+            Document(content="Password policy for the API", embedding=[0.5, 0.5],
+                     metadata={"id": "4", "product": "api", "locale": "en", "status": "published",
+                               "tags": ["security", "auth"]}),
+        ]
+
+    def test_where_applies_to_every_search_mode(self):
+        retriever = Retriever(self.docs(), filter_fields=["product", "locale", "status"])
+        where = {"locale": "en", "status": "published"}
+        assert ids(retriever.search([1.0, 0.0], top_k=4, where=where)) == ["1", "4"]
+        assert sorted(ids(retriever.keyword_search("password", top_k=4, where=where))) == ["1", "4"]
+        hybrid = retriever.hybrid_search("password", [1.0, 0.0], top_k=4, where=where)
+        assert sorted(ids(hybrid)) == ["1", "4"]
+        (batch,) = retriever.search_batch([[1.0, 0.0]], top_k=4, where={"locale": ["fr", "de"]})
+        assert ids(batch) == ["2"]
+        assert retriever.search([1.0, 0.0], where={"product": "unknown"}) == []
+
+    def test_unindexed_and_list_fields(self):
+        retriever = Retriever(self.docs())
+        assert ids(retriever.search([1.0, 0.0], top_k=4, where={"tags": "auth"})) == ["4"]
+
+    def test_filters_see_writes(self):
+        retriever = Retriever(self.docs(), filter_fields=["status"])
+        retriever.upsert([Document(content="Reset your password (final)", embedding=[1.0, 0.05],
+                                   metadata={"id": "3", "product": "billing", "locale": "en",
+                                             "status": "published"})])
+        retriever.delete("1")
+        where = {"status": "published", "locale": "en"}
+        assert ids(retriever.search([1.0, 0.0], top_k=4, where=where)) == ["3", "4"]
+        retriever.compact()
+        assert ids(retriever.search([1.0, 0.0], top_k=4, where=where)) == ["3", "4"]
+
+
+class TestParentRetrieval:
+    @staticmethod
+    def sub_chunked(seed=0):
+        rng = np.random.default_rng(seed)
+        docs = [Document(content=" ".join(f"w{i}x{j}" for j in range(120)), metadata={"id": str(i)})
+                for i in range(12)]
+        chunks = list(KnowledgeBase().iter_chunks(docs, chunk_size=16, overlap=2))
+        for chunk in chunks:
+            chunk.embedding = rng.normal(size=8).tolist()
+        return docs, chunks
+
+    def test_parents_rank_by_best_sub_chunk(self, tmp_path):
+        docs, chunks = self.sub_chunked()
+        order = np.random.default_rng(1).permutation(len(chunks))
+        query = np.random.default_rng(2).normal(size=8)
+        best = {}
+        for chunk in chunks:
+            vector = np.asarray(chunk.embedding) / np.linalg.norm(chunk.embedding)
+            score = float(vector @ query / np.linalg.norm(query))
+            best[chunk.metadata["id"]] = max(best.get(chunk.metadata["id"], -1.0), score)
+        expected = sorted(best.items(), key=lambda item: -item[1])[:4]
+
+        retriever = Retriever(chunks)
+        shuffled = Retriever([chunks[i] for i in order])
+        retriever.save(str(tmp_path / "index"))
+        for r in (retriever, shuffled, Retriever.load(str(tmp_path / "index"))):
+            results = r.search_parents(query, top_k=4)
+            assert ids(results) == [doc_id for doc_id, _ in expected]
+            assert np.allclose([x.score for x in results], [score for _, score in expected], atol=1e-5)
+
+        retriever.delete(expected[0][0])
+        assert expected[0][0] not in ids(retriever.search_parents(query, top_k=4))
+        assert ids(retriever.search_parents(query, top_k=2, where={"id": "3"})) == ["3"]
+
+    def test_window_surrounds_the_best_hit(self):
+        docs, chunks = self.sub_chunked()
+        target = chunks[7]
+        retriever = Retriever(chunks)
+        [result] = retriever.search_parents(target.embedding, top_k=1, window_tokens=40)
+        span = result.document
+        assert span.metadata["id"] == target.metadata["id"]
+        assert span.hit == (target.start, target.end)
+        assert span.start <= target.start and target.end <= span.end
+        assert target.content in span.content and len(span.content) > len(target.content)
+        assert span.content == target.source.content[span.start:span.end]
+        assert span.end - span.start <= 40 * 4
+
+    def test_pipeline_answers_with_the_parent_window(self):
+        from embedders import HashingEmbedder
+
+        filler = " ".join(f"Paragraph {i} covers account settings." for i in range(40))
+        kb = KnowledgeBase()
+        kb.documents = [
+            Document(content=filler + " Refunds for annual invoices take ten days. " + filler,
+                     metadata={"id": "long"}),
+            Document(content="Invoices list every charge.", metadata={"id": "short"}),
+        ]
+        pipeline = RAGPipeline(kb, top_k=1, embedder=HashingEmbedder(), sub_chunk_tokens=16,
+                               parent_window_tokens=64)
+        pipeline.build_index()
+        answer = pipeline.generate_answer("refunds for annual invoices")
+        assert "Refunds for annual invoices take ten days." in answer
+        assert "account settings" in answer and len(answer) < len(filler)
+
+
+class TestContextPacking:
+    TEXT = " ".join(f"Step {i} of the password reset flow is documented here." for i in range(40))
+
+    def chunks(self):
+        doc = Document(content=self.TEXT, metadata={"id": "article-001"})
+        return doc, list(KnowledgeBase().iter_chunks([doc], chunk_size=60, overlap=12))
+
+    def test_overlapping_chunks_merge_into_one_passage(self):
+        doc, chunks = self.chunks()
+        results = [SearchResult(document=c, score=0.9 - 0.01 * i) for i, c in enumerate(chunks[:3])]
+        passages = ContextPacker(token_budget=10_000).pack(results)
+        assert len(passages) == 1
+        assert passages[0].text == doc.content[chunks[0].start:chunks[2].end]
+        assert passages[0].score == pytest.approx(0.9)
+
+    def test_budget_is_respected_and_trimmed_at_sentence_end(self):
+        _, chunks = self.chunks()
+        results = [SearchResult(document=chunks[0], score=0.9)]
+        packer = ContextPacker(token_budget=40, count_tokens=lambda t: len(t.split()))
+        [passage] = packer.pack(results)
+        assert passage.tokens <= 40
+        assert passage.text.endswith("here.")
+
+    def test_packs_by_score_per_token(self):
+        long_doc = Document(content="Long but only loosely relevant. " * 30, metadata={"id": "a"})
+        short_doc = Document(content="Short and relevant.", metadata={"id": "b"})
+        results = [SearchResult(document=long_doc, score=0.9),
+                   SearchResult(document=short_doc, score=0.8)]
+        passages = ContextPacker(token_budget=60).pack(results)
+        assert passages[-1].doc_id == "b"
+        assert sum(p.tokens for p in passages) <= 60
+        assert passages[0].text.endswith("relevant.")
+
+    def test_negative_scores_still_favour_the_best_passage(self):
+        short_doc = Document(content="Short and relevant.", metadata={"id": "a"})
+        long_doc = Document(content="Long but only loosely relevant. " * 30, metadata={"id": "b"})
+        for best, worse in ((-1.0, -6.0), (6.0, 1.0)):
+            passages = ContextPacker(token_budget=60).pack([SearchResult(document=short_doc, score=best),
+                                                            SearchResult(document=long_doc, score=worse)])
+            assert [p.doc_id for p in passages] == ["a", "b"]
+            assert sum(p.tokens for p in passages) <= 60
+
+
+class LetterEmbedder:
+    """Picklable toy embedder: letter frequencies."""
+
+    def embed(self, texts):
+        return np.asarray([[t.lower().count(c) for c in "aeiost"] for t in texts], dtype=np.float32)
+
 
 class TestPipeline:
     def test_context_length_sufficient(self):
@@ -115,3 +558,130 @@ class TestPipeline:
         pipeline.build_index()
         answer = pipeline.generate_answer("password reset", [0.8, 0.1, 0.1])
         assert "context" in answer.lower() or "password" in answer.lower()
+
+    def test_saved_index_round_trips_through_mmap(self, tmp_path):
+        """A loaded index should answer exactly like the one that was saved."""
+        kb = KnowledgeBase()
+        kb.documents = [
+            Document(content="Error E-4012 means expired API key. " * 40,
+                     metadata={"id": "article-002", "locale": "en"}, embedding=[0.1, 0.9, 0.0]),
+            Document(content="Reset your password in Settings.",
+                     metadata={"id": "article-001"}, embedding=[0.9, 0.1, 0.0]),
+            Document(content="Unembedded release notes mention E-4012.", metadata={"id": "n"}),
+        ]
+        pipeline = RAGPipeline(kb)
+        pipeline.build_index()
+        pipeline.save_index(str(tmp_path / "index"))
+
+        loaded = RAGPipeline(KnowledgeBase())
+        loaded.load_index(str(tmp_path / "index"), mmap=True, verify=True)
+
+        for before, after in [
+            (pipeline.retriever.search([1.0, 0.2, 0.0], top_k=3),
+             loaded.retriever.search([1.0, 0.2, 0.0], top_k=3)),
+            (pipeline.retriever.keyword_search("E-4012", top_k=5),
+             loaded.retriever.keyword_search("E-4012", top_k=5)),
+        ]:
+            assert [r.document.span for r in after] == [r.document.span for r in before]
+            assert [r.document.content for r in after] == [r.document.content for r in before]
+            assert [r.score for r in after] == pytest.approx([r.score for r in before])
+        assert loaded.retriever.documents[0].metadata == {"id": "article-002", "locale": "en"}
+        assert loaded.generate_answer("q", [0.9, 0.1, 0.0]) == pipeline.generate_answer("q", [0.9, 0.1, 0.0])
+
+    def test_load_index_rejects_modified_files(self, tmp_path):
+        kb = KnowledgeBase()
+        kb.documents = [Document(content="Short doc", metadata={"id": "1"}, embedding=[1.0, 0.0])]
+        pipeline = RAGPipeline(kb)
+        pipeline.build_index()
+        pipeline.save_index(str(tmp_path))
+        (tmp_path / "text.bin").write_bytes(b"Shxrt doc")
+        with pytest.raises(ValueError, match="checksum"):
+            RAGPipeline(kb).load_index(str(tmp_path), verify=True)
+
+    def test_save_over_a_mapped_index_leaves_readers_valid(self, tmp_path):
+        path = str(tmp_path / "index")
+        docs = [Document(content=f"Article {i}. " + "Long body text. " * 400, metadata={"id": str(i)},
+                         embedding=[float(i), 1.0]) for i in range(20)]
+        Retriever(docs).save(path)
+        mapped = Retriever.load(path, use_mmap=True)
+        mapped.add([Document(content="Late addition.", metadata={"id": "late"}, embedding=[1.0, 0.0])])
+        mapped.save(path)
+
+        # The old mapping still reads the replaced files' contents.
+        assert [r.document.content[:11] for r in mapped.search([1.0, 0.0], top_k=2)] == [
+            "Late additi", "Article 19."]
+        reloaded = Retriever.load(path, verify=True)
+        assert len(reloaded) == 21 and reloaded.search([1.0, 0.0], top_k=1)[0].document.content == (
+            "Late addition.")
+        assert [entry.name for entry in tmp_path.iterdir()] == ["index"]
+
+    def test_generate_answers_batches_queries(self):
+        """Batched answering should produce one answer per query."""
+        kb = KnowledgeBase()
+        kb.documents = [
+            Document(content="Reset your password in Settings.",
+                     metadata={"id": "a"}, embedding=[1.0, 0.0]),
+            Document(content="Error E-4013 means rate limit exceeded.",
+                     metadata={"id": "b"}, embedding=[0.0, 1.0]),
+        ]
+        pipeline = RAGPipeline(kb)
+        pipeline.build_index()
+        answers = pipeline.generate_answers(["password", "rate limit"], [[1.0, 0.1], [0.1, 1.0]])
+        assert len(answers) == 2
+        assert answers[0].index("password") < answers[0].index("E-4013")
+        assert answers[1].index("E-4013") < answers[1].index("password")
+
+    def test_sharded_build_matches_serial_build(self, tmp_path):
+        kb = KnowledgeBase()
+        kb.documents = [
+            Document(content=f"Article {i}: " + "reset the password safely. " * (i % 7 + 1),
+                     metadata={"id": str(i)})
+            for i in range(40)
+        ]
+        serial = RAGPipeline(kb, embedder=LetterEmbedder())
+        serial.build_index()
+        sharded = RAGPipeline(kb, embedder=LetterEmbedder())
+        sharded.build_index(workers=2, shard_size=7, shard_dir=str(tmp_path))
+        assert len(sharded.retriever._snapshot.segments) == 6
+        assert len(sharded.retriever) == len(serial.retriever)
+
+        query = LetterEmbedder().embed(["reset password"])[0]
+        for search in (lambda r: r.search(query, top_k=5), lambda r: r.keyword_search("article 12")):
+            a, b = search(serial.retriever), search(sharded.retriever)
+            assert [r.document.span for r in a] == [r.document.span for r in b]
+            assert [r.score for r in a] == pytest.approx([r.score for r in b], rel=1e-5)
+
+        in_memory = RAGPipeline(kb, embedder=LetterEmbedder())
+        in_memory.build_index(workers=2, shard_size=25)
+        assert len(in_memory.retriever._snapshot.segments) == 2
+        assert [r.score for r in in_memory.retriever.search(query, top_k=5)] == pytest.approx(
+            [r.score for r in serial.retriever.search(query, top_k=5)], rel=1e-5)
+
+    def test_swap_releases_old_index_after_in_flight_queries(self, tmp_path):
+        kb = KnowledgeBase()
+        kb.documents = [Document(content=f"Article {i} on password resets.", metadata={"id": str(i)})
+                        for i in range(12)]
+        pipeline = RAGPipeline(kb, embedder=LetterEmbedder())
+        pipeline.build_index(workers=2, shard_size=6, shard_dir=str(tmp_path))
+        first_dir = list(tmp_path.iterdir())
+
+        with pipeline.acquire() as old:
+            kb.documents.append(Document(content="Invoices are emailed.", metadata={"id": "new"}))
+            pipeline.build_index(workers=2, shard_size=6, shard_dir=str(tmp_path))
+            assert pipeline.retriever is not old.retriever and len(old.retriever) == 12
+            assert old.retriever.search(LetterEmbedder().embed(["password"])[0], top_k=1)
+            assert not old.released and len(list(tmp_path.iterdir())) == 2
+        assert old.released and first_dir[0] not in list(tmp_path.iterdir())
+        assert len(pipeline.retriever) == 13
+        assert "Invoices" in pipeline.generate_answer("invoices emailed")
+
+    def test_load_index_warms_mapped_pages(self, tmp_path):
+        kb = KnowledgeBase()
+        kb.documents = [Document(content=f"Article {i}", metadata={"id": str(i)},
+                                 embedding=[float(i), 1.0]) for i in range(50)]
+        pipeline = RAGPipeline(kb)
+        pipeline.build_index()
+        pipeline.save_index(str(tmp_path))
+        pipeline.load_index(str(tmp_path))
+        assert pipeline.retriever.warm() >= pipeline.retriever._snapshot.segments[0].matrix.nbytes
+        assert "Article 49" in pipeline.generate_answer("article", [1.0, 0.0])
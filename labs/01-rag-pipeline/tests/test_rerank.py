@@ -0,0 +1,59 @@
+"""Tests for the second-stage re-ranker."""
+from rag_pipeline import Document, KnowledgeBase, RAGPipeline, Retriever
+from rerank import LexicalCrossEncoder, Reranker
+
+
+class RecordingScorer(LexicalCrossEncoder):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def predict(self, pairs):
+        self.batches.append(len(pairs))
+        return super().predict(pairs)
+
+
+def test_budget_skips_when_top_k_is_settled():
+    reranker = Reranker(LexicalCrossEncoder(), candidates=10, margin=0.05)
+    assert reranker.budget([0.9, 0.8, 0.5, 0.4], top_k=2) == 0
+    assert reranker.budget([0.9, 0.8, 0.78, 0.76, 0.5], top_k=2) == 4
+    assert reranker.budget([0.9, 0.8], top_k=2) == 0
+
+
+def test_lexical_scorer_prefers_the_phrase():
+    scores = LexicalCrossEncoder().predict([
+        ("reset password", "Password policy: reset tokens expire."),
+        ("reset password", "To reset password, open Settings."),
+    ])
+    assert scores[1] > scores[0]
+
+
+def test_rerank_scores_in_batches_and_keeps_k():
+    texts = [f"Article {i} about billing and invoices" for i in range(6)] + ["How to reset password"]
+    docs = [Document(content=t, metadata={"id": str(i)}, embedding=[1.0, 0.01 * i])
+            for i, t in enumerate(texts)]
+    first_stage = Retriever(docs).search([1.0, 0.0], top_k=7)
+    scorer = RecordingScorer()
+    reranker = Reranker(scorer, candidates=7, batch_size=3, margin=0.1)
+    results = reranker.rerank("reset password", first_stage, top_k=2)
+    assert [r.document.content for r in results][0] == "How to reset password"
+    assert len(results) == 2
+    assert scorer.batches == [3, 3, 1]
+    assert reranker.stats.pairs_scored == 7
+
+
+def test_pipeline_reranks_only_when_it_can_change_the_answer():
+    kb = KnowledgeBase()
+    kb.documents = [
+        Document(content="Password policy: reset tokens expire after 24 hours.",
+                 metadata={"id": "a"}, embedding=[1.0, 0.0]),
+        Document(content="To reset password, open Settings and choose Security.",
+                 metadata={"id": "b"}, embedding=[0.99, 0.1]),
+        Document(content="Invoices are emailed monthly.", metadata={"id": "c"}, embedding=[0.0, 1.0]),
+    ]
+    reranker = Reranker(LexicalCrossEncoder(), candidates=3, margin=0.05)
+    pipeline = RAGPipeline(kb, top_k=1, reranker=reranker)
+    pipeline.build_index()
+    assert "open Settings" in pipeline.generate_answer("reset password", [1.0, 0.0])
+    assert "Invoices" in pipeline.generate_answer("invoices", [0.0, 1.0])
+    assert (reranker.stats.queries, reranker.stats.skipped) == (2, 1)